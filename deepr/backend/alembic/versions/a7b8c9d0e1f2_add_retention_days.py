@@ -0,0 +1,25 @@
+"""add per-user conversation retention
+
+Revision ID: a7b8c9d0e1f2
+Revises: f6a7b8c9d0e1
+Create Date: 2026-10-19 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7b8c9d0e1f2'
+down_revision = 'f6a7b8c9d0e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user_settings', sa.Column('retention_days', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user_settings') as batch:
+        batch.drop_column('retention_days')
@@ -0,0 +1,27 @@
+"""soft-delete conversations
+
+Revision ID: b8c9d0e1f2a3
+Revises: a7b8c9d0e1f2
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8c9d0e1f2a3'
+down_revision = 'a7b8c9d0e1f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('conversations', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index('ix_conversations_deleted_at', 'conversations', ['deleted_at'])
+
+
+def downgrade():
+    op.drop_index('ix_conversations_deleted_at', table_name='conversations')
+    with op.batch_alter_table('conversations') as batch:
+        batch.drop_column('deleted_at')
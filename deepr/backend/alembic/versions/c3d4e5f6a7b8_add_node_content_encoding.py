@@ -0,0 +1,25 @@
+"""add content_encoding to nodes for delta-stored drafts
+
+Revision ID: c3d4e5f6a7b8
+Revises: b2c3d4e5f6a7
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d4e5f6a7b8'
+down_revision = 'b2c3d4e5f6a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL means content holds the full text; "delta" means a line delta against the parent node
+    op.add_column('nodes', sa.Column('content_encoding', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('nodes', 'content_encoding')
@@ -0,0 +1,55 @@
+"""cache extracted text of attachments
+
+Revision ID: c9d0e1f2a3b4
+Revises: b8c9d0e1f2a3
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9d0e1f2a3b4'
+down_revision = 'b8c9d0e1f2a3'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 100
+
+
+def upgrade():
+    op.add_column('attachments', sa.Column('extracted_text', sa.Text(), nullable=True))
+    op.add_column('attachments', sa.Column('page_count', sa.Integer(), nullable=True))
+    op.add_column('attachments', sa.Column('token_estimate', sa.Integer(), nullable=True))
+
+    # Text files only: PDF extraction needs the optional pypdf, so older PDFs keep being sent as files
+    bind = op.get_bind()
+    attachments = sa.table(
+        'attachments', sa.column('id', sa.Integer), sa.column('file_type', sa.String), sa.column('file_data', sa.LargeBinary),
+        sa.column('extracted_text', sa.Text), sa.column('token_estimate', sa.Integer)
+    )
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(attachments.c.id, attachments.c.file_data)
+            .where(attachments.c.id > last_id, attachments.c.file_type == 'text')
+            .order_by(attachments.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        for attachment_id, data in rows:
+            text = data.decode('utf-8', errors='replace')
+            bind.execute(
+                attachments.update().where(attachments.c.id == attachment_id)
+                .values(extracted_text=text, token_estimate=(len(text) + 3) // 4)
+            )
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    with op.batch_alter_table('attachments') as batch:
+        batch.drop_column('token_estimate')
+        batch.drop_column('page_count')
+        batch.drop_column('extracted_text')
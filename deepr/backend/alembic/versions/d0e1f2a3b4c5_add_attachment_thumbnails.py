@@ -0,0 +1,30 @@
+"""add image dimensions and thumbnails to attachments
+
+Revision ID: d0e1f2a3b4c5
+Revises: c9d0e1f2a3b4
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd0e1f2a3b4c5'
+down_revision = 'c9d0e1f2a3b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing images get no thumbnail (the UI falls back to an icon); Pillow is optional at runtime
+    op.add_column('attachments', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('attachments', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('attachments', sa.Column('thumbnail', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('attachments') as batch:
+        batch.drop_column('thumbnail')
+        batch.drop_column('height')
+        batch.drop_column('width')
@@ -0,0 +1,33 @@
+"""add execution timeline fields to nodes
+
+Revision ID: d4e5f6a7b8c9
+Revises: c3d4e5f6a7b8
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e5f6a7b8c9'
+down_revision = 'c3d4e5f6a7b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Model call and persistence timestamps for the run timeline
+    op.add_column('nodes', sa.Column('request_started_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('nodes', sa.Column('first_token_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('nodes', sa.Column('completed_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('nodes', sa.Column('persisted_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('nodes', sa.Column('retry_count', sa.Integer, nullable=True))
+
+
+def downgrade():
+    op.drop_column('nodes', 'retry_count')
+    op.drop_column('nodes', 'persisted_at')
+    op.drop_column('nodes', 'completed_at')
+    op.drop_column('nodes', 'first_token_at')
+    op.drop_column('nodes', 'request_started_at')
@@ -0,0 +1,33 @@
+"""add model_stats for telemetry-driven routing
+
+Revision ID: e1f2a3b4c5d6
+Revises: d0e1f2a3b4c5
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f2a3b4c5d6'
+down_revision = 'd0e1f2a3b4c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'model_stats',
+        sa.Column('model', sa.String(255), primary_key=True),
+        sa.Column('latency_seconds', sa.Float(), nullable=True),
+        sa.Column('ttft_seconds', sa.Float(), nullable=True),
+        sa.Column('error_rate', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('cost_per_1k_tokens', sa.Float(), nullable=True),
+        sa.Column('calls', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+
+
+def downgrade():
+    op.drop_table('model_stats')
@@ -0,0 +1,83 @@
+"""add full-text search vectors to conversations and nodes
+
+Revision ID: e5f6a7b8c9d0
+Revises: d4e5f6a7b8c9
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5f6a7b8c9d0'
+down_revision = 'd4e5f6a7b8c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        # SQLite keeps an unused column and searches with LIKE
+        op.add_column('conversations', sa.Column('search_vector', sa.Text(), nullable=True))
+        op.add_column('nodes', sa.Column('search_vector', sa.Text(), nullable=True))
+        return
+
+    op.add_column('conversations', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+    op.add_column('nodes', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION deepr_conversations_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER conversations_search_vector_update BEFORE INSERT OR UPDATE OF title ON conversations
+            FOR EACH ROW EXECUTE FUNCTION deepr_conversations_search_vector_update()
+    """)
+
+    # Delta-encoded drafts (content_encoding = 'delta') are JSON lists; index the lines they insert
+    op.execute("""
+        CREATE OR REPLACE FUNCTION deepr_node_search_text(content text, content_encoding text) RETURNS text AS $$
+            SELECT CASE WHEN content_encoding = 'delta' THEN (
+                SELECT coalesce(string_agg(line, ''), '')
+                FROM jsonb_array_elements(content::jsonb) AS ops(op),
+                     jsonb_array_elements_text(CASE WHEN jsonb_typeof(op) = 'array' THEN op ELSE '[]'::jsonb END) AS lines(line)
+            ) ELSE coalesce(content, '') END
+        $$ LANGUAGE sql IMMUTABLE
+    """)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION deepr_nodes_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := setweight(to_tsvector('english', deepr_node_search_text(NEW.content, NEW.content_encoding)), 'B');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER nodes_search_vector_update BEFORE INSERT OR UPDATE OF content, content_encoding ON nodes
+            FOR EACH ROW EXECUTE FUNCTION deepr_nodes_search_vector_update()
+    """)
+
+    # Backfill existing rows, then index
+    op.execute("UPDATE conversations SET search_vector = setweight(to_tsvector('english', coalesce(title, '')), 'A')")
+    op.execute("UPDATE nodes SET search_vector = setweight(to_tsvector('english', deepr_node_search_text(content, content_encoding)), 'B')")
+    op.create_index('ix_conversations_search_vector', 'conversations', ['search_vector'], postgresql_using='gin')
+    op.create_index('ix_nodes_search_vector', 'nodes', ['search_vector'], postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_nodes_search_vector', table_name='nodes')
+        op.drop_index('ix_conversations_search_vector', table_name='conversations')
+        op.execute("DROP TRIGGER IF EXISTS nodes_search_vector_update ON nodes")
+        op.execute("DROP TRIGGER IF EXISTS conversations_search_vector_update ON conversations")
+        op.execute("DROP FUNCTION IF EXISTS deepr_nodes_search_vector_update()")
+        op.execute("DROP FUNCTION IF EXISTS deepr_node_search_text(text, text)")
+        op.execute("DROP FUNCTION IF EXISTS deepr_conversations_search_vector_update()")
+    op.drop_column('nodes', 'search_vector')
+    op.drop_column('conversations', 'search_vector')
@@ -0,0 +1,24 @@
+"""index nodes by conversation and creation time for retention
+
+Revision ID: f2a3b4c5d6e7
+Revises: e1f2a3b4c5d6
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a3b4c5d6e7'
+down_revision = 'e1f2a3b4c5d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Retention looks for each conversation's newest node
+    op.create_index('ix_nodes_conversation_created_at', 'nodes', ['conversation_id', 'created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_nodes_conversation_created_at', table_name='nodes')
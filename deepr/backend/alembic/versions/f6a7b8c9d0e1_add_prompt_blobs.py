@@ -0,0 +1,79 @@
+"""store node prompts in content-addressed, compressed prompt_blobs
+
+Revision ID: f6a7b8c9d0e1
+Revises: e5f6a7b8c9d0
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import hashlib
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a7b8c9d0e1'
+down_revision = 'e5f6a7b8c9d0'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    op.create_table(
+        'prompt_blobs',
+        sa.Column('hash', sa.String(64), primary_key=True),
+        sa.Column('encoding', sa.String(10), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    with op.batch_alter_table('nodes') as batch:
+        batch.add_column(sa.Column('prompt_hash', sa.String(64), nullable=True))
+        batch.create_index('ix_nodes_prompt_hash', ['prompt_hash'])
+        batch.create_foreign_key('fk_nodes_prompt_hash', 'prompt_blobs', ['prompt_hash'], ['hash'])
+
+    # Move existing prompts into blobs (zlib here; the application reads zlib and zstd)
+    bind = op.get_bind()
+    nodes = sa.table('nodes', sa.column('id', sa.Integer), sa.column('prompt_sent', sa.Text), sa.column('prompt_hash', sa.String))
+    blobs = sa.table('prompt_blobs', sa.column('hash', sa.String), sa.column('encoding', sa.String), sa.column('data', sa.LargeBinary), sa.column('size', sa.Integer))
+    stored = set(bind.execute(sa.select(blobs.c.hash)).scalars())
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(nodes.c.id, nodes.c.prompt_sent)
+            .where(nodes.c.id > last_id, nodes.c.prompt_sent.isnot(None))
+            .order_by(nodes.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        for node_id, prompt in rows:
+            raw = prompt.encode('utf-8')
+            digest = hashlib.sha256(raw).hexdigest()
+            if digest not in stored:
+                bind.execute(blobs.insert().values(hash=digest, encoding='zlib', data=zlib.compress(raw, 9), size=len(raw)))
+                stored.add(digest)
+            bind.execute(nodes.update().where(nodes.c.id == node_id).values(prompt_hash=digest, prompt_sent=None))
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    bind = op.get_bind()
+    nodes = sa.table('nodes', sa.column('id', sa.Integer), sa.column('prompt_sent', sa.Text), sa.column('prompt_hash', sa.String))
+    blobs = sa.table('prompt_blobs', sa.column('hash', sa.String), sa.column('encoding', sa.String), sa.column('data', sa.LargeBinary))
+    for digest, encoding, data in bind.execute(sa.select(blobs.c.hash, blobs.c.encoding, blobs.c.data)).all():
+        if encoding == 'zstd':
+            import zstandard
+            text = zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+        else:
+            text = zlib.decompress(data).decode('utf-8')
+        bind.execute(nodes.update().where(nodes.c.prompt_hash == digest).values(prompt_sent=text))
+
+    with op.batch_alter_table('nodes') as batch:
+        batch.drop_constraint('fk_nodes_prompt_hash', type_='foreignkey')
+        batch.drop_index('ix_nodes_prompt_hash')
+        batch.drop_column('prompt_hash')
+    op.drop_table('prompt_blobs')
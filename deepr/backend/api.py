@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, Body, File, UploadFile
-from fastapi.responses import StreamingResponse, Response
+from fastapi import APIRouter, Depends, HTTPException, Body, File, UploadFile, Request
+from fastapi.responses import Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from typing import List, Optional
+from sqlalchemy import select, update
+from sqlalchemy.orm import selectinload
+from typing import List, Literal, Optional
+from datetime import datetime, timezone
 import json
 import asyncio
-from pydantic import BaseModel
+import time
+from pydantic import BaseModel, Field
 
 from database import get_db
 from models import User, UserSettings, Conversation, NodeType, Node, Attachment
@@ -17,10 +20,21 @@ from engines.dxo_engine import DxOEngine
 from sqlalchemy import desc
 from fastapi import File, UploadFile
 from file_utils import get_file_type, validate_file_size, temp_storage
+from storage import resolve_node_contents, resolve_node_prompts
+from metrics import observe_phase, track_stream
+from sse import sse_response
+from pubsub import get_broker, publish_run
+from memory_profiling import track_run_memory
+from maintenance import schedule_purge
+from images import THUMBNAIL_MIME
+import routing
 import uuid
 
 router = APIRouter()
 
+# Conversations accepted by one bulk delete request
+MAX_BULK_DELETE = 1000
+
 async def serialize_node_with_attachments(db: AsyncSession, node):
     """Helper to serialize node with attachments for streaming"""
     # Refresh node to get attachments relationship
@@ -38,7 +52,7 @@ async def serialize_node_with_attachments(db: AsyncSession, node):
         'content': node.content,
         'model': getattr(node, 'model_name', None),
         'attachment_filenames': getattr(node, 'attachment_filenames', None),
-        'prompt_sent': getattr(node, 'prompt_sent', None),
+        'prompt_sent': getattr(node, 'prompt_text', None) or getattr(node, 'prompt_sent', None),
         'actual_cost': getattr(node, 'actual_cost', 0.0),
         'warnings': json.loads(node.warnings) if hasattr(node, 'warnings') and node.warnings else [],
         'attachments': [
@@ -47,13 +61,31 @@ async def serialize_node_with_attachments(db: AsyncSession, node):
                 'filename': att.filename,
                 'file_type': att.file_type,
                 'file_size': att.file_size,
-                'mime_type': att.mime_type
+                'mime_type': att.mime_type,
+                'page_count': getattr(att, 'page_count', None),
+                'token_estimate': getattr(att, 'token_estimate', None),
+                'width': getattr(att, 'width', None),
+                'height': getattr(att, 'height', None)
             }
             for att in (node.attachments if hasattr(node, 'attachments') and node.attachments else [])
         ]
     }
 
 
+def route_models(request) -> List[str]:
+    """Replace "auto" and failing models of a run request with concrete ones; returns notes for the status stream"""
+    try:
+        request.council_members, notes = routing.assign(request.council_members, request.auto_models, request.routing_target)
+        (request.chairman_model,), chairman_notes = routing.assign([request.chairman_model], request.auto_models, request.routing_target)
+        roles = getattr(request, 'roles', [])
+        role_models, role_notes = routing.assign([role.get('model') for role in roles], request.auto_models, request.routing_target)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if roles:
+        request.roles = [{**role, 'model': model} for role, model in zip(roles, role_models)]
+    return notes + [f"Chairman: {note}" for note in chairman_notes] + role_notes
+
+
 @router.get("/models")
 async def get_models(current_user: User = Depends(get_current_user)):
    return await get_available_models(current_user)   
@@ -74,7 +106,7 @@ async def update_node_cost(
         select(Node)
         .join(Conversation, Node.conversation_id == Conversation.id)
         .where(Node.id == node_id)
-        .where(Conversation.user_id == current_user.id)
+        .where(Conversation.user_id == current_user.id, Conversation.deleted_at.is_(None))
     )
     node = result.scalar_one_or_none()
     
@@ -119,7 +151,8 @@ async def upload_files(
             'mime_type': file.content_type,
             'file_data': file_data,
             'file_size': file_size,
-            'user_id': current_user.id
+            'user_id': current_user.id,
+            'uploaded_at': time.time()
         }
         
         uploaded.append({
@@ -167,7 +200,7 @@ async def download_attachment(
         .join(Node, Attachment.node_id == Node.id)
         .join(Conversation, Node.conversation_id == Conversation.id)
         .where(Attachment.id == att_id_int)
-        .where(Conversation.user_id == current_user.id)
+        .where(Conversation.user_id == current_user.id, Conversation.deleted_at.is_(None))
     )
     attachment = result.scalar_one_or_none()
     
@@ -183,6 +216,26 @@ async def download_attachment(
         }
     )
 
+@router.get("/api/attachments/{attachment_id}/thumbnail")
+async def get_attachment_thumbnail(
+    attachment_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Small preview of an image attachment, made when it was saved"""
+    result = await db.execute(
+        select(Attachment.thumbnail)
+        .join(Node, Attachment.node_id == Node.id)
+        .join(Conversation, Node.conversation_id == Conversation.id)
+        .where(Attachment.id == attachment_id)
+        .where(Conversation.user_id == current_user.id, Conversation.deleted_at.is_(None))
+    )
+    thumbnail = result.scalar_one_or_none()
+    if not thumbnail:
+        raise HTTPException(404, "Thumbnail not found")
+    # Attachments never change, so browsers can keep the preview
+    return Response(content=thumbnail, media_type=THUMBNAIL_MIME, headers={"Cache-Control": "private, max-age=86400"})
+
 class CouncilRequest(BaseModel):
     prompt: str
     council_members: List[str]
@@ -228,21 +281,27 @@ class CouncilRunRequest(BaseModel):
     method: str = "dag" # dag, ensemble, or dxo
     roles: List[dict] = [] # List of {name, model, instructions}
     max_iterations: int = 5 # Default max loops for DxO
+    dxo_schedule: Literal["sequential", "concurrent"] = "sequential" # concurrent: critic reviews alongside experts
+    convergence_threshold: Optional[float] = Field(None, ge=0, le=1) # DxO draft similarity that ends the loop early
     attachment_ids: List[str] = [] # List of uploaded file IDs from /upload endpoint
+    auto_models: List[str] = [] # Equivalent models that "auto" (or failing) members, chairman and roles are routed to
+    routing_target: str = "latency" # latency or cost
+    deadline_seconds: Optional[float] = Field(None, ge=0) # Stop waiting for members after this long (0 = never); defaults to DEEPR_RUN_DEADLINE_SECONDS
 
 @router.post("/council/run")
 async def run_council(
     request: CouncilRunRequest,
+    http_request: Request,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    # Verify API Key
-    result = await db.execute(select(UserSettings).where(UserSettings.user_id == current_user.id))
-    settings = result.scalars().first()
+    # Verify API Key (settings are loaded, and cached, with the authenticated user)
+    settings = current_user.settings
     if not settings or not settings.encrypted_api_key:
         raise HTTPException(status_code=400, detail="No API Key")
-    
+
     api_key = decrypt_key(settings.encrypted_api_key, current_user.id)
+    routing_notes = route_models(request)
     
     # Create Conversation & Root Node immediately
     conversation = Conversation(
@@ -295,6 +354,11 @@ async def run_council(
 
 
     async def event_stream():
+        with track_stream(request.method), track_run_memory(request.method, conversation.id, db):
+            async for event in publish_run(conversation.id, run_events()):
+                yield event
+
+    async def run_events():
         # Setup context
         # We need a new session for the async generator because the dependency one might close?
         # Actually, FastAPI handles dependency lifetime. But running long process...
@@ -302,64 +366,72 @@ async def run_council(
         
         try:
             client = OpenRouterClient(api_key)
-            engine = CouncilEngine(db, current_user, client)
+            engine = CouncilEngine(db, current_user, client, deadline_seconds=request.deadline_seconds)
             
-            yield f"data: {json.dumps({'type': 'start', 'conversation_id': conversation.id})}\n\n"
+            yield {'type': 'start', 'conversation_id': conversation.id}
+            for note in routing_notes:
+                yield {'type': 'status', 'message': f'Routing: {note}'}
             
             # Send root node with attachments
             root_node_data = await serialize_node_with_attachments(db, root_node)
-            yield f"data: {json.dumps({'type': 'node', 'node': root_node_data})}\n\n"
+            yield {'type': 'node', 'node': root_node_data}
             
             if request.method == "ensemble":
                  # 1. Parallel Research (from all models in parallel)
-                yield f"data: {json.dumps({'type': 'status', 'message': 'All models are researching in parallel...'})}\n\n"
+                yield {'type': 'status', 'message': 'All models are researching in parallel...'}
                 # For ensemble, we treat root as the plan/prompt directly
-                research_nodes = await engine.run_ensemble_research(conversation.id, root_node, request.council_members)
+                with observe_phase("ensemble", "research"):
+                    research_nodes = await engine.run_ensemble_research(conversation.id, root_node, request.council_members)
                 for node in research_nodes:
                      node_data = await serialize_node_with_attachments(db, node)
-                     yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+                     yield {'type': 'node', 'node': node_data}
 
                 # 2. Synthesis (Anonymized)
-                yield f"data: {json.dumps({'type': 'status', 'message': 'Synthesizing anonymized responses...'})}\n\n"
-                synthesis_node = await engine.run_ensemble_synthesis(conversation.id, root_node, research_nodes, request.chairman_model)
+                yield {'type': 'status', 'message': 'Synthesizing anonymized responses...'}
+                with observe_phase("ensemble", "synthesis"):
+                    synthesis_node = await engine.run_ensemble_synthesis(conversation.id, root_node, research_nodes, request.chairman_model)
                 node_data = await serialize_node_with_attachments(db, synthesis_node)
-                yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+                yield {'type': 'node', 'node': node_data}
 
             elif request.method == "dxo":
                 dxo_engine = DxOEngine(db, current_user, client)
-                yield f"data: {json.dumps({'type': 'status', 'message': 'Initializing DxO Virtual Panel...'})}\n\n"
-                async for event in dxo_engine.run_dxo_pipeline(conversation.id, root_node, request.roles, max_iterations=request.max_iterations):
-                    yield f"data: {event}\n\n"
+                yield {'type': 'status', 'message': 'Initializing DxO Virtual Panel...'}
+                async for event in dxo_engine.run_dxo_pipeline(conversation.id, root_node, request.roles, max_iterations=request.max_iterations, schedule=request.dxo_schedule, convergence_threshold=request.convergence_threshold):
+                    yield event
 
             else:
                 # Default DAG flow
                 # 1. Coordinator
-                yield f"data: {json.dumps({'type': 'status', 'message': 'Coordinator is creating a plan...'})}\n\n"
-                plan_node = await engine.run_coordinator(conversation.id, root_node, request.chairman_model)
+                yield {'type': 'status', 'message': 'Coordinator is creating a plan...'}
+                with observe_phase("dag", "coordinator"):
+                    plan_node = await engine.run_coordinator(conversation.id, root_node, request.chairman_model)
                 node_data = await serialize_node_with_attachments(db, plan_node)
-                yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+                yield {'type': 'node', 'node': node_data}
 
                 # 2. Researchers
-                yield f"data: {json.dumps({'type': 'status', 'message': 'Council members are researching...'})}\n\n"
-                research_nodes = await engine.run_researchers(conversation.id, plan_node, request.council_members)
+                yield {'type': 'status', 'message': 'Council members are researching...'}
+                with observe_phase("dag", "research"):
+                    research_nodes = await engine.run_researchers(conversation.id, plan_node, request.council_members)
                 for node in research_nodes:
                     node_data = await serialize_node_with_attachments(db, node)
-                    yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+                    yield {'type': 'node', 'node': node_data}
 
                 # 3. Critics
-                yield f"data: {json.dumps({'type': 'status', 'message': 'Critics are reviewing findings...'})}\n\n"
-                critique_nodes = await engine.run_critics(conversation.id, research_nodes, request.council_members)
+                yield {'type': 'status', 'message': 'Critics are reviewing findings...'}
+                with observe_phase("dag", "critique"):
+                    critique_nodes = await engine.run_critics(conversation.id, research_nodes, request.council_members)
                 for node in critique_nodes:
                     node_data = await serialize_node_with_attachments(db, node)
-                    yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+                    yield {'type': 'node', 'node': node_data}
 
                 # 4. Synthesis
-                yield f"data: {json.dumps({'type': 'status', 'message': 'Chairman is synthesizing the final answer...'})}\n\n"
-                synthesis_node = await engine.run_synthesis(conversation.id, plan_node, research_nodes, critique_nodes, request.chairman_model)
+                yield {'type': 'status', 'message': 'Chairman is synthesizing the final answer...'}
+                with observe_phase("dag", "synthesis"):
+                    synthesis_node = await engine.run_synthesis(conversation.id, plan_node, research_nodes, critique_nodes, request.chairman_model)
                 node_data = await serialize_node_with_attachments(db, synthesis_node)
-                yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+                yield {'type': 'node', 'node': node_data}
             
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            yield {'type': 'done'}
         except Exception as e:
             # Send error to frontend before closing stream
             import traceback
@@ -367,10 +439,10 @@ async def run_council(
             error_msg = str(e)
             error_trace = traceback.format_exc()
             logging.error(f"Error in council stream: {error_trace}")
-            yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
+            yield {'type': 'error', 'message': error_msg}
             # Don't re-raise - let the stream close gracefully
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    return sse_response(event_stream(), http_request)
 
 @router.get("/history")
 async def get_history(
@@ -379,7 +451,7 @@ async def get_history(
 ):
     result = await db.execute(
         select(Conversation)
-        .where(Conversation.user_id == current_user.id)
+        .where(Conversation.user_id == current_user.id, Conversation.deleted_at.is_(None))
         .order_by(desc(Conversation.created_at))
     )
     conversations = result.scalars().all()
@@ -395,27 +467,210 @@ async def get_conversation(
     result = await db.execute(
         select(Conversation).where(
             Conversation.id == conversation_id,
-            Conversation.user_id == current_user.id
+            Conversation.user_id == current_user.id,
+            Conversation.deleted_at.is_(None)
         )
     )
     conversation = result.scalars().first()
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
         
-    # Fetch nodes
+    # Fetch nodes with their attachment metadata in one extra query (file data stays unloaded)
     result = await db.execute(
-        select(Node).where(Node.conversation_id == conversation_id)
+        select(Node)
+        .where(Node.conversation_id == conversation_id)
+        .options(selectinload(Node.attachments).load_only(
+            Attachment.id, Attachment.node_id, Attachment.filename,
+            Attachment.file_type, Attachment.file_size, Attachment.mime_type,
+            Attachment.page_count, Attachment.token_estimate, Attachment.width, Attachment.height
+        ))
     )
     nodes = result.scalars().all()
     
     # Serialize nodes with attachments
+    contents = await resolve_node_contents(db, nodes)
+    prompts = await resolve_node_prompts(db, nodes)
     nodes_data = []
     for node in nodes:
-        node_data = await serialize_node_with_attachments(db, node)
+        node_data = await serialize_node_with_attachments(None, node)
+        node_data['content'] = contents[node.id]
+        node_data['prompt_sent'] = prompts[node.id]
         nodes_data.append(node_data)
     
     return {"conversation": conversation, "nodes": nodes_data}
 
+class DeleteConversationsRequest(BaseModel):
+    conversation_ids: List[int] = Field(..., min_length=1, max_length=MAX_BULK_DELETE)
+
+async def mark_conversations_deleted(db: AsyncSession, user_id: int, conversation_ids: List[int]) -> List[int]:
+    """Hide the user's conversations at once; their rows are purged in the background"""
+    result = await db.execute(
+        update(Conversation)
+        .where(
+            Conversation.id.in_(conversation_ids),
+            Conversation.user_id == user_id,
+            Conversation.deleted_at.is_(None)
+        )
+        .values(deleted_at=datetime.now(timezone.utc))
+        .returning(Conversation.id)
+    )
+    deleted = result.scalars().all()
+    await db.commit()
+    if deleted:
+        schedule_purge(db.bind)
+    return deleted
+
+@router.delete("/history/{conversation_id}")
+async def delete_conversation(
+    conversation_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if not await mark_conversations_deleted(db, current_user.id, [conversation_id]):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return {"deleted": [conversation_id]}
+
+@router.post("/history/delete")
+async def delete_conversations(
+    request: DeleteConversationsRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Bulk delete; ids that are unknown, not the user's or already deleted are skipped"""
+    deleted = await mark_conversations_deleted(db, current_user.id, request.conversation_ids)
+    return {"deleted": sorted(deleted)}
+
+@router.get("/runs/{conversation_id}/events")
+async def subscribe_run_events(
+    conversation_id: int,
+    http_request: Request,
+    last_event_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Follow a run started by any request on any worker.
+    Resumes after `last_event_id` (or the Last-Event-ID header); when no run is
+    known for the conversation a single `idle` event is sent.
+    """
+    result = await db.execute(
+        select(Conversation.id).where(
+            Conversation.id == conversation_id,
+            Conversation.user_id == current_user.id,
+            Conversation.deleted_at.is_(None)
+        )
+    )
+    if result.scalar() is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    if last_event_id is None:
+        header = http_request.headers.get("last-event-id", "")
+        last_event_id = int(header) if header.isdigit() else 0
+
+    broker = get_broker()
+
+    async def events():
+        if not broker.has_run(conversation_id):
+            yield {'type': 'idle', 'conversation_id': conversation_id}
+            return
+        with track_stream("subscription"):
+            async for event in broker.subscribe(conversation_id, last_event_id):
+                yield event
+
+    return sse_response(events(), http_request)
+
+def _epoch(dt) -> Optional[float]:
+    """Seconds since the epoch; naive datetimes (SQLite) are treated as UTC"""
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+@router.get("/history/{conversation_id}/timeline")
+async def get_conversation_timeline(
+    conversation_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Gantt-style breakdown of a run. Offsets are seconds from the start of the
+    conversation. For each node:
+    - queue_seconds: time from the parent being persisted to the model request
+    - model_seconds: time from the request to the complete response
+    - persist_wait_seconds: time from the response to the node being persisted.
+      For parallel phases this includes waiting on the slowest sibling.
+    """
+    result = await db.execute(
+        select(Conversation).where(
+            Conversation.id == conversation_id,
+            Conversation.user_id == current_user.id,
+            Conversation.deleted_at.is_(None)
+        )
+    )
+    conversation = result.scalars().first()
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    result = await db.execute(
+        select(Node).where(Node.conversation_id == conversation_id).order_by(Node.id)
+    )
+    nodes = result.scalars().all()
+
+    run_start = min(
+        [t for t in [_epoch(conversation.created_at)] + [_epoch(n.request_started_at) or _epoch(n.created_at) for n in nodes] if t is not None],
+        default=None
+    )
+
+    def offset(dt):
+        ts = _epoch(dt)
+        return round(ts - run_start, 3) if ts is not None and run_start is not None else None
+
+    def span(start, end):
+        a, b = _epoch(start), _epoch(end)
+        return round(b - a, 3) if a is not None and b is not None else None
+
+    persisted = {n.id: n.persisted_at or n.created_at for n in nodes}
+    rows = []
+    phases = {}
+    for node in nodes:
+        end = node.persisted_at or node.created_at
+        row = {
+            'id': node.id,
+            'parent_id': node.parent_id,
+            'type': node.type,
+            'model': node.model_name,
+            'start_offset': offset(node.request_started_at or end),
+            'first_token_offset': offset(node.first_token_at),
+            'completed_offset': offset(node.completed_at),
+            'end_offset': offset(end),
+            'queue_seconds': span(persisted.get(node.parent_id), node.request_started_at),
+            'ttft_seconds': span(node.request_started_at, node.first_token_at),
+            'model_seconds': span(node.request_started_at, node.completed_at),
+            'persist_wait_seconds': span(node.completed_at, node.persisted_at),
+            'retry_count': node.retry_count
+        }
+        rows.append(row)
+
+        phase = phases.setdefault(node.type, {'type': node.type, 'start_offset': row['start_offset'], 'end_offset': row['end_offset'], 'nodes': 0})
+        phase['nodes'] += 1
+        if row['start_offset'] is not None and (phase['start_offset'] is None or row['start_offset'] < phase['start_offset']):
+            phase['start_offset'] = row['start_offset']
+        if row['end_offset'] is not None and (phase['end_offset'] is None or row['end_offset'] > phase['end_offset']):
+            phase['end_offset'] = row['end_offset']
+
+    for phase in phases.values():
+        phase['duration'] = round(phase['end_offset'] - phase['start_offset'], 3) if phase['start_offset'] is not None and phase['end_offset'] is not None else None
+
+    ends = [r['end_offset'] for r in rows if r['end_offset'] is not None]
+    return {
+        'conversation_id': conversation_id,
+        'started_at': datetime.fromtimestamp(run_start, tz=timezone.utc).isoformat() if run_start is not None else None,
+        'total_seconds': max(ends) if ends else None,
+        'phases': sorted(phases.values(), key=lambda p: (p['start_offset'] is None, p['start_offset'])),
+        'nodes': rows
+    }
+
 @router.get("/conversations/{conversation_id}/cost")
 async def get_conversation_cost(
     conversation_id: int,
@@ -427,7 +682,8 @@ async def get_conversation_cost(
     result = await db.execute(
         select(Conversation).where(
             Conversation.id == conversation_id,
-            Conversation.user_id == current_user.id
+            Conversation.user_id == current_user.id,
+            Conversation.deleted_at.is_(None)
         )
     )
     conversation = result.scalars().first()
@@ -453,20 +709,24 @@ class SuperChatRequest(BaseModel):
     council_members: List[str]
     chairman_model: str
     attachment_ids: List[str] = []
+    auto_models: List[str] = []
+    routing_target: str = "latency"
+    deadline_seconds: Optional[float] = Field(None, ge=0)
 
 @router.post("/superchat/chat")
 async def superchat_chat(
     request: SuperChatRequest,
+    http_request: Request,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    # Verify API Key
-    result = await db.execute(select(UserSettings).where(UserSettings.user_id == current_user.id))
-    settings = result.scalars().first()
+    # Verify API Key (settings are loaded, and cached, with the authenticated user)
+    settings = current_user.settings
     if not settings or not settings.encrypted_api_key:
         raise HTTPException(status_code=400, detail="No API Key")
 
     api_key = decrypt_key(settings.encrypted_api_key, current_user.id)
+    routing_notes = route_models(request)
 
     # Attachments will be processed after node creation in SuperChat to match Council pattern
     attachment_ids = request.attachment_ids or []
@@ -480,7 +740,8 @@ async def superchat_chat(
         result = await db.execute(
             select(Conversation).where(
                 Conversation.id == conversation_id,
-                Conversation.user_id == current_user.id
+                Conversation.user_id == current_user.id,
+                Conversation.deleted_at.is_(None)
             )
         )
         conversation = result.scalars().first()
@@ -553,15 +814,22 @@ async def superchat_chat(
     await db.refresh(user_node) # Get latest state with attachments
 
     async def event_stream():
+        with track_stream("superchat"), track_run_memory("superchat", conversation_id, db):
+            async for event in publish_run(conversation_id, run_events()):
+                yield event
+
+    async def run_events():
         try:
             client = OpenRouterClient(api_key)
-            engine = CouncilEngine(db, current_user, client)
+            engine = CouncilEngine(db, current_user, client, deadline_seconds=request.deadline_seconds)
 
-            yield f"data: {json.dumps({'type': 'start', 'conversation_id': conversation_id})}\n\n"
+            yield {'type': 'start', 'conversation_id': conversation_id}
+            for note in routing_notes:
+                yield {'type': 'status', 'message': f'Routing: {note}'}
 
             # Send User Node to client immediately
             node_data = await serialize_node_with_attachments(db, user_node)
-            yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+            yield {'type': 'node', 'node': node_data}
 
             # Construct Ensemble Prompt
             ensemble_prompt = request.prompt
@@ -589,19 +857,21 @@ async def superchat_chat(
             mock_root = MockNode(user_node.id, ensemble_prompt, user_node.parent_id, conversation_id)
 
             # 1. Research
-            yield f"data: {json.dumps({'type': 'status', 'message': 'Council members are researching...'})}\n\n"
-            research_nodes = await engine.run_ensemble_research(conversation_id, mock_root, request.council_members)
+            yield {'type': 'status', 'message': 'Council members are researching...'}
+            with observe_phase("superchat", "research"):
+                research_nodes = await engine.run_ensemble_research(conversation_id, mock_root, request.council_members)
             for node in research_nodes:
                  node_data = await serialize_node_with_attachments(db, node)
-                 yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
+                 yield {'type': 'node', 'node': node_data}
 
             # 2. Synthesis
-            yield f"data: {json.dumps({'type': 'status', 'message': 'Chairman is synthesizing...'})}\n\n"
+            yield {'type': 'status', 'message': 'Chairman is synthesizing...'}
             # Note: run_ensemble_synthesis uses root_node.content for context.
-            synthesis_node = await engine.run_ensemble_synthesis(conversation_id, mock_root, research_nodes, request.chairman_model)
+            with observe_phase("superchat", "synthesis"):
+                synthesis_node = await engine.run_ensemble_synthesis(conversation_id, mock_root, research_nodes, request.chairman_model)
             node_data = await serialize_node_with_attachments(db, synthesis_node)
-            yield f"data: {json.dumps({'type': 'node', 'node': node_data})}\n\n"
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            yield {'type': 'node', 'node': node_data}
+            yield {'type': 'done'}
 
         except Exception as e:
             import traceback
@@ -609,9 +879,9 @@ async def superchat_chat(
             error_msg = str(e)
             error_trace = traceback.format_exc()
             logging.error(f"Error in superchat stream: {error_trace}")
-            yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
+            yield {'type': 'error', 'message': error_msg}
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    return sse_response(event_stream(), http_request)
 
 # ============================================================================
 # FILE ATTACHMENT ENDPOINTS
@@ -656,7 +926,8 @@ async def upload_files(
             'mime_type': file.content_type,
             'file_data': file_data,
             'file_size': file_size,
-            'user_id': current_user.id
+            'user_id': current_user.id,
+            'uploaded_at': time.time()
         }
         
         uploaded.append({
@@ -695,7 +966,8 @@ async def get_attachment(
     result = await db.execute(
         select(Conversation).where(
             Conversation.id == node.conversation_id,
-            Conversation.user_id == current_user.id
+            Conversation.user_id == current_user.id,
+            Conversation.deleted_at.is_(None)
         )
     )
     if not result.scalars().first():
@@ -8,11 +8,21 @@ from sqlalchemy import select
 from database import get_db
 from models import User, UserSettings
 from pydantic import BaseModel
+from typing import Dict, Tuple
+import hmac
 import os
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY", "secret")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# How long an authenticated user and their settings are reused across requests (0 disables)
+AUTH_CACHE_SECONDS = float(os.getenv("DEEPR_AUTH_CACHE_SECONDS", "30"))
+AUTH_CACHE_SIZE = 10000
+# Comma-separated emails allowed to use the /admin endpoints
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
+# Bearer token a Prometheus scraper can present for GET /metrics instead of an admin login
+METRICS_TOKEN = os.getenv("DEEPR_METRICS_TOKEN", "")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -59,11 +69,47 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
     except JWTError:
         raise credentials_exception
     
-    result = await db.execute(select(User).options(selectinload(User.settings)).where(User.email == token_data.email))
+    cached = _user_cache.get(token_data.email)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    # populate_existing: a miss after invalidate_user must see the new settings even if the session already holds the user
+    result = await db.execute(
+        select(User).options(selectinload(User.settings)).where(User.email == token_data.email)
+        .execution_options(populate_existing=True)
+    )
     user = result.scalars().first()
     if user is None:
         raise credentials_exception
-    return user
+    if AUTH_CACHE_SECONDS <= 0:
+        return user
+
+    snapshot = _detached_copy(user)
+    if len(_user_cache) >= AUTH_CACHE_SIZE:
+        _user_cache.pop(next(iter(_user_cache)))
+    _user_cache[token_data.email] = (time.monotonic() + AUTH_CACHE_SECONDS, snapshot)
+    return snapshot
+
+# JWT subject -> (expires_at, detached user with settings loaded)
+_user_cache: Dict[str, Tuple[float, User]] = {}
+
+def _detached_copy(user: User) -> User:
+    """
+    Session-free copy of a user and their settings, safe to share between concurrent requests.
+    Endpoints only read id, email and settings (API key, retention) from the current user.
+    """
+    copy = User(id=user.id, email=user.email, google_id=user.google_id, created_at=user.created_at)
+    if user.settings is not None:
+        copy.settings = UserSettings(
+            id=user.settings.id, user_id=user.id,
+            encrypted_api_key=user.settings.encrypted_api_key,
+            retention_days=user.settings.retention_days,
+        )
+    return copy
+
+def invalidate_user(email: str):
+    """Drop a cached user, e.g. after their settings changed"""
+    _user_cache.pop(email, None)
 
 @router.post("/auth/dev-login", response_model=Token)
 async def dev_login(request: LoginRequest, db: AsyncSession = Depends(get_db)):
@@ -90,3 +136,14 @@ async def dev_login(request: LoginRequest, db: AsyncSession = Depends(get_db)):
 @router.get("/auth/me", response_model=UserResponse)
 async def read_users_me(current_user: User = Depends(get_current_user)):
     return {"id": current_user.id, "email": current_user.email}
+
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    if current_user.email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+async def get_metrics_reader(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    # Metrics show per-model usage, cost and errors of every user: admins or the scraper token only
+    if METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return None
+    return await get_admin_user(await get_current_user(token, db))
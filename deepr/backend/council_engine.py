@@ -1,20 +1,34 @@
 import asyncio
+import os
+import time
+from datetime import datetime, timezone
 from typing import List, Dict, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from models import Conversation, Node, NodeType, User, UserSettings
 from openrouter_service import OpenRouterClient, get_unsupported_attachments
+from prompt_cache import build_messages, render
+from storage import store_prompt
 from encryption import decrypt_key
 from sqlalchemy import select
 import json
 import logging
+import metrics
 
 logger = logging.getLogger(__name__)
 
+# Default run deadline in seconds (0 = wait for every member); runs can set their own
+RUN_DEADLINE_SECONDS = float(os.getenv("DEEPR_RUN_DEADLINE_SECONDS", "0"))
+
 class CouncilEngine:
-    def __init__(self, db: AsyncSession, user: User, openrouter_client: OpenRouterClient):
+    def __init__(self, db: AsyncSession, user: User, openrouter_client: OpenRouterClient, deadline_seconds: Optional[float] = None):
         self.db = db
         self.user = user
         self.client = openrouter_client
+        # Member fan-outs stop waiting at this time.monotonic() value; synthesis always runs
+        self.deadline_seconds = RUN_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+        self.deadline = time.monotonic() + self.deadline_seconds if self.deadline_seconds > 0 else None
+        # "model (phase)" of member calls cancelled at the deadline, reported on the synthesis node
+        self.timed_out: List[str] = []
 
     async def create_node(
         self, 
@@ -26,7 +40,8 @@ class CouncilEngine:
         attachment_filenames: str = None, 
         prompt_sent: str = None,
         actual_cost: float = None,
-        warnings: str = None
+        warnings: str = None,
+        timing: Optional[Dict] = None
     ):
         node = Node(
             conversation_id=conversation_id,
@@ -35,15 +50,61 @@ class CouncilEngine:
             content=content,
             model_name=model_name,
             attachment_filenames=attachment_filenames,
-            prompt_sent=prompt_sent,
+            prompt_hash=await store_prompt(self.db, prompt_sent),
             actual_cost=actual_cost,
-            warnings=warnings
+            warnings=warnings,
+            request_started_at=timing.get('request_started_at') if timing else None,
+            first_token_at=timing.get('first_token_at') if timing else None,
+            completed_at=timing.get('completed_at') if timing else None,
+            retry_count=timing.get('retry_count') if timing else None,
+            persisted_at=datetime.now(timezone.utc)
         )
         self.db.add(node)
         await self.db.commit()
         await self.db.refresh(node)
+        node.prompt_text = prompt_sent
         return node
 
+    async def _gather_members(self, phase: str, models: List[str], calls: List, require_one: bool = True) -> List:
+        """
+        Results of the member calls, in member order. At the run deadline the calls still
+        running are cancelled and left out; with require_one, the first answer is awaited
+        even past the deadline, since synthesis needs something to work with.
+        """
+        if self.deadline is None:
+            return list(await asyncio.gather(*calls))
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0 and not require_one:
+            for call in calls:
+                call.close()
+            self._record_timeouts(phase, models)
+            return []
+
+        tasks = [asyncio.ensure_future(call) for call in calls]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=max(remaining, 0))
+            if not done and require_one:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Also reached when the run itself is cancelled (client gone)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            self._record_timeouts(phase, [model for model, task in zip(models, tasks) if task in pending])
+        return [task.result() for task in tasks if task in done]
+
+    def _record_timeouts(self, phase: str, models: List[str]):
+        for model in models:
+            metrics.MEMBER_TIMEOUTS.inc(model=model, phase=phase)
+            self.timed_out.append(f"{model} ({phase})")
+
+    def _timeout_warnings(self) -> List[str]:
+        if not self.timed_out:
+            return []
+        return [f"No response before the {self.deadline_seconds:g}s run deadline: {', '.join(self.timed_out)}"]
+
     async def get_attachments_for_node(self, node_id: int):
         """Get attachments associated with a node"""
         from models import Attachment
@@ -77,6 +138,15 @@ class CouncilEngine:
         
         return attachments
 
+    async def _root_request(self, node: Node) -> str:
+        """
+        The user's request that started the run, i.e. the content of the root node above `node`.
+        The run's nodes are already in the session, so this normally issues no queries.
+        """
+        while node.parent_id:
+            node = await self.db.get(Node, node.parent_id)
+        return node.content
+
 
     async def run_coordinator(self, conversation_id: int, root_node: Node, chairman_model: str) -> Node:
         """
@@ -89,17 +159,16 @@ class CouncilEngine:
         # Check for warnings (non-vision model with images, etc.)
         warning_list = get_unsupported_attachments(chairman_model, attachments, self.user.id)
         
-        prompt = f"""
-        You are the Coordinator of a research council. 
-        The user has asked: "{root_node.content}"
-        
-        Break this down into a clear research plan with specific questions or areas to investigate.
-        """
+        messages = build_messages(root_node.content, """
+        You are the Coordinator of a research council.
+        Break the user's request down into a clear research plan with specific questions or areas to investigate.
+        """.strip())
+        prompt = render(messages)
         
         # Make API call with cost tracking
         response, cost_info = await self.client.chat_completion_details(
             model=chairman_model,
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             attachments=attachments
         )
         
@@ -113,9 +182,10 @@ class CouncilEngine:
             response_content, 
             model_name=chairman_model,
             attachment_filenames=attachment_filenames,
-            prompt_sent=prompt.strip(),
+            prompt_sent=prompt,
             actual_cost=cost_info['actual_cost'],
-            warnings=json.dumps(warning_list) if warning_list else None
+            warnings=json.dumps(warning_list) if warning_list else None,
+            timing=cost_info
         )
 
     async def run_researchers(self, conversation_id: int, plan_node: Node, council_models: List[str]) -> List[Node]:
@@ -125,20 +195,21 @@ class CouncilEngine:
         # Get attachments using chain from plan_node
         attachments = await self.get_attachments_chain(plan_node, max_depth=3)
         attachment_filenames = ",".join([att.filename for att in attachments]) if attachments else None
+        request = await self._root_request(plan_node)
         
-        prompt = f"""
+        context = f"Research Plan:\n{plan_node.content}"
+        instructions = """
         You are a Council Member researcher.
-        Here is the research plan:
-        "{plan_node.content}"
-        
-        Please conduct your research and provide your findings and insights.
-        """
+        Please conduct your research following the plan and provide your findings and insights.
+        """.strip()
+        prompt = render(build_messages(request, instructions, context))
         
         tasks = []
         for model in council_models:
-            tasks.append(self._fetch_research_with_attachments(model, prompt, attachments))
+            # Every call gets its own messages: attachments are added to them in place
+            tasks.append(self._fetch_research_with_attachments(model, build_messages(request, instructions, context), attachments))
         
-        results = await asyncio.gather(*tasks)
+        results = await self._gather_members("research", council_models, tasks)
         
         nodes = []
         for model, content, cost_info in results:
@@ -152,9 +223,10 @@ class CouncilEngine:
                 content, 
                 model_name=model,
                 attachment_filenames=attachment_filenames,
-                prompt_sent=prompt.strip(),
+                prompt_sent=prompt,
                 actual_cost=cost_info['actual_cost'],
-                warnings=json.dumps(warning_list) if warning_list else None
+                warnings=json.dumps(warning_list) if warning_list else None,
+                timing=cost_info
             )
             nodes.append(node)
             
@@ -170,11 +242,11 @@ class CouncilEngine:
         except Exception as e:
             return model, f"Error conducting research: {str(e)}"
 
-    async def _fetch_research_with_attachments(self, model: str, prompt: str, attachments):
+    async def _fetch_research_with_attachments(self, model: str, messages: List[Dict], attachments):
         try:
             response, cost_info = await self.client.chat_completion_details(
                 model=model,
-                messages=[{"role": "user", "content": prompt}],
+                messages=messages,
                 attachments=attachments
             )
             return model, response.choices[0].message.content, cost_info
@@ -188,24 +260,24 @@ class CouncilEngine:
         # Get attachments using chain from first research node
         attachments = await self.get_attachments_chain(research_nodes[0], max_depth=3) if research_nodes else []
         attachment_filenames = ",".join([att.filename for att in attachments]) if attachments else None
+        request = await self._root_request(research_nodes[0]) if research_nodes else ""
         
         # Prepare anonymized context
         context = "Here are the findings from other researchers:\n\n"
         for i, node in enumerate(research_nodes):
             context += f"--- Findings from Agent {i+1} ---\n{node.content}\n\n"
             
-        prompt = f"""
-        You are a Critic. Review the following research findings from other agents.
+        instructions = """
+        You are a Critic. Review the research findings from other agents above.
         Identify gaps, conflicts, biases, or areas that need more depth.
-        
-        {context}
-        """
+        """.strip()
+        prompt = render(build_messages(request, instructions, context))
         
         tasks = []
         for model in council_models:
-            tasks.append(self._fetch_research_with_attachments(model, prompt, attachments))
+            tasks.append(self._fetch_research_with_attachments(model, build_messages(request, instructions, context), attachments))
              
-        results = await asyncio.gather(*tasks)
+        results = await self._gather_members("critique", council_models, tasks, require_one=False)
         
         nodes = []
         for model, content, cost_info in results:
@@ -220,9 +292,10 @@ class CouncilEngine:
                 content, 
                 model_name=model,
                 attachment_filenames=attachment_filenames,
-                prompt_sent=prompt.strip(),
+                prompt_sent=prompt,
                 actual_cost=cost_info['actual_cost'],
-                warnings=json.dumps(warning_list) if warning_list else None
+                warnings=json.dumps(warning_list) if warning_list else None,
+                timing=cost_info
             )
             nodes.append(node)
             
@@ -237,8 +310,9 @@ class CouncilEngine:
         attachment_filenames = ",".join([att.filename for att in attachments]) if attachments else None
         
         # Check for warnings
-        warning_list = get_unsupported_attachments(chairman_model, attachments, self.user.id)
+        warning_list = get_unsupported_attachments(chairman_model, attachments, self.user.id) + self._timeout_warnings()
         
+        request = await self._root_request(plan_node)
         context = f"Original Plan:\n{plan_node.content}\n\n"
         
         context += "Research Findings:\n"
@@ -249,17 +323,18 @@ class CouncilEngine:
         for i, node in enumerate(critique_nodes):
             context += f"--- Critic {i+1} ---\n{node.content}\n\n"
             
-        prompt = f"""
+        messages = build_messages(request, """
         You are the Chairman. Synthesize the final answer based on the research and critiques provided.
         
         Your goal is to provide a comprehensive, reasoned judgment.
         
         IMPORTANT: When you use an idea from a specific Agent or Critic, please reference them in parentheses, e.g., "(Idea by Agent 1)".
-        """
+        """.strip(), context)
+        prompt = render(messages)
         
         response, cost_info = await self.client.chat_completion_details(
             model=chairman_model,
-            messages=[{"role": "user", "content": context}, {"role": "user", "content": prompt}],
+            messages=messages,
             attachments=attachments
         )
         content = response.choices[0].message.content
@@ -272,9 +347,10 @@ class CouncilEngine:
             content, 
             model_name=chairman_model,
             attachment_filenames=attachment_filenames,
-            prompt_sent=f"{context}\n\n{prompt}".strip(),
+            prompt_sent=prompt,
             actual_cost=cost_info['actual_cost'],
-            warnings=json.dumps(warning_list) if warning_list else None
+            warnings=json.dumps(warning_list) if warning_list else None,
+            timing=cost_info
         )
 
     async def run_ensemble_research(self, conversation_id: int, root_node: Node, council_models: List[str]) -> List[Node]:
@@ -286,18 +362,17 @@ class CouncilEngine:
         attachments = await self.get_attachments_chain(root_node, max_depth=3)
         attachment_filenames = ",".join([att.filename for att in attachments]) if attachments else None
         
-        prompt = f"""
+        instructions = """
         You are a Model in an ensemble.
-        The user has asked: "{root_node.content}"
-
-        Please answer this question comprehensively from your perspective.
-        """
+        Please answer the user's request comprehensively from your perspective.
+        """.strip()
+        prompt = render(build_messages(root_node.content, instructions))
 
         tasks = []
         for model in council_models:
-            tasks.append(self._fetch_research_with_attachments(model, prompt, attachments))
+            tasks.append(self._fetch_research_with_attachments(model, build_messages(root_node.content, instructions), attachments))
 
-        results = await asyncio.gather(*tasks)
+        results = await self._gather_members("research", council_models, tasks)
 
         nodes = []
         for model, content, cost_info in results:
@@ -311,9 +386,10 @@ class CouncilEngine:
                 content, 
                 model_name=model,
                 attachment_filenames=attachment_filenames,
-                prompt_sent=prompt.strip(),
+                prompt_sent=prompt,
                 actual_cost=cost_info['actual_cost'],
-                warnings=json.dumps(warning_list) if warning_list else None
+                warnings=json.dumps(warning_list) if warning_list else None,
+                timing=cost_info
             )
             nodes.append(node)
 
@@ -328,25 +404,24 @@ class CouncilEngine:
         attachment_filenames = ",".join([att.filename for att in attachments]) if attachments else None
         
         # Check for warnings
-        warning_list = get_unsupported_attachments(chairman_model, attachments, self.user.id)
-        
-        context = f"Original Question:\n{root_node.content}\n\n"
+        warning_list = get_unsupported_attachments(chairman_model, attachments, self.user.id) + self._timeout_warnings()
         
-        context += "Responses from different models:\n"
+        context = "Responses from different models:\n"
         for i, node in enumerate(research_nodes):
             context += f"--- Model {i+1} ({node.model_name}) ---\n{node.content}\n\n"
             
-        prompt = f"""
+        messages = build_messages(root_node.content, """
         You are the Synthesizer. Combine the insights from all models into a comprehensive final answer.
         
         Your goal is to provide the best possible answer by synthesizing all perspectives.
         
         IMPORTANT: When you use an idea from a specific model, please reference them, e.g., "(Model 1: GPT-4)".
-        """
+        """.strip(), context)
+        prompt = render(messages)
         
         response, cost_info = await self.client.chat_completion_details(
             model=chairman_model,
-            messages=[{"role": "user", "content": context}, {"role": "user", "content": prompt}],
+            messages=messages,
             attachments=attachments
         )
         content = response.choices[0].message.content
@@ -358,9 +433,10 @@ class CouncilEngine:
             content, 
             model_name=chairman_model,
             attachment_filenames=attachment_filenames,
-            prompt_sent=f"{context}\n\n{prompt}".strip(),
+            prompt_sent=prompt,
             actual_cost=cost_info['actual_cost'],
-            warnings=json.dumps(warning_list) if warning_list else None
+            warnings=json.dumps(warning_list) if warning_list else None,
+            timing=cost_info
         )
 
 # Global helper to reconstruct the engine context (ugly hack for streaming via global refs if needed, but better to pass dependencies)
@@ -1,6 +1,9 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.dialects import postgresql, sqlite
 import os
+import query_stats
+import tracing
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,6 +18,8 @@ if not DATABASE_URL:
     DATABASE_URL = f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{db}"
 
 engine = create_async_engine(DATABASE_URL, echo=True)
+tracing.instrument_engine(engine)
+query_stats.instrument_engine(engine)
 
 AsyncSessionLocal = sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
@@ -25,3 +30,10 @@ Base = declarative_base()
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+# INSERT constructs with ON CONFLICT support, by dialect name
+_CONFLICT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+def conflict_insert(db: AsyncSession):
+    """The dialect's `insert` (with on_conflict_do_nothing/do_update) for the session's database, or None"""
+    return _CONFLICT_INSERTS.get(db.bind.dialect.name)
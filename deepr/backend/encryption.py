@@ -1,9 +1,18 @@
 from cryptography.fernet import Fernet
+from functools import lru_cache
+from typing import Dict, Tuple
 import base64
 import hashlib
 import os
+import time
 
 CODEBASE_SECRET = os.getenv("CODEBASE_SECRET", "default-secret")
+# How long decrypted API keys are kept in memory (0 disables the cache)
+KEY_CACHE_SECONDS = float(os.getenv("DEEPR_KEY_CACHE_SECONDS", "300"))
+KEY_CACHE_SIZE = 4096
+
+# (user_id, ciphertext) -> (expires_at, plaintext); a new ciphertext never hits a stale entry
+_decrypted_keys: Dict[Tuple[int, str], Tuple[float, str]] = {}
 
 def _get_fernet_key(user_id: int) -> bytes:
     """Derives a Fernet key from the codebase secret and user ID."""
@@ -13,12 +22,28 @@ def _get_fernet_key(user_id: int) -> bytes:
     hasher.update(key_material)
     return base64.urlsafe_b64encode(hasher.digest())
 
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _get_fernet(user_id: int) -> Fernet:
+    return Fernet(_get_fernet_key(user_id))
+
 def encrypt_key(api_key: str, user_id: int) -> str:
-    key = _get_fernet_key(user_id)
-    f = Fernet(key)
-    return f.encrypt(api_key.encode()).decode()
+    return _get_fernet(user_id).encrypt(api_key.encode()).decode()
 
 def decrypt_key(encrypted_key: str, user_id: int) -> str:
-    key = _get_fernet_key(user_id)
-    f = Fernet(key)
-    return f.decrypt(encrypted_key.encode()).decode()
+    cache_key = (user_id, encrypted_key)
+    cached = _decrypted_keys.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    api_key = _get_fernet(user_id).decrypt(encrypted_key.encode()).decode()
+    if KEY_CACHE_SECONDS > 0:
+        if len(_decrypted_keys) >= KEY_CACHE_SIZE:
+            # Drop the oldest entry (dicts keep insertion order)
+            _decrypted_keys.pop(next(iter(_decrypted_keys)))
+        _decrypted_keys[cache_key] = (time.monotonic() + KEY_CACHE_SECONDS, api_key)
+    return api_key
+
+def invalidate_user_keys(user_id: int):
+    """Forget decrypted keys of a user, e.g. after their API key changed"""
+    for cache_key in [k for k in _decrypted_keys if k[0] == user_id]:
+        del _decrypted_keys[cache_key]
@@ -0,0 +1,162 @@
+"""
+Draft comparison utilities for the DxO loop.
+Local, dependency-free measures used to tell whether a refinement materially changed the draft,
+compact diffs for re-review prompts, and line deltas for storing refinements against their parent draft.
+"""
+import difflib
+import json
+import os
+import re
+from typing import List, Optional, Set
+
+# Drafts at or above this similarity to their predecessor are considered converged
+DEFAULT_CONVERGENCE_THRESHOLD = float(os.getenv("DXO_CONVERGENCE_THRESHOLD", "0.95"))
+
+SHINGLE_SIZE = 5
+
+# Compact re-review views larger than this fraction of the full draft are not worth sending
+COMPACT_VIEW_MAX_RATIO = 0.6
+
+# Store refinements as deltas only when the delta is at most this fraction of the full text
+DELTA_MAX_RATIO = 0.8
+
+# Node.content_encoding value for contents stored as a delta against the parent node
+DELTA_ENCODING = "delta"
+
+# Experts re-reviewing a refined draft get a compact diff instead of the full text
+DIFF_REVIEWS_ENABLED = os.getenv("DXO_DIFF_REVIEWS", "true").lower() in ("1", "true", "yes")
+
+# Refinement nodes are stored as deltas against the draft they refine
+DELTA_STORAGE_ENABLED = os.getenv("DXO_DELTA_STORAGE", "true").lower() in ("1", "true", "yes")
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, ignoring punctuation and whitespace changes"""
+    return _WORD_RE.findall((text or "").lower())
+
+
+def shingles(tokens: List[str], size: int = SHINGLE_SIZE) -> Set[tuple]:
+    """Set of overlapping word n-grams"""
+    if len(tokens) < size:
+        return {tuple(tokens)} if tokens else set()
+    return {tuple(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def shingle_similarity(a: str, b: str, size: int = SHINGLE_SIZE) -> float:
+    """Jaccard similarity of the word shingles of two texts"""
+    sa = shingles(tokenize(a), size)
+    sb = shingles(tokenize(b), size)
+    if not sa and not sb:
+        return 1.0
+    return len(sa & sb) / len(sa | sb)
+
+
+def sequence_similarity(a: str, b: str) -> float:
+    """Word-level diff ratio (difflib), sensitive to reordering"""
+    ta, tb = tokenize(a), tokenize(b)
+    if not ta and not tb:
+        return 1.0
+    return difflib.SequenceMatcher(None, ta, tb, autojunk=False).ratio()
+
+
+def draft_similarity(previous: str, current: str) -> float:
+    """
+    Similarity between two successive drafts in [0, 1].
+    Takes the lower of the shingle and diff scores so that both must agree
+    before a draft is treated as unchanged.
+    """
+    shingle_score = shingle_similarity(previous, current)
+    if shingle_score == 0.0:
+        return 0.0
+    return min(shingle_score, sequence_similarity(previous, current))
+
+
+def split_sections(text: str) -> List[str]:
+    """Split a draft into sections at markdown headings, falling back to paragraphs"""
+    lines = (text or "").splitlines()
+    if any(line.lstrip().startswith("#") for line in lines):
+        sections, current = [], []
+        for line in lines:
+            if line.lstrip().startswith("#") and current:
+                sections.append("\n".join(current).strip())
+                current = []
+            current.append(line)
+        if current:
+            sections.append("\n".join(current).strip())
+    else:
+        sections = [p.strip() for p in re.split(r"\n\s*\n", text or "")]
+    return [s for s in sections if s]
+
+
+def compact_review_view(previous: str, current: str, max_ratio: float = COMPACT_VIEW_MAX_RATIO) -> Optional[str]:
+    """
+    Build a compact description of what changed between two drafts: a unified
+    diff without context followed by the full text of the changed sections.
+    Returns None when the compact view would not be meaningfully smaller than
+    the full draft, in which case callers should send the draft itself.
+    """
+    diff = "\n".join(difflib.unified_diff(
+        (previous or "").splitlines(),
+        (current or "").splitlines(),
+        fromfile="previous_draft",
+        tofile="current_draft",
+        n=0,
+        lineterm=""
+    ))
+    previous_sections = set(split_sections(previous))
+    changed = [s for s in split_sections(current) if s not in previous_sections]
+
+    view = f"Diff against the previous draft:\n{diff}\n\nChanged sections (full text):\n" + "\n\n".join(changed)
+    if len(view) > len(current or "") * max_ratio:
+        return None
+    return view
+
+
+def encode_delta(base: str, target: str) -> str:
+    """
+    Encode `target` as a line delta against `base`.
+    The delta is a JSON list where a positive int copies that many lines from
+    the base, a negative int skips that many base lines and a list of strings
+    inserts those lines.
+    """
+    base_lines = (base or "").splitlines(keepends=True)
+    target_lines = (target or "").splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(-(i2 - i1))
+        if j2 > j1:
+            ops.append(target_lines[j1:j2])
+    return json.dumps(ops, separators=(",", ":"))
+
+
+def decode_delta(base: str, delta: str) -> str:
+    """Rebuild the text encoded by `encode_delta` from its base"""
+    base_lines = (base or "").splitlines(keepends=True)
+    out = []
+    pos = 0
+    for op in json.loads(delta):
+        if isinstance(op, list):
+            out.extend(op)
+        elif op > 0:
+            out.extend(base_lines[pos:pos + op])
+            pos += op
+        else:
+            pos -= op
+    return "".join(out)
+
+
+def maybe_encode_delta(base: Optional[str], target: str, max_ratio: float = DELTA_MAX_RATIO) -> Optional[str]:
+    """Delta for `target` if it is worth storing instead of the full text, otherwise None"""
+    if not base or not target:
+        return None
+    delta = encode_delta(base, target)
+    if len(delta) > len(target) * max_ratio:
+        return None
+    return delta
@@ -1,17 +1,27 @@
 import asyncio
 import json
 import re
+from datetime import datetime, timezone
 from typing import List, Dict, Optional, Any
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from models import Conversation, Node, NodeType, User
 from openrouter_service import OpenRouterClient, get_unsupported_attachments
+from prompt_cache import build_messages, render
+from metrics import observe_phase
+from storage import store_prompt
+from engines.drafts import (
+    draft_similarity, compact_review_view, maybe_encode_delta,
+    DEFAULT_CONVERGENCE_THRESHOLD, DELTA_ENCODING, DIFF_REVIEWS_ENABLED, DELTA_STORAGE_ENABLED
+)
 
 class DxOEngine:
     def __init__(self, db: AsyncSession, user: User, openrouter_client: OpenRouterClient):
         self.db = db
         self.user = user
         self.client = openrouter_client
+        # Reviewers of a round run concurrently and share the session; node writes take turns
+        self._db_lock = asyncio.Lock()
 
     async def create_node(
         self, 
@@ -23,22 +33,41 @@ class DxOEngine:
         attachment_filenames: str = None, 
         prompt_sent: str = None,
         actual_cost: float = None,
-        warnings: str = None
+        warnings: str = None,
+        timing: Optional[Dict] = None,
+        delta_base: str = None
     ):
+        async with self._db_lock:
+            return await self._create_node(
+                conversation_id, parent_id, node_type, content, model_name, attachment_filenames,
+                prompt_sent, actual_cost, warnings, timing, delta_base
+            )
+
+    async def _create_node(self, conversation_id, parent_id, node_type, content, model_name, attachment_filenames,
+                           prompt_sent, actual_cost, warnings, timing, delta_base):
+        # Drafts refining their parent are stored as a delta against the parent's text
+        delta = maybe_encode_delta(delta_base, content) if delta_base and DELTA_STORAGE_ENABLED else None
         node = Node(
             conversation_id=conversation_id,
             parent_id=parent_id,
             type=node_type,
-            content=content,
+            content=delta if delta is not None else content,
+            content_encoding=DELTA_ENCODING if delta is not None else None,
             model_name=model_name,
             attachment_filenames=attachment_filenames,
-            prompt_sent=prompt_sent,
+            prompt_hash=await store_prompt(self.db, prompt_sent),
             actual_cost=actual_cost,
-            warnings=warnings
+            warnings=warnings,
+            request_started_at=timing.get('request_started_at') if timing else None,
+            first_token_at=timing.get('first_token_at') if timing else None,
+            completed_at=timing.get('completed_at') if timing else None,
+            retry_count=timing.get('retry_count') if timing else None,
+            persisted_at=datetime.now(timezone.utc)
         )
         self.db.add(node)
         await self.db.commit()
         await self.db.refresh(node)
+        node.prompt_text = prompt_sent
         return node
 
     async def get_attachments_for_node(self, node_id: int):
@@ -73,7 +102,57 @@ class DxOEngine:
         
         return attachments
 
-    async def run_dxo_pipeline(self, conversation_id: int, root_node: Node, roles: List[Dict], max_iterations: int = 3):
+    def build_review_prompt(self, role: Dict, content_to_review: str, is_gatekeeper: bool = False, changes: Optional[str] = None):
+        """
+        Build a reviewer prompt; returns (context, instructions, node_type).
+        The context (the draft or its changes) is shared by every reviewer of a round and
+        precedes the role-specific instructions, so it stays in the cacheable prompt prefix.
+        """
+        is_qa = "QA" in role.get('name') or "Quality" in role.get('name')
+        instructions = ""
+        node_type = "critique"
+        qa_label = "Draft"
+        review_label = "Review the following draft"
+
+        # Re-reviews of a refined draft only need what changed since the previous version
+        if changes and not is_gatekeeper:
+            content_to_review = changes
+            qa_label = review_label = "The draft was revised after the previous review round. Changes since the previous version"
+
+        if is_gatekeeper: # Critical Reviewer
+             context = f"Refined Draft:\n{content_to_review}"
+             instructions = f"""
+             You are the {role['name']}.
+             Instructions: {role.get('instructions', 'TEAR DOWN the proposal. Scan for risks, flaws, complexity.')}
+
+             Review the Refined Draft above.
+
+             Output a Critique Report.
+             IMPORTANT: You must include a "Confidence Score" (0-100) indicating your confidence in the design's safety and completeness.
+             Format your response as JSON or clearly structured text where "Score: X" can be parsed.
+             """
+        elif is_qa:
+             node_type = "test_cases"
+             context = f"{qa_label}:\n{content_to_review}"
+             instructions = f"""
+             You are the {role['name']}.
+             Instructions: {role.get('instructions', 'Generate test cases.')}
+
+             Generate specific test cases to validate this design.
+             """
+        else:
+             # General Council Member
+             context = f"{review_label}:\n{content_to_review}"
+             instructions = f"""
+             You are the {role['name']}.
+             Instructions: {role.get('instructions', 'Provide your domain-specific perspective.')}
+
+             Provide your analysis, pointed critiques, or suggestions based on your expertise.
+             """
+
+        return context, instructions.strip(), node_type
+
+    async def run_dxo_pipeline(self, conversation_id: int, root_node: Node, roles: List[Dict], max_iterations: int = 3, schedule: str = "sequential", convergence_threshold: Optional[float] = None):
         """
         Orchestrates the DxO workflow:
         Phase A: Proposal (Lead Researcher)
@@ -82,12 +161,29 @@ class DxOEngine:
           Phase C: Refinement (Lead Researcher)
           Phase D: Critical Review (Sequential Gatekeeper)
         Step E: Convergence/Verdict
+
+        With schedule="concurrent", Phase D runs in parallel with Phase B on the
+        current draft; an approved draft ends the loop before Phase C, and the
+        critique is otherwise fed into the refinement alongside the expert feedback.
+
+        When a refinement is at least `convergence_threshold` similar to the draft
+        it replaced, the loop stops: the gatekeeper scores the converged draft
+        once more and no further expert reviews are run. Without a gatekeeper the
+        converged draft has no confidence score ("n/a" in the verdict).
+
+        The confidence in the verdict is always the gatekeeper's score of the final
+        draft: in the concurrent schedule the last refinement is scored on its own.
+
+        Yields event dicts; the API layer encodes them for the SSE stream.
         """
 
         if not roles:
-             yield json.dumps({'type': 'error', 'message': 'No roles defined!'})
+             yield {'type': 'error', 'message': 'No roles defined!'}
              return
 
+        if convergence_threshold is None:
+            convergence_threshold = DEFAULT_CONVERGENCE_THRESHOLD
+
         # Get attachments using chain from root node
         attachments = await self.get_attachments_chain(root_node, max_depth=3)
         attachment_filenames = ",".join([att.filename for att in attachments]) if attachments else None
@@ -106,23 +202,23 @@ class DxOEngine:
         ]
 
         # Phase A: Proposal
-        yield json.dumps({'type': 'status', 'message': f'Phase A: {proposer_role["name"]} is drafting the proposal...'})
+        yield {'type': 'status', 'message': f'Phase A: {proposer_role["name"]} is drafting the proposal...'}
 
-        proposal_prompt = f"""
+        proposal_messages = build_messages(root_node.content, f"""
         You are the {proposer_role['name']}.
         Instructions: {proposer_role.get('instructions', '')}
 
-        User Request: "{root_node.content}"
-
         Please provide a solid initial design/response. Focus on structure, patterns, and scalability.
-        """
+        """.strip())
+        proposal_prompt = render(proposal_messages)
 
         # Cost tracking and attachment handling
-        response, cost_info = await self.client.chat_completion_details(
-            model=proposer_role['model'],
-            messages=[{"role": "user", "content": proposal_prompt}],
-            attachments=attachments
-        )
+        with observe_phase("dxo", "proposal"):
+            response, cost_info = await self.client.chat_completion_details(
+                model=proposer_role['model'],
+                messages=proposal_messages,
+                attachments=attachments
+            )
         draft_content = response.choices[0].message.content
         
         warning_list = get_unsupported_attachments(proposer_role['model'], attachments, self.user.id)
@@ -134,60 +230,26 @@ class DxOEngine:
             draft_content, 
             model_name=proposer_role['model'],
             attachment_filenames=attachment_filenames,
-            prompt_sent=proposal_prompt.strip(),
+            prompt_sent=proposal_prompt,
             actual_cost=cost_info['actual_cost'],
-            warnings=json.dumps(warning_list) if warning_list else None
+            warnings=json.dumps(warning_list) if warning_list else None,
+            timing=cost_info
         )
         
-        yield json.dumps({'type': 'node', 'node': {
+        yield {'type': 'node', 'node': {
             'id': draft_node.id, 'type': 'proposal', 'content': draft_node.content, 'model': draft_node.model_name,
-            'actual_cost': draft_node.actual_cost, 'attachment_filenames': draft_node.attachment_filenames, 'prompt_sent': draft_node.prompt_sent
-        }})
+            'actual_cost': draft_node.actual_cost, 'attachment_filenames': draft_node.attachment_filenames, 'prompt_sent': draft_node.prompt_text
+        }}
 
         # Define the Reviewer Runner Helper
-        async def run_single_reviewer(role, content_to_review, is_gatekeeper=False):
-            is_qa = "QA" in role.get('name') or "Quality" in role.get('name')
-            review_prompt = ""
-            node_type = "critique"
-
-            if is_gatekeeper: # Critical Reviewer
-                 review_prompt = f"""
-                 You are the {role['name']}.
-                 Instructions: {role.get('instructions', 'TEAR DOWN the proposal. Scan for risks, flaws, complexity.')}
-                 
-                 Review the following Refined Draft:
-                 {content_to_review}
-                 
-                 Output a Critique Report.
-                 IMPORTANT: You must include a "Confidence Score" (0-100) indicating your confidence in the design's safety and completeness.
-                 Format your response as JSON or clearly structured text where "Score: X" can be parsed.
-                 """
-            elif is_qa:
-                 node_type = "test_cases"
-                 review_prompt = f"""
-                 You are the {role['name']}.
-                 Instructions: {role.get('instructions', 'Generate test cases.')}
-                 
-                 Draft:
-                 {content_to_review}
-                 
-                 Generate specific test cases to validate this design.
-                 """
-            else:
-                 # General Council Member
-                 review_prompt = f"""
-                 You are the {role['name']}.
-                 Instructions: {role.get('instructions', 'Provide your domain-specific perspective.')}
-                 
-                 Review the following draft:
-                 {content_to_review}
-                 
-                 Provide your analysis, pointed critiques, or suggestions based on your expertise.
-                 """
+        async def run_single_reviewer(role, content_to_review, is_gatekeeper=False, changes=None):
+            context, instructions, node_type = self.build_review_prompt(role, content_to_review, is_gatekeeper, changes)
+            review_messages = build_messages(root_node.content, instructions, context)
+            review_prompt = render(review_messages)
 
             res, reviewer_cost = await self.client.chat_completion_details(
                 model=role['model'],
-                messages=[{"role": "user", "content": review_prompt}],
+                messages=review_messages,
                 attachments=attachments
             )
             response_text = res.choices[0].message.content
@@ -209,9 +271,10 @@ class DxOEngine:
                 response_text, 
                 model_name=display_name,
                 attachment_filenames=attachment_filenames,
-                prompt_sent=review_prompt.strip(),
+                prompt_sent=review_prompt,
                 actual_cost=reviewer_cost['actual_cost'],
-                warnings=json.dumps(reviewer_warnings) if reviewer_warnings else None
+                warnings=json.dumps(reviewer_warnings) if reviewer_warnings else None,
+                timing=reviewer_cost
             )
             
             return {
@@ -222,55 +285,91 @@ class DxOEngine:
                 'type': node_type
             }
 
+        def reviewer_event(res, score=0):
+            return {'type': 'node', 'node': {
+                'id': res['node'].id, 
+                'type': res['type'], 
+                'content': res['content'], 
+                'model': res['node'].model_name,
+                'score': score,
+                'actual_cost': res['node'].actual_cost,
+                'attachment_filenames': res['node'].attachment_filenames,
+                'prompt_sent': res['node'].prompt_text
+            }}
+
+        # In the concurrent schedule the gatekeeper scores the current draft
+        # alongside the experts, so an approved draft skips the refinement round-trip.
+        concurrent = schedule == "concurrent" and critic_role is not None
+
         # Loop
         iteration = 0
         confidence_score = 0
+        similarity = None
+        converged = False
+        previous_draft = None
 
         while iteration < max_iterations and confidence_score < 85:
             iteration += 1
             
             # --- Phase B: Expert Council Review ---
-            yield json.dumps({'type': 'status', 'message': f'Phase B: Council Review (Loop {iteration})...'})
             feedback_collection = []
+            changes = None
+            if DIFF_REVIEWS_ENABLED and previous_draft is not None:
+                changes = compact_review_view(previous_draft, draft_content)
             
-            if experts:
+            if concurrent:
+                yield {'type': 'status', 'message': f'Phase B+D: Council Review and Critical Review (Loop {iteration})...'}
+                tasks = [run_single_reviewer(r, draft_content, is_gatekeeper=False, changes=changes) for r in experts]
+                tasks.append(run_single_reviewer(critic_role, draft_content, is_gatekeeper=True))
+                with observe_phase("dxo", "review_and_gatekeeper"):
+                    *expert_results, critic_res = await asyncio.gather(*tasks)
+
+                for res in expert_results:
+                    feedback_collection.append(f"--- Feedback from {res['role']} ---\n{res['content']}\n")
+                    yield reviewer_event(res)
+
+                confidence_score = critic_res['score']
+                yield reviewer_event(critic_res, confidence_score)
+
+                if confidence_score >= 85:
+                    break
+                feedback_collection.append(f"--- Feedback from {critic_res['role']} ---\n{critic_res['content']}\n")
+
+            elif experts:
+                yield {'type': 'status', 'message': f'Phase B: Council Review (Loop {iteration})...'}
                 # Run experts in parallel
-                tasks = [run_single_reviewer(r, draft_content, is_gatekeeper=False) for r in experts]
-                expert_results = await asyncio.gather(*tasks)
+                tasks = [run_single_reviewer(r, draft_content, is_gatekeeper=False, changes=changes) for r in experts]
+                with observe_phase("dxo", "review"):
+                    expert_results = await asyncio.gather(*tasks)
                 
                 for res in expert_results:
                     feedback_collection.append(f"--- Feedback from {res['role']} ---\n{res['content']}\n")
-                    yield json.dumps({'type': 'node', 'node': {
-                        'id': res['node'].id, 
-                        'type': res['type'], 
-                        'content': res['content'], 
-                        'model': res['node'].model_name,
-                        'score': 0,
-                        'actual_cost': res['node'].actual_cost,
-                        'attachment_filenames': res['node'].attachment_filenames,
-                        'prompt_sent': res['node'].prompt_sent
-                    }})
+                    yield reviewer_event(res)
+            else:
+                yield {'type': 'status', 'message': f'Phase B: Council Review (Loop {iteration})...'}
             
             # --- Phase C: Refinement ---
-            yield json.dumps({'type': 'status', 'message': f'Phase C: {proposer_role["name"]} is refining the design...'})
+            yield {'type': 'status', 'message': f'Phase C: {proposer_role["name"]} is refining the design...'}
             
             all_feedback = "\n".join(feedback_collection)
-            refine_prompt = f"""
+            refine_messages = build_messages(root_node.content, f"""
             You are the {proposer_role['name']}.
             Iteration: {iteration}
-            
-            Feedback from the Council:
-            {all_feedback}
 
-            Fix the issues identified. Provide a new version (Draft_v{iteration+1}).
-            """
+            Fix the issues identified by the Council. Provide a new version (Draft_v{iteration+1}).
+            """.strip(), f"Feedback from the Council:\n{all_feedback}")
+            refine_prompt = render(refine_messages)
 
-            response, refine_cost = await self.client.chat_completion_details(
-                model=proposer_role['model'],
-                messages=[{"role": "user", "content": refine_prompt}],
-                attachments=attachments
-            )
+            with observe_phase("dxo", "refinement"):
+                response, refine_cost = await self.client.chat_completion_details(
+                    model=proposer_role['model'],
+                    messages=refine_messages,
+                    attachments=attachments
+                )
+            previous_draft = draft_content
             draft_content = response.choices[0].message.content
+            similarity = draft_similarity(previous_draft, draft_content)
+            converged = similarity >= convergence_threshold
             
             refine_warnings = get_unsupported_attachments(proposer_role['model'], attachments, self.user.id)
             
@@ -281,43 +380,46 @@ class DxOEngine:
                 draft_content, 
                 model_name=proposer_role['model'],
                 attachment_filenames=attachment_filenames,
-                prompt_sent=refine_prompt.strip(),
+                prompt_sent=refine_prompt,
                 actual_cost=refine_cost['actual_cost'],
-                warnings=json.dumps(refine_warnings) if refine_warnings else None
+                warnings=json.dumps(refine_warnings) if refine_warnings else None,
+                timing=refine_cost,
+                delta_base=previous_draft
             )
             
-            yield json.dumps({'type': 'node', 'node': {
+            yield {'type': 'node', 'node': {
                 'id': draft_node.id, 'type': 'refinement', 'content': draft_content, 'model': draft_node.model_name,
-                'actual_cost': draft_node.actual_cost, 'attachment_filenames': draft_node.attachment_filenames, 'prompt_sent': draft_node.prompt_sent
-            }})
+                'actual_cost': draft_node.actual_cost, 'attachment_filenames': draft_node.attachment_filenames, 'prompt_sent': draft_node.prompt_text,
+                'similarity': round(similarity, 4)
+            }}
 
             # --- Phase D: Critical Review (Gatekeeper) ---
-            if critic_role:
-                yield json.dumps({'type': 'status', 'message': f'Phase D: Critical Review (Gatekeeper)...'})
-                critic_res = await run_single_reviewer(critic_role, draft_content, is_gatekeeper=True)
+            # (in the concurrent schedule the refined draft is scored at the start of the next loop,
+            # unless it has converged or this was the last loop, so the verdict scores the final draft)
+            if critic_role and (not concurrent or converged or iteration >= max_iterations):
+                yield {'type': 'status', 'message': f'Phase D: Critical Review (Gatekeeper)...'}
+                with observe_phase("dxo", "gatekeeper"):
+                    critic_res = await run_single_reviewer(critic_role, draft_content, is_gatekeeper=True)
                 
                 confidence_score = critic_res['score']
                 
-                yield json.dumps({'type': 'node', 'node': {
-                    'id': critic_res['node'].id, 
-                    'type': critic_res['type'], 
-                    'content': critic_res['content'], 
-                    'model': critic_res['node'].model_name,
-                    'score': confidence_score,
-                    'actual_cost': critic_res['node'].actual_cost,
-                    'attachment_filenames': critic_res['node'].attachment_filenames,
-                    'prompt_sent': critic_res['node'].prompt_sent
-                }})
-            else:
-                # Fallback if no critic exists
-                confidence_score = 50 + (iteration * 15)
+                yield reviewer_event(critic_res, confidence_score)
+            elif not critic_role:
+                # Fallback if no critic exists; nothing scores a converged draft, so it gets no confidence
+                confidence_score = None if converged else 50 + (iteration * 15)
+
+            if converged and (confidence_score or 0) < 85:
+                yield {'type': 'status', 'message': f'Draft converged ({similarity:.0%} similar to the previous version), skipping further iterations...'}
+                break
 
         # Final Verdict
-        yield json.dumps({'type': 'status', 'message': 'Finalizing result...'})
+        yield {'type': 'status', 'message': 'Finalizing result...'}
+        approved = confidence_score is not None and confidence_score >= 85
         final_verdict = f"""
         Final Output
-        Status: {"APPROVED" if confidence_score >= 85 else "Review Limit Reached"} (Confidence: {confidence_score}%)
+        Status: {"APPROVED" if approved else "Converged" if converged else "Review Limit Reached"} (Confidence: {f"{confidence_score}%" if confidence_score is not None else "n/a"})
         Iterations: {iteration} Loops
+        Last Draft Similarity: {f"{similarity:.0%}" if similarity is not None else "n/a"}
 
         EXECUTIVE SUMMARY:
         (See final draft)
@@ -331,7 +433,7 @@ class DxOEngine:
             attachment_filenames=attachment_filenames,
             actual_cost=0.0 # System node has no cost
         )
-        yield json.dumps({'type': 'node', 'node': {
+        yield {'type': 'node', 'node': {
             'id': final_node.id, 
             'conversation_id': conversation_id,
             'type': 'verdict', 
@@ -339,4 +441,4 @@ class DxOEngine:
             'model': 'System', 
             'actual_cost': 0.0,
             'attachment_filenames': final_node.attachment_filenames
-        }})
+        }}
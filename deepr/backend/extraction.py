@@ -0,0 +1,84 @@
+"""
+Plain-text extraction for attachments.
+
+Text and PDF attachments get their text extracted once, when they are saved,
+and stored on the attachment with a page count and a token estimate. The
+request builder then sends that text instead of decoding the file on every
+call. PDFs go to models as text when DEEPR_PDF_AS_TEXT says so:
+- auto (default): only for models whose OpenRouter modalities exclude files,
+  so those models can read documents at all
+- always: for every model, which keeps requests small
+- never: always send the raw PDF
+
+PDF extraction uses `pypdf` (in requirements.txt). If it is missing, and for
+PDFs without a text layer (scans), PDFs are always sent as files.
+"""
+import asyncio
+import logging
+import os
+from io import BytesIO
+from typing import Dict, Optional
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+logger = logging.getLogger(__name__)
+
+PDF_AS_TEXT = os.getenv("DEEPR_PDF_AS_TEXT", "auto").lower()
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Roughly 4 characters per token"""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def _pdf_text(data: bytes):
+    reader = pypdf.PdfReader(BytesIO(data))
+    pages = [page.extract_text() or "" for page in reader.pages]
+    return "\n\n".join(pages), len(pages)
+
+
+def extract_text(file_type: str, data: bytes) -> Optional[Dict]:
+    """Extracted text, page count and token estimate, or None when the file has no usable text"""
+    page_count = None
+    if file_type == 'text':
+        text = data.decode('utf-8', errors='replace')
+    elif file_type == 'pdf' and pypdf is not None:
+        try:
+            text, page_count = _pdf_text(data)
+        except Exception as e:
+            logger.warning("PDF text extraction failed: %s", e)
+            return None
+        if not text.strip():
+            return None
+    else:
+        return None
+
+    return {"extracted_text": text, "page_count": page_count, "token_estimate": estimate_tokens(text)}
+
+
+async def extract_attachment(file_type: str, data: bytes) -> Dict:
+    """extract_text off the event loop; returns the Attachment column values (empty if nothing was extracted)"""
+    if file_type not in ('text', 'pdf'):
+        return {}
+    return await asyncio.to_thread(extract_text, file_type, data) or {}
+
+
+def send_pdf_as_text(attachment, file_supported: Optional[bool]) -> bool:
+    """Whether a PDF attachment goes to the model as its extracted text instead of the raw file"""
+    if attachment.file_type != 'pdf' or not getattr(attachment, 'extracted_text', None):
+        return False
+    if PDF_AS_TEXT == 'always':
+        return True
+    if PDF_AS_TEXT == 'never':
+        return False
+    # auto: models known to lack file input; unknown models keep getting the file
+    return file_supported is False
+
+
+def attachment_text(attachment) -> str:
+    """Text of a text attachment, decoding the file for attachments saved before extraction existed"""
+    text = getattr(attachment, 'extracted_text', None)
+    return text if text is not None else attachment.file_data.decode('utf-8')
@@ -2,6 +2,8 @@
 File upload utilities for attachment support.
 Handles file validation, temporary storage, and MIME type detection.
 """
+import os
+import time
 import uuid
 from typing import Dict, Optional
 
@@ -75,6 +77,8 @@ ALLOWED_MIME_TYPES = {
 # Temporary storage for uploaded files (before node creation)
 # In production, use Redis or similar
 temp_storage: Dict[str, dict] = {}
+# Uploads never attached to a run are dropped after this long (see maintenance.py)
+UPLOAD_TTL_SECONDS = float(os.getenv("DEEPR_UPLOAD_TTL_SECONDS", "3600"))
 
 def get_file_type(mime_type: str) -> Optional[str]:
     """Determine file type category from MIME type"""
@@ -87,3 +91,18 @@ def validate_file_size(file_size: int, file_type: str) -> bool:
     """Check if file size is within limits"""
     max_size = MAX_FILE_SIZE.get(file_type, 0)
     return file_size <= max_size
+
+def reap_expired_uploads(now: Optional[float] = None, ttl: float = None) -> Dict[str, int]:
+    """Remove temporary uploads older than the TTL; returns the count and bytes freed"""
+    now = time.time() if now is None else now
+    ttl = UPLOAD_TTL_SECONDS if ttl is None else ttl
+    expired = [
+        file_id for file_id, info in list(temp_storage.items())
+        if now - info.get('uploaded_at', now) > ttl
+    ]
+    freed = 0
+    for file_id in expired:
+        info = temp_storage.pop(file_id, None)
+        if info is not None:
+            freed += info.get('file_size', 0)
+    return {"deleted": len(expired), "bytes": freed}
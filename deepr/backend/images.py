@@ -0,0 +1,196 @@
+"""
+Image preprocessing: per-model downsizing before submission and thumbnails.
+
+Vision models downscale large images on their side anyway, so an image is
+resized to the largest resolution the model's provider actually uses (its
+profile) and re-encoded before it is base64-encoded into the request.
+Results are cached per attachment and profile in a bounded in-process LRU
+(DEEPR_IMAGE_CACHE_MB), so a council sending the same image to several
+models of one provider resizes it once. Images within the profile, or that
+would not get smaller, are sent as uploaded.
+
+Thumbnails for the history UI are made when an attachment is saved and
+served by GET /api/attachments/{id}/thumbnail.
+
+Both use Pillow (in requirements.txt). If it is missing, images are sent as
+uploaded and no thumbnails are made. Set DEEPR_IMAGE_NORMALIZE=false to always send originals.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_NORMALIZE = os.getenv("DEEPR_IMAGE_NORMALIZE", "true").lower() in ("1", "true", "yes")
+CACHE_BYTES = int(float(os.getenv("DEEPR_IMAGE_CACHE_MB", "64")) * 1024 * 1024)
+# Profile per model prefix: (name, max long edge, max short edge) beyond which the provider downscales
+VISION_PROFILES = {
+    "anthropic/": ("anthropic", 1568, 1568),
+    "openai/": ("openai", 2048, 768),
+    "google/": ("google", 3072, 3072),
+}
+DEFAULT_PROFILE = ("default", 2048, 2048)
+JPEG_QUALITY = 85
+THUMBNAIL_EDGE = 256
+THUMBNAIL_MIME = "image/webp"
+# Formats Pillow re-encodes safely; GIFs may be animated and SVGs are not raster
+NORMALIZABLE = {"image/jpeg", "image/png", "image/webp"}
+
+IMAGE_BYTES = metrics.counter("deepr_image_bytes_total", "Image bytes before and after normalisation", ["stage"])
+
+_cache: "OrderedDict[Tuple[int, str], Tuple[str, bytes]]" = OrderedDict()
+_cache_bytes = 0
+# Normalisations in progress, so concurrent calls of a council wait for one result
+_pending: Dict[Tuple[int, str], asyncio.Future] = {}
+
+
+class NormalizedImage:
+    """Stand-in for an image attachment in one request; the attachment itself is shared and left untouched"""
+
+    def __init__(self, attachment, mime_type: str, file_data: bytes):
+        self.id = getattr(attachment, "id", None)
+        self.filename = attachment.filename
+        self.file_type = attachment.file_type
+        self.mime_type = mime_type
+        self.file_data = file_data
+
+
+def profile_for(model: Optional[str]) -> Tuple[str, int, int]:
+    for prefix, profile in VISION_PROFILES.items():
+        if model and model.startswith(prefix):
+            return profile
+    return DEFAULT_PROFILE
+
+
+def _encode(image, has_alpha: bool) -> Tuple[str, bytes]:
+    out = BytesIO()
+    if has_alpha:
+        image.save(out, format="PNG", optimize=True)
+        return "image/png", out.getvalue()
+    image.convert("RGB").save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return "image/jpeg", out.getvalue()
+
+
+def normalize_image(data: bytes, mime_type: str, long_edge: int, short_edge: int) -> Optional[Tuple[str, bytes]]:
+    """Downsized, re-encoded image within the limits, or None when the original should be sent"""
+    if Image is None or mime_type not in NORMALIZABLE:
+        return None
+    try:
+        image = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+        width, height = image.size
+        scale = min(long_edge / max(width, height), short_edge / min(width, height))
+        if scale >= 1.0:
+            # Within the profile: the original goes as uploaded rather than re-encoded lossily
+            return None
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        encoded_mime, encoded = _encode(image, has_alpha)
+    except Exception as e:
+        logger.warning("Image normalisation failed: %s", e)
+        return None
+    if len(encoded) >= len(data):
+        return None
+    return encoded_mime, encoded
+
+
+def _cache_get(key):
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    return None
+
+
+def _cache_put(key, value: Tuple[str, bytes]):
+    global _cache_bytes
+    size = len(value[1])
+    if size > CACHE_BYTES:
+        return
+    _cache[key] = value
+    _cache_bytes += size
+    while _cache_bytes > CACHE_BYTES:
+        _, (_, evicted) = _cache.popitem(last=False)
+        _cache_bytes -= len(evicted)
+
+
+async def _normalize(att, long_edge: int, short_edge: int) -> Tuple[str, bytes]:
+    # Originals are returned as (mime, b"") so an image that needs no change is only inspected once
+    result = await asyncio.to_thread(normalize_image, att.file_data, att.mime_type, long_edge, short_edge)
+    return result or (att.mime_type, b"")
+
+
+async def _normalized(att, name: str, long_edge: int, short_edge: int) -> Tuple[str, bytes]:
+    attachment_id = getattr(att, "id", None)
+    if attachment_id is None:
+        return await _normalize(att, long_edge, short_edge)
+    key = (attachment_id, name)
+    result = _cache_get(key)
+    if result is not None:
+        return result
+    future = _pending.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_normalize(att, long_edge, short_edge))
+        _pending[key] = future
+
+        def done(f):
+            _pending.pop(key, None)
+            if not f.cancelled() and f.exception() is None:
+                _cache_put(key, f.result())
+
+        future.add_done_callback(done)
+    # Shielded: one cancelled call must not cancel the work other calls are waiting for
+    return await asyncio.shield(future)
+
+
+async def prepare_images(attachments: Optional[List], model: Optional[str]) -> Optional[List]:
+    """Attachments for one model call, with images replaced by their normalised version where that is smaller"""
+    if not attachments or not IMAGE_NORMALIZE or Image is None:
+        return attachments
+    name, long_edge, short_edge = profile_for(model)
+    prepared = []
+    for att in attachments:
+        if att.file_type != "image":
+            prepared.append(att)
+            continue
+        mime_type, data = await _normalized(att, name, long_edge, short_edge)
+        IMAGE_BYTES.inc(len(att.file_data), stage="original")
+        if data:
+            IMAGE_BYTES.inc(len(data), stage="sent")
+            prepared.append(NormalizedImage(att, mime_type, data))
+        else:
+            IMAGE_BYTES.inc(len(att.file_data), stage="sent")
+            prepared.append(att)
+    return prepared
+
+
+def make_thumbnail(data: bytes, mime_type: str) -> Dict:
+    """Thumbnail and original dimensions as Attachment column values (empty if the image cannot be read)"""
+    if Image is None or mime_type == "image/svg+xml":
+        return {}
+    try:
+        image = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+        width, height = image.size
+        image.thumbnail((THUMBNAIL_EDGE, THUMBNAIL_EDGE))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        out = BytesIO()
+        image.save(out, format="WEBP", quality=80)
+    except Exception as e:
+        logger.warning("Thumbnail generation failed: %s", e)
+        return {}
+    return {"thumbnail": out.getvalue(), "width": width, "height": height}
+
+
+async def thumbnail_columns(file_type: str, data: bytes, mime_type: str) -> Dict:
+    if file_type != "image":
+        return {}
+    return await asyncio.to_thread(make_thumbnail, data, mime_type)
@@ -0,0 +1,4 @@
+"""
+Load-testing tools: a fake OpenRouter provider and a load generator for the backend API.
+Run from deepr/backend, e.g. `python -m loadtest.mock_openrouter` and `python -m loadtest.run_load`.
+"""
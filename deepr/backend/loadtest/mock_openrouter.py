@@ -0,0 +1,231 @@
+"""
+OpenAI-compatible fake provider standing in for OpenRouter during load tests.
+
+Point the backend at it with OPENROUTER_BASE_URL=http://localhost:8100/api/v1.
+Latency, token rate, error rate and response size are configurable from the
+command line or MOCK_* environment variables:
+
+    python -m loadtest.mock_openrouter --port 8100 --ttft lognormal:800:0.5 \
+        --tokens-per-second 60 --output-tokens 400 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MOCK_MODELS = [
+    ("openai/gpt-4o", "text+image->text"),
+    ("openai/gpt-3.5-turbo", "text->text"),
+    ("anthropic/claude-3.5-sonnet", "text+image+file->text"),
+    ("google/gemini-pro-1.5", "text+image+file+audio+video->text"),
+    ("meta-llama/llama-3-70b-instruct", "text->text"),
+]
+
+FILLER = (
+    "The council considered the question from several angles and weighed the trade-offs "
+    "between cost, latency, reliability and maintainability before settling on a recommendation. "
+).split()
+
+
+@dataclass
+class LatencyDistribution:
+    """Sampled delay in milliseconds: fixed:MS, uniform:LOW:HIGH, lognormal:MEDIAN:SIGMA or exponential:MEAN"""
+    kind: str = "lognormal"
+    params: List[float] = field(default_factory=lambda: [800.0, 0.5])
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyDistribution":
+        kind, *params = spec.split(":")
+        if kind not in ("fixed", "uniform", "lognormal", "exponential"):
+            raise ValueError(f"Unknown latency distribution: {kind}")
+        return cls(kind=kind, params=[float(p) for p in params])
+
+    def sample_ms(self) -> float:
+        p = self.params
+        if self.kind == "fixed":
+            return p[0]
+        if self.kind == "uniform":
+            return random.uniform(p[0], p[1])
+        if self.kind == "exponential":
+            return random.expovariate(1.0 / p[0])
+        # lognormal: median and shape
+        return random.lognormvariate(0.0, p[1] if len(p) > 1 else 0.5) * p[0]
+
+
+@dataclass
+class MockConfig:
+    ttft: LatencyDistribution = field(default_factory=LatencyDistribution)
+    tokens_per_second: float = 60.0
+    output_tokens: int = 400
+    error_rate: float = 0.0
+    error_statuses: List[int] = field(default_factory=lambda: [429, 500, 502])
+    cost_per_1k_tokens: float = 0.002
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "MockConfig":
+        config = cls()
+        if os.getenv("MOCK_TTFT"):
+            config.ttft = LatencyDistribution.parse(os.getenv("MOCK_TTFT"))
+        config.tokens_per_second = float(os.getenv("MOCK_TOKENS_PER_SECOND", config.tokens_per_second))
+        config.output_tokens = int(os.getenv("MOCK_OUTPUT_TOKENS", config.output_tokens))
+        config.error_rate = float(os.getenv("MOCK_ERROR_RATE", config.error_rate))
+        return config
+
+
+def _estimate_prompt_tokens(messages: List[dict]) -> int:
+    """Roughly 4 characters per token; attachment parts are counted by their payload size"""
+    chars = 0
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            chars += len(json.dumps(content))
+    return max(1, chars // 4)
+
+
+def _prompt_text(messages: List[dict]) -> str:
+    parts = []
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(p.get("text", "") for p in content if p.get("type") == "text")
+    return "\n".join(parts)
+
+
+def _generate_tokens(config: MockConfig, prompt: str) -> List[str]:
+    count = max(1, int(random.gauss(config.output_tokens, config.output_tokens * 0.2)))
+    words = [random.choice(FILLER) for _ in range(count)]
+    # Let the DxO gatekeeper parse a score so convergence paths are exercised
+    if "Confidence Score" in prompt:
+        words = [f"Score: {random.randint(60, 95)}\n"] + words
+    return [w if w.endswith("\n") else w + " " for w in words]
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI(title="Mock OpenRouter")
+    if config.seed is not None:
+        random.seed(config.seed)
+    models = [
+        {
+            "id": model_id,
+            "name": model_id,
+            "description": "Mock model",
+            "context_length": 128000,
+            "pricing": {"prompt": "0.000001", "completion": "0.000002"},
+            "architecture": {"modality": modality},
+        }
+        for model_id, modality in MOCK_MODELS
+    ]
+
+    @app.get("/api/v1/models")
+    @app.get("/api/v1/models/user")
+    async def list_models():
+        return {"data": models}
+
+    @app.post("/api/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "mock/model")
+        messages = body.get("messages", [])
+        prompt_tokens = _estimate_prompt_tokens(messages)
+
+        await asyncio.sleep(config.ttft.sample_ms() / 1000.0)
+
+        if random.random() < config.error_rate:
+            status = random.choice(config.error_statuses)
+            return JSONResponse(status_code=status, content={"error": {"message": "Mock upstream error", "code": status}})
+
+        tokens = _generate_tokens(config, _prompt_text(messages))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "cost": (prompt_tokens + len(tokens)) / 1000.0 * config.cost_per_1k_tokens,
+        }
+
+        if not body.get("stream"):
+            # Non-streaming callers still pay for generation time
+            await asyncio.sleep(len(tokens) / config.tokens_per_second)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        async def stream():
+            interval = 1.0 / config.tokens_per_second
+            for token in tokens:
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(interval)
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake OpenRouter provider")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ttft", help="Latency to first token, e.g. fixed:500, uniform:200:1500, lognormal:800:0.5")
+    parser.add_argument("--tokens-per-second", type=float)
+    parser.add_argument("--output-tokens", type=int)
+    parser.add_argument("--error-rate", type=float)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config = MockConfig.from_env()
+    if args.ttft:
+        config.ttft = LatencyDistribution.parse(args.ttft)
+    if args.tokens_per_second is not None:
+        config.tokens_per_second = args.tokens_per_second
+    if args.output_tokens is not None:
+        config.output_tokens = args.output_tokens
+    if args.error_rate is not None:
+        config.error_rate = args.error_rate
+    config.seed = args.seed
+
+    import uvicorn
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+End-to-end load generator for the DeepR backend.
+
+Drives /council/run (dag, ensemble, dxo), /superchat/chat and /upload at a
+fixed concurrency and reports time to first model node (TTFT), latency
+percentiles, runs/sec, database query counts and process RSS.
+
+By default the app is served in-process on a local port so database
+statements and memory can be measured directly; pass --base-url to target a
+running server instead. Either way the backend must reach a provider through
+OPENROUTER_BASE_URL; --start-mock launches loadtest.mock_openrouter for that.
+
+    DATABASE_URL=sqlite+aiosqlite:///./loadtest.db \
+        python -m loadtest.run_load --start-mock --concurrency 20 --runs 100
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+
+SCENARIOS = ["dag", "ensemble", "dxo", "superchat", "upload"]
+
+DEFAULT_MODELS = ["openai/gpt-4o", "anthropic/claude-3.5-sonnet", "google/gemini-pro-1.5"]
+
+
+@dataclass
+class RunResult:
+    scenario: str
+    ok: bool
+    duration: float
+    ttft: Optional[float] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class LoadStats:
+    results: List[RunResult] = field(default_factory=list)
+    db_queries: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident set size of this process (Linux), None where unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def build_payload(scenario: str, models: List[str], max_iterations: int) -> Dict:
+    prompt = f"Load test {scenario} run: compare three approaches to caching in a web service."
+    if scenario == "dxo":
+        return {
+            "prompt": prompt,
+            "method": "dxo",
+            "max_iterations": max_iterations,
+            "roles": [
+                {"name": "Lead Researcher", "model": models[0], "instructions": ""},
+                {"name": "Domain Expert", "model": models[1 % len(models)], "instructions": ""},
+                {"name": "Critical Reviewer", "model": models[2 % len(models)], "instructions": ""},
+            ],
+        }
+    if scenario == "superchat":
+        return {"prompt": prompt, "council_members": models, "chairman_model": models[0]}
+    return {"prompt": prompt, "method": scenario, "council_members": models, "chairman_model": models[0]}
+
+
+async def run_stream(client: httpx.AsyncClient, scenario: str, path: str, payload: Dict, headers: Dict) -> RunResult:
+    start = time.perf_counter()
+    ttft = None
+    try:
+        async with client.stream("POST", path, json=payload, headers=headers) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                return RunResult(scenario, False, time.perf_counter() - start, error=f"HTTP {response.status_code}: {body[:200]!r}")
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if event.get("type") == "node" and ttft is None and event["node"].get("type") != "root":
+                    ttft = time.perf_counter() - start
+                elif event.get("type") == "error":
+                    return RunResult(scenario, False, time.perf_counter() - start, ttft, event.get("message"))
+                elif event.get("type") == "done":
+                    break
+        return RunResult(scenario, True, time.perf_counter() - start, ttft)
+    except Exception as e:
+        return RunResult(scenario, False, time.perf_counter() - start, ttft, str(e))
+
+
+async def run_upload(client: httpx.AsyncClient, headers: Dict, upload_bytes: int) -> RunResult:
+    start = time.perf_counter()
+    files = {"files": ("loadtest.txt", b"x" * upload_bytes, "text/plain")}
+    try:
+        response = await client.post("/upload", files=files, headers=headers)
+        ok = response.status_code == 200
+        return RunResult("upload", ok, time.perf_counter() - start, error=None if ok else f"HTTP {response.status_code}")
+    except Exception as e:
+        return RunResult("upload", False, time.perf_counter() - start, error=str(e))
+
+
+async def authenticate(client: httpx.AsyncClient, email: str) -> Dict:
+    response = await client.post("/auth/dev-login", json={"email": email})
+    response.raise_for_status()
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = await client.put("/settings", json={"openrouter_api_key": "mock-key"}, headers=headers)
+    response.raise_for_status()
+    return headers
+
+
+async def run_load(client: httpx.AsyncClient, args, stats: LoadStats):
+    headers = await authenticate(client, args.email)
+
+    jobs: asyncio.Queue = asyncio.Queue()
+    for i in range(args.runs):
+        for scenario in args.scenarios:
+            jobs.put_nowait(scenario)
+
+    async def worker():
+        while True:
+            try:
+                scenario = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if scenario == "upload":
+                result = await run_upload(client, headers, args.upload_kb * 1024)
+            else:
+                path = "/superchat/chat" if scenario == "superchat" else "/council/run"
+                payload = build_payload(scenario, args.models, args.max_iterations)
+                result = await run_stream(client, scenario, path, payload, headers)
+            stats.results.append(result)
+
+    stats.started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    stats.finished = time.perf_counter()
+
+
+def summarize(stats: LoadStats, in_process: bool) -> Dict:
+    elapsed = stats.finished - stats.started
+    summary = {"elapsed_seconds": round(elapsed, 3), "scenarios": {}}
+    for scenario in sorted({r.scenario for r in stats.results}):
+        results = [r for r in stats.results if r.scenario == scenario]
+        ok = [r for r in results if r.ok]
+        durations = [r.duration for r in ok]
+        ttfts = [r.ttft for r in ok if r.ttft is not None]
+        summary["scenarios"][scenario] = {
+            "runs": len(results),
+            "errors": len(results) - len(ok),
+            "runs_per_sec": round(len(ok) / elapsed, 3) if elapsed else None,
+            "latency_p50": percentile(durations, 50),
+            "latency_p95": percentile(durations, 95),
+            "latency_p99": percentile(durations, 99),
+            "ttft_p50": percentile(ttfts, 50),
+            "ttft_p95": percentile(ttfts, 95),
+            "ttft_p99": percentile(ttfts, 99),
+            "sample_errors": sorted({r.error for r in results if r.error})[:3],
+        }
+    total = len(stats.results)
+    summary["runs_per_sec"] = round(sum(1 for r in stats.results if r.ok) / elapsed, 3) if elapsed else None
+    if in_process:
+        summary["db_queries"] = stats.db_queries
+        summary["db_queries_per_run"] = round(stats.db_queries / total, 1) if total else None
+        summary["rss_bytes"] = current_rss_bytes()
+        summary["peak_rss_bytes"] = peak_rss_bytes()
+    return summary
+
+
+def print_summary(summary: Dict):
+    def fmt(value):
+        return "-" if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
+
+    columns = ["runs", "errors", "runs_per_sec", "ttft_p50", "ttft_p95", "ttft_p99", "latency_p50", "latency_p95", "latency_p99"]
+    print(f"{'scenario':<10} " + " ".join(f"{c:>12}" for c in columns))
+    for scenario, row in summary["scenarios"].items():
+        print(f"{scenario:<10} " + " ".join(f"{fmt(row[c]):>12}" for c in columns))
+        for error in row["sample_errors"]:
+            print(f"  error: {error}")
+    print(f"\nelapsed: {summary['elapsed_seconds']}s, total runs/sec: {fmt(summary['runs_per_sec'])}")
+    if "db_queries" in summary:
+        print(f"db queries: {summary['db_queries']} ({fmt(summary['db_queries_per_run'])} per run)")
+        print(f"rss: {fmt(summary['rss_bytes'])} bytes, peak rss: {summary['peak_rss_bytes']} bytes")
+
+
+def start_mock(port: int) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, "-m", "loadtest.mock_openrouter", "--port", str(port)])
+    os.environ["OPENROUTER_BASE_URL"] = f"http://127.0.0.1:{port}/api/v1"
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/api/v1/models", timeout=0.5)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock provider did not start")
+
+
+async def main_async(args) -> Dict:
+    stats = LoadStats()
+    timeout = httpx.Timeout(args.timeout)
+    if args.base_url:
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=timeout) as client:
+            await run_load(client, args, stats)
+        return summarize(stats, in_process=False)
+
+    import uvicorn
+    from sqlalchemy import event
+    from database import engine, Base
+    from main import app
+
+    # Statement logging would dominate the measurement
+    engine.sync_engine.echo = False
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    def count_query(*_):
+        stats.db_queries += 1
+
+    # Serve over a real socket so streamed events (and TTFT) arrive as they are sent
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.app_port, log_level="warning"))
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if serve_task.done():
+            serve_task.result()
+        await asyncio.sleep(0.05)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.app_port}", timeout=timeout) as client:
+            await run_load(client, args, stats)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", count_query)
+        server.should_exit = True
+        await serve_task
+    return summarize(stats, in_process=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the DeepR backend")
+    parser.add_argument("--base-url", help="Target a running server instead of the in-process app")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=10, help="Runs per scenario")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("--max-iterations", type=int, default=2, help="DxO loop limit")
+    parser.add_argument("--upload-kb", type=int, default=256)
+    parser.add_argument("--email", default="loadtest@example.com")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--start-mock", action="store_true", help="Launch the mock provider and point the backend at it")
+    parser.add_argument("--mock-port", type=int, default=8100)
+    parser.add_argument("--app-port", type=int, default=8199, help="Port for the in-process app")
+    parser.add_argument("--json", help="Also write the summary to this file")
+    args = parser.parse_args()
+
+    mock = start_mock(args.mock_port) if args.start_mock else None
+    try:
+        summary = asyncio.run(main_async(args))
+    finally:
+        if mock:
+            mock.terminate()
+
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
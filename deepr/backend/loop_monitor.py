@@ -0,0 +1,111 @@
+"""
+Event-loop lag sampling and blocking-call detection.
+
+A sampler task sleeps for a fixed interval and records how late it wakes up
+(deepr_event_loop_lag_seconds). When DEEPR_BLOCKING_THRESHOLD_MS is set, a
+watchdog thread also watches the sampler's heartbeat and, if the loop stays
+blocked longer than the threshold, logs the loop thread's current stack once
+per stall so the offending synchronous call can be found.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL_SECONDS = float(os.getenv("DEEPR_LOOP_LAG_INTERVAL_MS", "250")) / 1000.0
+BLOCKING_THRESHOLD_SECONDS = float(os.getenv("DEEPR_BLOCKING_THRESHOLD_MS", "0")) / 1000.0
+
+LOOP_LAG = metrics.histogram(
+    "deepr_event_loop_lag_seconds", "How late the event loop ran a timer callback",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+LOOP_LAG_MAX = metrics.gauge(
+    "deepr_event_loop_lag_max_seconds", "Largest event loop lag seen since the last scrape",
+    collect=lambda: {(): _monitor.take_max_lag() if _monitor else 0.0}
+)
+LOOP_BLOCKED = metrics.counter("deepr_event_loop_blocked_total", "Stalls longer than DEEPR_BLOCKING_THRESHOLD_MS")
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS, blocking_threshold: float = BLOCKING_THRESHOLD_SECONDS):
+        # The heartbeat has to tick well inside the threshold or idle time would look like a stall
+        self.interval = min(interval, blocking_threshold / 2) if blocking_threshold else interval
+        self.blocking_threshold = blocking_threshold
+        self.heartbeat = time.monotonic()
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        if self.blocking_threshold:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._watchdog:
+            self._watchdog.join(timeout=1)
+
+    def take_max_lag(self) -> float:
+        value, self.max_lag = self.max_lag, 0.0
+        return value
+
+    async def _sample(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.heartbeat = now
+            LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stopped.wait(self.blocking_threshold / 4):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.blocking_threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            LOOP_BLOCKED.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "<unavailable>"
+            logger.warning("Event loop blocked for %.0f ms; loop thread stack:\n%s", stalled * 1000, stack)
+
+
+_monitor: Optional[LoopMonitor] = None
+
+
+def start_monitor() -> LoopMonitor:
+    """Start sampling the running loop; call from the app's startup hook"""
+    global _monitor
+    _monitor = LoopMonitor()
+    _monitor.start()
+    return _monitor
+
+
+async def stop_monitor():
+    global _monitor
+    if _monitor:
+        await _monitor.stop()
+        _monitor = None
@@ -1,8 +1,18 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from database import engine, Base
-from auth import router as auth_router
+from auth import router as auth_router, get_metrics_reader
 from settings import router as settings_router
 from api import router as api_router
+from search import router as search_router
+from transfer import router as transfer_router
+from metrics import router as metrics_router
+from tracing import TracingMiddleware
+from query_stats import QueryStatsMiddleware
+from loop_monitor import start_monitor, stop_monitor
+from memory_profiling import router as memory_router, install_signal_handler
+from pubsub import start_broker, stop_broker
+from maintenance import router as maintenance_router, start_scheduler, stop_scheduler
+from routing import router as routing_router, start_stats_sync, stop_stats_sync
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
 
@@ -15,15 +25,36 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 app.include_router(auth_router)
 app.include_router(settings_router)
+# Before api_router, whose /history/{conversation_id} would otherwise capture /history/export
+app.include_router(transfer_router)
 app.include_router(api_router)
+app.include_router(search_router)
+app.include_router(metrics_router, dependencies=[Depends(get_metrics_reader)])
+app.include_router(memory_router)
+app.include_router(maintenance_router)
+app.include_router(routing_router)
 
 @app.on_event("startup")
 async def startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    start_monitor()
+    install_signal_handler()
+    await start_broker()
+    start_scheduler()
+    await start_stats_sync()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_stats_sync()
+    await stop_scheduler()
+    await stop_broker()
+    await stop_monitor()
 
 @app.get("/")
 def read_root():
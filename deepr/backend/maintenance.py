@@ -0,0 +1,384 @@
+"""
+Garbage collection and retention jobs.
+
+- uploads: temporary uploads that were never attached to a run, once older
+  than DEEPR_UPLOAD_TTL_SECONDS. They live in worker memory, so every worker
+  reaps its own.
+- deleted: conversations users deleted. Deleting only sets `deleted_at`;
+  schedule_purge removes the rows right after, and this job catches whatever
+  a restarted worker left behind. Conversations with a run still streaming
+  are purged once it finishes, so the run never writes into a purged one.
+- retention: conversations without activity (no new node) for longer than the
+  owner's `retention_days` setting, or DEEPR_RETENTION_DAYS for users without
+  one (0 keeps them forever). A SuperChat thread continued today is kept.
+- attachments: attachments whose node no longer exists. SQLite does not
+  enforce the ON DELETE CASCADE, and node deletes that bypass the ORM leave
+  them behind.
+- prompt_blobs: prompt blobs no node references. Blobs younger than
+  DEEPR_PROMPT_BLOB_GRACE_SECONDS are kept, so a run that is storing the same
+  prompt right now cannot lose it.
+
+Database jobs work in keyset-ordered batches of DEEPR_GC_BATCH_SIZE rows (or
+conversations) with a commit per batch, so no statement holds locks on a large
+range. Every job reports the rows it removed and the bytes reclaimed, which
+are also counted in deepr_gc_deleted_total and deepr_gc_reclaimed_bytes_total.
+
+Workers run all jobs every DEEPR_MAINTENANCE_INTERVAL_SECONDS (0 = off). On
+Postgres an advisory lock lets only one worker run the database jobs at a
+time. Admins can trigger a pass with POST /admin/maintenance/run, and the
+database jobs can run from cron:
+
+    python -m maintenance [--dry-run] [--job retention --job attachments ...]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import delete, exists, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import metrics
+from auth import get_admin_user
+from file_utils import reap_expired_uploads
+from models import Attachment, Conversation, Node, PromptBlob, User, UserSettings
+from pubsub import get_broker
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("DEEPR_MAINTENANCE_INTERVAL_SECONDS", "3600"))
+RETENTION_DAYS = int(os.getenv("DEEPR_RETENTION_DAYS", "0"))
+PROMPT_BLOB_GRACE_SECONDS = float(os.getenv("DEEPR_PROMPT_BLOB_GRACE_SECONDS", "3600"))
+GC_BATCH_SIZE = int(os.getenv("DEEPR_GC_BATCH_SIZE", "500"))
+# Conversations purged per batch; each one takes all of its nodes and attachments with it
+PURGE_BATCH_SIZE = 20
+# How often a purge waiting for live runs of deleted conversations checks again
+LIVE_RUN_RECHECK_SECONDS = 5.0
+# Key of the Postgres advisory lock that serialises database jobs across workers
+ADVISORY_LOCK_KEY = 0x6465657072  # "deepr"
+
+DB_JOBS = ("deleted", "retention", "attachments", "prompt_blobs")
+JOBS = ("uploads",) + DB_JOBS
+
+GC_DELETED = metrics.counter("deepr_gc_deleted_total", "Rows and uploads removed by maintenance jobs", ["job"])
+GC_BYTES = metrics.counter("deepr_gc_reclaimed_bytes_total", "Bytes reclaimed by maintenance jobs", ["job"])
+
+
+def _report(deleted: int = 0, bytes_: int = 0) -> Dict[str, int]:
+    return {"deleted": deleted, "bytes": bytes_}
+
+
+def _add(report: Dict[str, int], deleted: int, bytes_: int):
+    report["deleted"] += deleted
+    report["bytes"] += bytes_
+
+
+async def _conversation_footprint(db: AsyncSession, conversation_ids: List[int]) -> Dict[str, int]:
+    node_ids = select(Node.id).where(Node.conversation_id.in_(conversation_ids))
+    attachments, attachment_bytes = (await db.execute(
+        select(func.count(Attachment.id), func.coalesce(func.sum(Attachment.file_size), 0))
+        .where(Attachment.node_id.in_(node_ids))
+    )).one()
+    nodes, node_bytes = (await db.execute(
+        select(func.count(Node.id), func.coalesce(func.sum(func.length(Node.content)), 0))
+        .where(Node.conversation_id.in_(conversation_ids))
+    )).one()
+    return {"attachments": attachments, "nodes": nodes, "bytes": int(attachment_bytes) + int(node_bytes)}
+
+
+async def purge_conversations(db: AsyncSession, conversation_ids: List[int], dry_run: bool = False) -> Dict[str, int]:
+    """
+    Delete conversations with their nodes and attachments using set-based
+    statements (nothing is loaded into the session), then commit.
+    Prompt blobs the nodes used are left to the prompt_blobs job.
+    Conversations with a live run are skipped; a later pass takes them.
+    """
+    broker = get_broker()
+    conversation_ids = [cid for cid in conversation_ids if not broker.is_running(cid)]
+    if not conversation_ids:
+        return {"conversations": 0, "attachments": 0, "nodes": 0, "bytes": 0}
+    footprint = await _conversation_footprint(db, conversation_ids)
+    if not dry_run:
+        node_ids = select(Node.id).where(Node.conversation_id.in_(conversation_ids))
+        await db.execute(delete(Attachment).where(Attachment.node_id.in_(node_ids)))
+        # One statement per table: the parent_id self-reference is checked at the end of the statement
+        await db.execute(delete(Node).where(Node.conversation_id.in_(conversation_ids)))
+        await db.execute(delete(Conversation).where(Conversation.id.in_(conversation_ids)))
+        await db.commit()
+    return {"conversations": len(conversation_ids), **footprint}
+
+
+async def purge_deleted_conversations(db: AsyncSession, dry_run: bool = False) -> Dict[str, int]:
+    report = _report()
+    last_id = 0
+    while True:
+        ids = (await db.execute(
+            select(Conversation.id)
+            .where(Conversation.deleted_at.isnot(None), Conversation.id > last_id)
+            .order_by(Conversation.id)
+            .limit(PURGE_BATCH_SIZE)
+        )).scalars().all()
+        if not ids:
+            break
+        purged = await purge_conversations(db, ids, dry_run=dry_run)
+        _add(report, purged["conversations"], purged["bytes"])
+        last_id = ids[-1]
+    return report
+
+
+async def _retention_policies(db: AsyncSession) -> Dict[int, int]:
+    """Retention in days per user, for users whose conversations expire"""
+    stmt = select(User.id, UserSettings.retention_days).outerjoin(UserSettings, UserSettings.user_id == User.id)
+    if RETENTION_DAYS <= 0:
+        stmt = stmt.where(UserSettings.retention_days > 0)
+    policies = {}
+    for user_id, days in (await db.execute(stmt)).all():
+        days = RETENTION_DAYS if days is None else days
+        if days > 0:
+            policies[user_id] = days
+    return policies
+
+
+async def enforce_retention(db: AsyncSession, dry_run: bool = False, now: Optional[datetime] = None) -> Dict[str, int]:
+    now = now or datetime.now(timezone.utc)
+    report = _report()
+    for user_id, days in (await _retention_policies(db)).items():
+        cutoff = now - timedelta(days=days)
+        # Served by ix_nodes_conversation_created_at
+        active = exists().where(Node.conversation_id == Conversation.id, Node.created_at >= cutoff)
+        last_id = 0
+        while True:
+            ids = (await db.execute(
+                select(Conversation.id)
+                .where(Conversation.user_id == user_id, Conversation.created_at < cutoff, ~active, Conversation.id > last_id)
+                .order_by(Conversation.id)
+                .limit(PURGE_BATCH_SIZE)
+            )).scalars().all()
+            if not ids:
+                break
+            purged = await purge_conversations(db, ids, dry_run=dry_run)
+            _add(report, purged["conversations"], purged["bytes"])
+            last_id = ids[-1]
+    return report
+
+
+async def delete_orphaned_attachments(db: AsyncSession, dry_run: bool = False) -> Dict[str, int]:
+    report = _report()
+    last_id = 0
+    while True:
+        rows = (await db.execute(
+            select(Attachment.id, Attachment.file_size)
+            .outerjoin(Node, Node.id == Attachment.node_id)
+            .where(Node.id.is_(None), Attachment.id > last_id)
+            .order_by(Attachment.id)
+            .limit(GC_BATCH_SIZE)
+        )).all()
+        if not rows:
+            break
+        ids = [row[0] for row in rows]
+        if not dry_run:
+            await db.execute(delete(Attachment).where(Attachment.id.in_(ids)))
+            await db.commit()
+        _add(report, len(rows), sum(size or 0 for _, size in rows))
+        last_id = ids[-1]
+    return report
+
+
+async def delete_orphaned_prompt_blobs(db: AsyncSession, dry_run: bool = False, now: Optional[datetime] = None) -> Dict[str, int]:
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(seconds=PROMPT_BLOB_GRACE_SECONDS)
+    unreferenced = ~exists().where(Node.prompt_hash == PromptBlob.hash)
+    report = _report()
+    last_hash = ""
+    while True:
+        rows = (await db.execute(
+            select(PromptBlob.hash, func.length(PromptBlob.data))
+            .where(unreferenced, PromptBlob.created_at < cutoff, PromptBlob.hash > last_hash)
+            .order_by(PromptBlob.hash)
+            .limit(GC_BATCH_SIZE)
+        )).all()
+        if not rows:
+            break
+        sizes = {digest: size or 0 for digest, size in rows}
+        deleted = list(sizes)
+        if not dry_run:
+            # Re-check references: a node may have picked up a blob since it was selected
+            deleted = (await db.execute(
+                delete(PromptBlob).where(PromptBlob.hash.in_(list(sizes)), unreferenced).returning(PromptBlob.hash)
+            )).scalars().all()
+            await db.commit()
+        _add(report, len(deleted), sum(sizes[digest] for digest in deleted))
+        last_hash = rows[-1][0]
+    return report
+
+
+DB_JOB_FUNCTIONS = {
+    "deleted": purge_deleted_conversations,
+    "retention": enforce_retention,
+    "attachments": delete_orphaned_attachments,
+    "prompt_blobs": delete_orphaned_prompt_blobs,
+}
+
+
+async def run_db_jobs(db: AsyncSession, jobs: Iterable[str] = DB_JOBS, dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+    """Run database jobs in dependency order (purges first, so their orphans are collected in the same pass)"""
+    reports = {}
+    for job in DB_JOBS:
+        if job not in jobs:
+            continue
+        started = time.perf_counter()
+        report = await DB_JOB_FUNCTIONS[job](db, dry_run=dry_run)
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        reports[job] = report
+    return reports
+
+
+def _record(reports: Dict[str, Dict[str, int]], dry_run: bool):
+    for job, report in reports.items():
+        if not dry_run:
+            GC_DELETED.inc(report["deleted"], job=job)
+            GC_BYTES.inc(report["bytes"], job=job)
+        if report["deleted"]:
+            logger.info("maintenance %s%s: %d removed, %d bytes", job, " (dry run)" if dry_run else "", report["deleted"], report["bytes"])
+
+
+async def _try_lock(conn) -> bool:
+    if conn.dialect.name != "postgresql":
+        return True
+    return bool((await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY})).scalar())
+
+
+async def run_maintenance(jobs: Iterable[str] = JOBS, dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+    """One maintenance pass with its own sessions; returns a report per job that ran"""
+    from database import AsyncSessionLocal, engine
+
+    jobs = set(jobs)
+    reports = {}
+    if "uploads" in jobs and not dry_run:
+        reports["uploads"] = reap_expired_uploads()
+
+    if jobs & set(DB_JOBS):
+        # Hold the lock on a dedicated connection: sessions return theirs to the pool on every commit
+        async with engine.connect() as lock_conn:
+            if await _try_lock(lock_conn):
+                try:
+                    async with AsyncSessionLocal() as db:
+                        reports.update(await run_db_jobs(db, jobs, dry_run=dry_run))
+                finally:
+                    if lock_conn.dialect.name == "postgresql":
+                        await lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY})
+            else:
+                logger.info("maintenance: database jobs already running on another worker")
+
+    _record(reports, dry_run)
+    return reports
+
+
+_purge_task: Optional[asyncio.Task] = None
+_purge_requested = False
+
+
+async def _purge_until_idle(bind):
+    global _purge_requested
+    session_factory = async_sessionmaker(bind, expire_on_commit=False)
+    while _purge_requested:
+        _purge_requested = False
+        try:
+            async with session_factory() as db:
+                report = await purge_deleted_conversations(db)
+                _record({"deleted": report}, dry_run=False)
+                # Deleted while their run is streaming: wait for the run to end, then purge them
+                remaining = (await db.execute(select(Conversation.id).where(Conversation.deleted_at.isnot(None)))).scalars().all()
+            if any(get_broker().is_running(cid) for cid in remaining):
+                await asyncio.sleep(LIVE_RUN_RECHECK_SECONDS)
+                _purge_requested = True
+        except Exception:
+            logger.exception("purging deleted conversations failed")
+
+
+def schedule_purge(bind) -> asyncio.Task:
+    """
+    Purge soft-deleted conversations in the background, one task per worker.
+    Requests made while the task runs are picked up by its next round, so
+    deletes are never left waiting for the periodic maintenance pass.
+    """
+    global _purge_task, _purge_requested
+    _purge_requested = True
+    if _purge_task is None or _purge_task.done():
+        _purge_task = asyncio.get_running_loop().create_task(_purge_until_idle(bind))
+    return _purge_task
+
+
+class MaintenanceScheduler:
+    """Runs a maintenance pass every `interval` seconds on the worker's event loop"""
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL_SECONDS):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await run_maintenance()
+            except Exception:
+                logger.exception("maintenance pass failed")
+
+
+_scheduler: Optional[MaintenanceScheduler] = None
+
+
+def start_scheduler() -> Optional[MaintenanceScheduler]:
+    """Start periodic maintenance; call from the app's startup hook"""
+    global _scheduler
+    if MAINTENANCE_INTERVAL_SECONDS <= 0:
+        return None
+    _scheduler = MaintenanceScheduler()
+    _scheduler.start()
+    return _scheduler
+
+
+async def stop_scheduler():
+    global _scheduler
+    if _scheduler:
+        await _scheduler.stop()
+        _scheduler = None
+
+
+router = APIRouter(prefix="/admin/maintenance", dependencies=[Depends(get_admin_user)])
+
+
+@router.post("/run")
+async def run_now(job: Optional[List[str]] = Query(None), dry_run: bool = False):
+    jobs = job or JOBS
+    unknown = set(jobs) - set(JOBS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown jobs: {', '.join(sorted(unknown))}")
+    return await run_maintenance(jobs, dry_run=dry_run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--job", action="append", choices=DB_JOBS, help="Job to run (repeatable; default all)")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be removed without deleting")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run_maintenance(args.job or DB_JOBS, dry_run=args.dry_run)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+On-demand memory profiling with tracemalloc.
+
+Admins (ADMIN_EMAILS) can start and stop tracing and dump the top allocation
+sites through /admin/memory, or toggle tracing by sending SIGUSR2 to a worker
+(the top sites are logged when it stops). Every run also gets a memory report:
+attachment bytes loaded, encoded payload bytes sent upstream, ORM objects held
+by its session and, while tracing, the peak traced memory during the run.
+"""
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from auth import get_admin_user
+
+logger = logging.getLogger(__name__)
+
+TRACE_FRAMES = int(os.getenv("DEEPR_TRACEMALLOC_FRAMES", "10"))
+RECENT_RUNS = 50
+
+# Files whose allocations are grouped into the run attribution categories
+_CATEGORY_MARKERS = [
+    ("payloads", ("openrouter_service.py", "base64.py", "/openai/", "/httpx/", "/json/")),
+    ("orm", ("/sqlalchemy/", "/asyncpg/", "/aiosqlite/", "models.py")),
+    ("attachments", ("file_utils.py", "storage.py", "/starlette/datastructures.py", "/multipart/")),
+]
+
+
+class RunMemory:
+    """Memory attributed to one council/superchat run"""
+
+    def __init__(self, conversation_id: Optional[int], method: str):
+        self.conversation_id = conversation_id
+        self.method = method
+        self.attachment_bytes = 0
+        self.payload_bytes = 0
+        self.largest_payload_bytes = 0
+        self.orm_objects: Dict[str, int] = {}
+        self.traced_peak_bytes: Optional[int] = None
+        self.concurrent_runs = 0
+        self.started = time.time()
+        self.seconds = 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            'conversation_id': self.conversation_id,
+            'method': self.method,
+            'started_at': self.started,
+            'seconds': round(self.seconds, 3),
+            'attachment_bytes': self.attachment_bytes,
+            'payload_bytes': self.payload_bytes,
+            'largest_payload_bytes': self.largest_payload_bytes,
+            'orm_objects': self.orm_objects,
+            'traced_peak_bytes': self.traced_peak_bytes,
+            # Traced peaks are process-wide, so overlapping runs share them
+            'concurrent_runs': self.concurrent_runs,
+        }
+
+
+_current_run: ContextVar[Optional[RunMemory]] = ContextVar("deepr_run_memory", default=None)
+_active_runs = 0
+recent_runs: deque = deque(maxlen=RECENT_RUNS)
+
+
+def record_attachment(raw_bytes: int, encoded_bytes: int):
+    """Account an attachment being loaded and encoded into a model request"""
+    run = _current_run.get()
+    if run is not None:
+        run.attachment_bytes += raw_bytes
+        run.payload_bytes += encoded_bytes
+
+
+def record_payload(request_bytes: int):
+    """Account the size of a request body sent to the model provider"""
+    run = _current_run.get()
+    if run is not None:
+        run.largest_payload_bytes = max(run.largest_payload_bytes, request_bytes)
+
+
+@contextmanager
+def track_run_memory(method: str, conversation_id: Optional[int] = None, db=None):
+    global _active_runs
+    run = RunMemory(conversation_id, method)
+    token = _current_run.set(run)
+    _active_runs += 1
+    run.concurrent_runs = _active_runs
+    traced = tracemalloc.is_tracing()
+    if traced:
+        if _active_runs == 1:
+            tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        yield run
+    finally:
+        if traced and tracemalloc.is_tracing():
+            run.traced_peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+        if db is not None:
+            for obj in list(db.identity_map.values()):
+                name = type(obj).__name__
+                run.orm_objects[name] = run.orm_objects.get(name, 0) + 1
+        run.seconds = time.time() - run.started
+        _active_runs -= 1
+        _current_run.reset(token)
+        recent_runs.append(run.to_dict())
+        logger.info("Run memory: %s", run.to_dict())
+
+
+def _category(filename: str) -> str:
+    for category, markers in _CATEGORY_MARKERS:
+        if any(marker in filename for marker in markers):
+            return category
+    return "other"
+
+
+def top_allocations(limit: int = 25, group_by: str = "lineno") -> Dict:
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is not running")
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    stats = snapshot.statistics(group_by)
+
+    categories: Dict[str, int] = {}
+    for stat in snapshot.statistics("filename"):
+        category = _category(stat.traceback[0].filename)
+        categories[category] = categories.get(category, 0) + stat.size
+
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'traced_bytes': current,
+        'peak_traced_bytes': peak,
+        'categories': categories,
+        'top': [
+            {
+                'size_bytes': stat.size,
+                'count': stat.count,
+                'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                'traceback': stat.traceback.format() if group_by == "traceback" else None,
+            }
+            for stat in stats[:limit]
+        ],
+    }
+
+
+def toggle_tracing() -> bool:
+    """Start tracing, or log the top allocation sites and stop; returns whether tracing is now on"""
+    if tracemalloc.is_tracing():
+        for line in (f"{t['size_bytes']:>12} B {t['count']:>8} blocks  {t['location']}" for t in top_allocations(25)['top']):
+            logger.warning("tracemalloc top: %s", line)
+        tracemalloc.stop()
+        return False
+    tracemalloc.start(TRACE_FRAMES)
+    return True
+
+
+def install_signal_handler():
+    """Toggle tracemalloc on SIGUSR2; the toggle runs as a loop callback, not inside the signal handler"""
+    if not hasattr(signal, "SIGUSR2") or threading.current_thread() is not threading.main_thread():
+        return
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGUSR2, lambda: logger.warning("tracemalloc %s", "started" if toggle_tracing() else "stopped")
+    )
+
+
+router = APIRouter(prefix="/admin/memory", dependencies=[Depends(get_admin_user)])
+
+
+@router.post("/start")
+async def start_tracing(frames: int = TRACE_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    return {"tracing": True, "frames": tracemalloc.get_traceback_limit()}
+
+
+@router.post("/stop")
+async def stop_tracing():
+    tracemalloc.stop()
+    return {"tracing": False}
+
+
+@router.get("/snapshot")
+async def get_snapshot(limit: int = 25, group_by: str = "lineno"):
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group_by must be lineno, filename or traceback")
+    return top_allocations(limit, group_by)
+
+
+@router.get("/runs")
+async def get_run_reports() -> List[Dict]:
+    return list(recent_runs)
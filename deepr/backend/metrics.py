@@ -0,0 +1,222 @@
+"""
+In-process metrics with a Prometheus text exposition endpoint.
+Counters, gauges and histograms are kept per worker and scraped from GET /metrics,
+which main.py restricts to admins and DEEPR_METRICS_TOKEN (auth.get_metrics_reader).
+"""
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+import tracing
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._collect = collect
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        values = self._collect() if self._collect else self._values
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(self._key(labels), []))
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {self._sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = (), collect=None) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames, collect=collect))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+
+# --- Upstream model calls ---
+MODEL_CALL_DURATION = histogram("deepr_model_call_duration_seconds", "Duration of OpenRouter calls", ["model", "outcome"])
+MODEL_TTFT = histogram("deepr_model_ttft_seconds", "Time until the first response bytes of an OpenRouter call arrive", ["model"])
+MODEL_TOKENS = counter("deepr_model_tokens_total", "Tokens reported by OpenRouter usage", ["model", "direction"])
+MODEL_COST = counter("deepr_model_cost_usd_total", "Cost reported by OpenRouter usage", ["model"])
+MODEL_ERRORS = counter("deepr_model_errors_total", "Failed OpenRouter calls", ["model", "error"])
+MODEL_RETRIES = counter("deepr_model_retries_total", "HTTP retries made by the OpenAI client", ["model"])
+MEMBER_TIMEOUTS = counter("deepr_member_timeouts_total", "Council member calls cancelled at the run deadline", ["model", "phase"])
+
+# --- Runs and streams ---
+PHASE_DURATION = histogram("deepr_phase_duration_seconds", "Duration of each run phase", ["method", "phase"])
+RUNS_IN_FLIGHT = gauge("deepr_runs_in_flight", "Runs currently executing", ["method"])
+SSE_CONNECTIONS = gauge("deepr_sse_connections", "Open server-sent event streams")
+SSE_CONNECTIONS.set(0)
+
+
+def _collect_db_pool() -> Dict[Tuple[str, ...], float]:
+    from database import engine
+    pool = engine.sync_engine.pool
+    values = {}
+    for state in ("checkedout", "checkedin", "overflow", "size"):
+        fn = getattr(pool, state, None)
+        if callable(fn):
+            values[(state,)] = fn()
+    return values
+
+
+def _collect_temp_uploads() -> Dict[Tuple[str, ...], float]:
+    from file_utils import temp_storage
+    return {(): sum(info.get('file_size', 0) for info in list(temp_storage.values()))}
+
+
+DB_POOL = gauge("deepr_db_pool_connections", "Database connection pool usage", ["state"], collect=_collect_db_pool)
+TEMP_UPLOAD_BYTES = gauge("deepr_temp_upload_bytes", "Bytes held in temporary upload storage", collect=_collect_temp_uploads)
+
+
+@contextmanager
+def observe_phase(method: str, phase: str):
+    """Record the wall-clock duration of a run phase, traced as a span"""
+    start = time.perf_counter()
+    try:
+        with tracing.span(f"{method}.{phase}", **{"deepr.method": method, "deepr.phase": phase}):
+            yield
+    finally:
+        PHASE_DURATION.observe(time.perf_counter() - start, method=method, phase=phase)
+
+
+@contextmanager
+def track_stream(method: str):
+    """Count an open SSE stream and its in-flight run"""
+    SSE_CONNECTIONS.inc()
+    RUNS_IN_FLIGHT.inc(method=method)
+    try:
+        yield
+    finally:
+        RUNS_IN_FLIGHT.dec(method=method)
+        SSE_CONNECTIONS.dec()
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
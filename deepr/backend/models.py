@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Enum, Text, DateTime, Float, LargeBinary
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Enum, Text, DateTime, Float, LargeBinary, Index, DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql import func
 import enum
 from database import Base
@@ -15,6 +16,10 @@ class NodeType(enum.Enum):
     REFINEMENT = "refinement"
     VERDICT = "verdict"
 
+# Full-text search vectors are maintained by Postgres triggers (see SEARCH_TRIGGERS below);
+# on SQLite the column is plain, always-NULL text and search falls back to LIKE scans
+SearchVector = TSVECTOR().with_variant(Text(), "sqlite")
+
 class User(Base):
     __tablename__ = "users"
 
@@ -32,6 +37,7 @@ class UserSettings(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), unique=True)
     encrypted_api_key = Column(String, nullable=True)
+    retention_days = Column(Integer, nullable=True)  # Delete conversations older than this; None uses DEEPR_RETENTION_DAYS
 
     user = relationship("User", back_populates="settings")
 
@@ -43,6 +49,12 @@ class Conversation(Base):
     title = Column(String)
     method = Column(String, default="dag") # dag or ensemble
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    deleted_at = Column(DateTime(timezone=True), nullable=True, index=True)  # Set on delete; rows are purged in the background
+    search_vector = deferred(Column(SearchVector, nullable=True))  # Title, maintained by trigger
+
+    __table_args__ = (
+        Index("ix_conversations_search_vector", "search_vector", postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
 
     user = relationship("User", back_populates="conversations")
     nodes = relationship("Node", back_populates="conversation", cascade="all, delete-orphan")
@@ -55,18 +67,57 @@ class Node(Base):
     parent_id = Column(Integer, ForeignKey("nodes.id"), nullable=True)
     type = Column(String) # Storing enum as string for simplicity with SQLite
     content = Column(Text)
+    content_encoding = Column(String, nullable=True)  # None for full text, "delta" for a line delta against the parent node
     model_name = Column(String, nullable=True) # Metadata about which model generated this
     attachment_filenames = Column(Text, nullable=True)  # Comma-separated list of attachment filenames
-    prompt_sent = Column(Text, nullable=True)  # Full prompt sent to the model
+    prompt_sent = Column(Text, nullable=True)  # Full prompt sent to the model (nodes written before prompt_blobs)
+    prompt_hash = Column(String(64), ForeignKey("prompt_blobs.hash"), nullable=True, index=True)  # Prompt sent to the model
     estimated_cost = Column(Float, nullable=True)  # Estimated cost before API call
     actual_cost = Column(Float, nullable=True)  # Actual cost from OpenRouter response
     warnings = Column(Text, nullable=True)  # JSON array of warning messages
+    request_started_at = Column(DateTime(timezone=True), nullable=True)  # Model request sent
+    first_token_at = Column(DateTime(timezone=True), nullable=True)  # First response bytes received
+    completed_at = Column(DateTime(timezone=True), nullable=True)  # Model response complete
+    persisted_at = Column(DateTime(timezone=True), nullable=True)  # Node written to the database
+    retry_count = Column(Integer, nullable=True)  # HTTP retries made for the model call
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    search_vector = deferred(Column(SearchVector, nullable=True))  # Content, maintained by trigger
+
+    __table_args__ = (
+        Index("ix_nodes_search_vector", "search_vector", postgresql_using="gin").ddl_if(dialect="postgresql"),
+        # Last activity of a conversation, for retention
+        Index("ix_nodes_conversation_created_at", "conversation_id", "created_at"),
+    )
+
+    # Prompt text of nodes created by this process, so streamed events need no blob lookup
+    # (storage.resolve_node_prompts loads it for nodes read from the database)
+    prompt_text = None
 
     conversation = relationship("Conversation", back_populates="nodes")
     children = relationship("Node", backref="parent", remote_side=[id])
     attachments = relationship("Attachment", back_populates="node", cascade="all, delete-orphan")
 
+class PromptBlob(Base):
+    __tablename__ = "prompt_blobs"
+
+    hash = Column(String(64), primary_key=True)  # SHA-256 of the UTF-8 prompt text
+    encoding = Column(String(10), nullable=False)  # 'zstd' or 'zlib'
+    data = Column(LargeBinary, nullable=False)  # Compressed prompt text
+    size = Column(Integer, nullable=False)  # Uncompressed size in bytes
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class ModelStat(Base):
+    __tablename__ = "model_stats"
+
+    # Rolling (EWMA) call statistics per model, maintained by routing
+    model = Column(String(255), primary_key=True)
+    latency_seconds = Column(Float, nullable=True)  # Successful calls only
+    ttft_seconds = Column(Float, nullable=True)
+    error_rate = Column(Float, nullable=False, default=0.0)
+    cost_per_1k_tokens = Column(Float, nullable=True)  # USD
+    calls = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
 class Attachment(Base):
     __tablename__ = "attachments"
 
@@ -77,7 +128,60 @@ class Attachment(Base):
     mime_type = Column(String(100), nullable=False)  # 'image/jpeg', 'application/pdf', etc.
     file_data = Column(LargeBinary, nullable=False)  # Binary file data
     file_size = Column(Integer, nullable=False)  # Size in bytes
+    extracted_text = Column(Text, nullable=True)  # Plain text of text and PDF files, extracted on save
+    page_count = Column(Integer, nullable=True)  # PDF pages
+    token_estimate = Column(Integer, nullable=True)  # Approximate tokens of extracted_text
+    width = Column(Integer, nullable=True)  # Image dimensions
+    height = Column(Integer, nullable=True)
+    thumbnail = deferred(Column(LargeBinary, nullable=True))  # Small WebP preview of images, made on save
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     node = relationship("Node", back_populates="attachments")
 
+# Keep search vectors current on Postgres databases created with create_all;
+# migrated databases get the same functions and triggers from revision e5f6a7b8c9d0.
+# One statement per entry: asyncpg cannot run several in one prepared statement.
+SEARCH_TRIGGERS = {
+    Conversation.__table__: [
+        """
+        CREATE OR REPLACE FUNCTION deepr_conversations_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER conversations_search_vector_update BEFORE INSERT OR UPDATE OF title ON conversations
+            FOR EACH ROW EXECUTE FUNCTION deepr_conversations_search_vector_update()
+        """,
+    ],
+    Node.__table__: [
+        """
+        CREATE OR REPLACE FUNCTION deepr_node_search_text(content text, content_encoding text) RETURNS text AS $$
+            SELECT CASE WHEN content_encoding = 'delta' THEN (
+                -- Deltas are JSON lists; index the lines they insert
+                SELECT coalesce(string_agg(line, ''), '')
+                FROM jsonb_array_elements(content::jsonb) AS ops(op),
+                     jsonb_array_elements_text(CASE WHEN jsonb_typeof(op) = 'array' THEN op ELSE '[]'::jsonb END) AS lines(line)
+            ) ELSE coalesce(content, '') END
+        $$ LANGUAGE sql IMMUTABLE
+        """,
+        """
+        CREATE OR REPLACE FUNCTION deepr_nodes_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := setweight(to_tsvector('english', deepr_node_search_text(NEW.content, NEW.content_encoding)), 'B');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER nodes_search_vector_update BEFORE INSERT OR UPDATE OF content, content_encoding ON nodes
+            FOR EACH ROW EXECUTE FUNCTION deepr_nodes_search_vector_update()
+        """,
+    ],
+}
+
+for _table, _statements in SEARCH_TRIGGERS.items():
+    for _statement in _statements:
+        event.listen(_table, "after_create", DDL(_statement).execute_if(dialect="postgresql"))
@@ -1,15 +1,53 @@
+import asyncio
 import httpx
 import os
 import json
 import base64
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from contextvars import ContextVar
 from typing import List, Dict, AsyncGenerator, Optional, Tuple
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from encryption import decrypt_key
 from models import User
 from fastapi import HTTPException
+import metrics
+import tracing
+import memory_profiling
+import prompt_cache
+import images
+import retrieval
+import routing
+from extraction import attachment_text, send_pdf_as_text
+
+logger = logging.getLogger(__name__)
 
 # Global cache for models (per user)
 _CACHED_MODELS_BY_USER = {}
+# Capabilities by model id, from whichever user's model list was fetched last
+_CAPABILITIES_BY_MODEL: Dict[str, Dict] = {}
+
+# HTTP attempts and first-response time of the OpenRouter call running in the current task
+_call_stats: ContextVar[Optional[Dict]] = ContextVar("openrouter_call_stats", default=None)
+
+async def _on_http_request(request):
+    stats = _call_stats.get()
+    if stats is not None:
+        # Only the attempt that finally succeeds counts towards time to first byte
+        stats['attempts'] += 1
+        stats['first_byte_at'] = None
+        try:
+            stats['request_bytes'] = len(request.content)
+        except httpx.RequestNotRead:
+            stats['request_bytes'] = 0
+        memory_profiling.record_payload(stats['request_bytes'])
+
+async def _on_http_response(response):
+    stats = _call_stats.get()
+    if stats is not None:
+        stats['first_byte_at'] = time.perf_counter()
+        stats['response_bytes'] = int(response.headers.get('content-length', 0))
 
 def clear_model_cache(user_id: int):
     """Clear cached models for a specific user to force refresh"""
@@ -31,7 +69,8 @@ async def fetch_models_from_api(current_user: User):
     try:
         async with httpx.AsyncClient() as client:
             headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}            
-            response = await client.get("https://openrouter.ai/api/v1/models/user", headers=headers)            
+            base_url = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+            response = await client.get(f"{base_url}/models/user", headers=headers)            
             response.raise_for_status()
             data = response.json()
             api_models = data.get('data', [])            
@@ -71,6 +110,7 @@ async def fetch_models_from_api(current_user: User):
             # Update globals
             global _CACHED_MODELS_BY_USER
             _CACHED_MODELS_BY_USER[current_user.id] = models_list            
+            _CAPABILITIES_BY_MODEL.update((m['id'], m['capabilities']) for m in models_list)
             
             return models_list
             
@@ -85,6 +125,10 @@ async def get_available_models(current_user: User):
         await fetch_models_from_api(current_user)
     return _CACHED_MODELS_BY_USER.get(current_user.id, [])
 
+def model_capabilities(model_id: str) -> Dict:
+    """Capabilities of a model from any fetched model list; empty if unknown"""
+    return _CAPABILITIES_BY_MODEL.get(model_id, {})
+
 def get_unsupported_attachments(model_id: str, attachments: List, user_id: int = None) -> List[str]:
     """
     Get list of warnings for unsupported attachments.    
@@ -110,7 +154,11 @@ def get_unsupported_attachments(model_id: str, attachments: List, user_id: int =
     
     # Count attachment types
     image_count = sum(1 for att in attachments if att.file_type == 'image')
-    file_count = sum(1 for att in attachments if att.file_type == 'file')
+    # PDFs sent as their extracted text need no file support
+    file_count = sum(
+        1 for att in attachments
+        if att.file_type == 'file' or (att.file_type == 'pdf' and not send_pdf_as_text(att, caps.get('file')))
+    )
     audio_count = sum(1 for att in attachments if att.file_type == 'audio')
     video_count = sum(1 for att in attachments if att.file_type == 'video')
     
@@ -137,12 +185,101 @@ def get_unsupported_attachments(model_id: str, attachments: List, user_id: int =
         )           
     return warnings
 
+def build_messages_with_attachments(messages: List[Dict], attachments: Optional[List], model: Optional[str] = None) -> List[Dict]:
+    """
+    Expand the first user message into a content array carrying the attachments.
+    Attachments go only there, ahead of its text, so they are part of the cacheable
+    prompt prefix (see prompt_cache) and are not repeated for later user messages.
+    Text files, and PDFs for models that should get text (see extraction), are
+    sent as their extracted text. Messages are updated in place and returned.
+    """
+    if attachments:
+        file_supported = model_capabilities(model).get('file') if model else None
+        # Process messages to include attachments
+        for msg in messages:
+            if msg.get('role') == 'user':
+                # Convert string content to array format
+                if isinstance(msg.get('content'), str):
+                    text_content = msg['content']
+                    content_array = []
+
+                    # Add attachments
+                    for att in attachments:
+                        if att.file_type == 'text':
+                            content_array.append({"type": "text", "text": attachment_text(att)})
+                            continue
+                        if send_pdf_as_text(att, file_supported):
+                            content_array.append({
+                                "type": "text",
+                                "text": f"Contents of {att.filename}:\n\n{att.extracted_text}"
+                            })
+                            continue
+
+                        with tracing.span("attachment.encode", **{"attachment.type": att.file_type, "attachment.bytes": len(att.file_data)}):
+                            base64_data = base64.b64encode(att.file_data).decode('utf-8')
+                        memory_profiling.record_attachment(len(att.file_data), len(base64_data))
+
+                        if att.file_type == 'image':
+                            content_array.append({
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:{att.mime_type};base64,{base64_data}"
+                                }
+                            })
+                        elif att.file_type == 'file' or att.file_type == 'pdf':
+                            content_array.append({
+                                "type": "file",
+                                "file": {
+                                    "filename": getattr(att, 'filename', 'document.pdf'),
+                                    "file_data": f"data:{att.mime_type};base64,{base64_data}"
+                                }
+                            })
+                        elif att.file_type == 'audio':
+                            # Map mime_type to format (mp3 or wav typically)
+                            audio_format = 'mp3'
+                            if 'wav' in att.mime_type:
+                                audio_format = 'wav'
+                            elif 'ogg' in att.mime_type:
+                                audio_format = 'oga' # OpenAI uses 'oga' for ogg? or 'ogg'. OpenRouter docs say 'ogg' supported but OpenAI 'input_audio' spec often asks for 'wav' or 'mp3'.
+                                # Let's fallback to 'wav' if unsure or keep 'mp3' as safe default if transcoded.
+                                # Actually, let's just use the subtype.
+                                audio_format = att.mime_type.split('/')[-1]
+
+                            content_array.append({
+                                "type": "input_audio",
+                                "input_audio": {
+                                    "data": base64_data, # Raw base64, no data: prefix
+                                    "format": audio_format
+                                }
+                            })
+                        elif att.file_type == 'video':
+                            content_array.append({
+                                "type": "video_url",
+                                "video_url": {
+                                    "url": f"data:{att.mime_type};base64,{base64_data}"
+                                }
+                            })
+                        else:
+                            content_array.append({
+                                "type": "text",
+                                "text": att.file_data.decode('utf-8')
+                            })
+
+                    content_array.append({"type": "text", "text": text_content})
+                    msg['content'] = content_array
+                break
+
+    return messages
+
 class OpenRouterClient:
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.client = AsyncOpenAI(
             base_url=os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
             api_key=api_key,
+            http_client=DefaultAsyncHttpxClient(
+                event_hooks={'request': [_on_http_request], 'response': [_on_http_response]}
+            ),
         )
 
     async def get_models(self):
@@ -158,7 +295,7 @@ class OpenRouterClient:
             )
             return response
         except Exception as e:
-            print(f"Error calling {model}: {e}")
+            logger.error("Error calling %s: %s", model, e)
             raise
 
     async def chat_completion_details(
@@ -169,67 +306,11 @@ class OpenRouterClient:
         stream: bool = False
     ) -> Tuple[any, Dict]:
 
-        if attachments:
-            # Process messages to include attachments
-            for msg in messages:
-                if msg.get('role') == 'user':
-                    # Convert string content to array format
-                    if isinstance(msg.get('content'), str):
-                        text_content = msg['content']
-                        content_array = [{"type": "text", "text": text_content}]
-                        
-                        # Add attachments
-                        for att in attachments:
-                            base64_data = base64.b64encode(att.file_data).decode('utf-8')
-                            
-                            if att.file_type == 'image':
-                                content_array.append({
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:{att.mime_type};base64,{base64_data}"
-                                    }
-                                })
-                            elif att.file_type == 'file' or att.file_type == 'pdf':
-                                content_array.append({
-                                    "type": "file",
-                                    "file": {
-                                        "filename": getattr(att, 'filename', 'document.pdf'),
-                                        "file_data": f"data:{att.mime_type};base64,{base64_data}"
-                                    }
-                                })
-                            elif att.file_type == 'audio':
-                                # Map mime_type to format (mp3 or wav typically)
-                                audio_format = 'mp3'
-                                if 'wav' in att.mime_type:
-                                    audio_format = 'wav'
-                                elif 'ogg' in att.mime_type:
-                                    audio_format = 'oga' # OpenAI uses 'oga' for ogg? or 'ogg'. OpenRouter docs say 'ogg' supported but OpenAI 'input_audio' spec often asks for 'wav' or 'mp3'.
-                                    # Let's fallback to 'wav' if unsure or keep 'mp3' as safe default if transcoded.
-                                    # Actually, let's just use the subtype.
-                                    audio_format = att.mime_type.split('/')[-1]
-
-                                content_array.append({
-                                    "type": "input_audio",
-                                    "input_audio": {
-                                        "data": base64_data, # Raw base64, no data: prefix
-                                        "format": audio_format
-                                    }
-                                })
-                            elif att.file_type == 'video':
-                                content_array.append({
-                                    "type": "video_url",
-                                    "video_url": {
-                                        "url": f"data:{att.mime_type};base64,{base64_data}"
-                                    }
-                                })
-                            else:
-                                content_array.append({
-                                    "type": "text",
-                                    "text": att.file_data.decode('utf-8')
-                                })
-                        
-                        msg['content'] = content_array
-        
+        attachments = await images.prepare_images(attachments, model)
+        attachments = await retrieval.prepare_text(attachments, messages, model_capabilities(model).get('file'))
+        build_messages_with_attachments(messages, attachments, model)
+        prompt_cache.add_cache_breakpoints(model, messages)
+
         # Determine referer
         # Determine referer
         host = os.getenv("HOST_IP")
@@ -237,19 +318,47 @@ class OpenRouterClient:
         referer = f"http://{host}:{port}"
 
         # Make the API call        
-        response = await self.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=stream,
-            extra_headers={
-                "HTTP-Referer": referer,
-                "X-Title": "DeepR Council"
-            }
-        )
+        stats = {'attempts': 0, 'first_byte_at': None, 'request_bytes': 0, 'response_bytes': 0}
+        stats_token = _call_stats.set(stats)
+        started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        call_span = tracing.start_span("openrouter.chat_completion", **{"llm.model": model, "llm.stream": stream})
+        try:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=stream,
+                extra_headers={
+                    "HTTP-Referer": referer,
+                    "X-Title": "DeepR Council"
+                }
+            )
+        except Exception as e:
+            metrics.MODEL_ERRORS.inc(model=model, error=type(e).__name__)
+            metrics.MODEL_CALL_DURATION.observe(time.perf_counter() - started, model=model, outcome="error")
+            routing.record_error(model, time.perf_counter() - started, e)
+            tracing.end_span(call_span, e)
+            raise
+        except asyncio.CancelledError as e:
+            # A run deadline gave up on the call; not the model's failure, so routing leaves it out
+            metrics.MODEL_CALL_DURATION.observe(time.perf_counter() - started, model=model, outcome="cancelled")
+            call_span.set_attribute("llm.cancelled", True)
+            tracing.end_span(call_span, e)
+            raise
+        finally:
+            _call_stats.reset(stats_token)
+            if stats['attempts'] > 1:
+                metrics.MODEL_RETRIES.inc(stats['attempts'] - 1, model=model)
+
+        elapsed = time.perf_counter() - started
+        metrics.MODEL_CALL_DURATION.observe(elapsed, model=model, outcome="ok")
+        if stats['first_byte_at'] is not None:
+            metrics.MODEL_TTFT.observe(stats['first_byte_at'] - started, model=model)
         
         # Extract token counts from response
         input_tokens = 0
         output_tokens = 0
+        cached_tokens = 0
         actual_cost = 0.0 # Initialize variable
         
         if hasattr(response, 'usage') and response.usage:
@@ -260,6 +369,7 @@ class OpenRouterClient:
             try:
                 # Convert usage to dict to access extra fields
                 usage_data = response.usage.model_dump() if hasattr(response.usage, 'model_dump') else response.usage.__dict__                
+                cached_tokens = prompt_cache.cached_tokens(usage_data)
                 if 'cost' in usage_data:
                     actual_cost = float(usage_data['cost'])
                 elif 'total_cost' in usage_data:
@@ -273,16 +383,46 @@ class OpenRouterClient:
             except Exception as e:
                 pass
 
+        metrics.MODEL_TOKENS.inc(input_tokens or 0, model=model, direction="input")
+        metrics.MODEL_TOKENS.inc(output_tokens or 0, model=model, direction="output")
+        metrics.MODEL_TOKENS.inc(cached_tokens, model=model, direction="cached_input")
+        metrics.MODEL_COST.inc(actual_cost, model=model)
+        routing.record_call(
+            model, elapsed, ok=True,
+            ttft=stats['first_byte_at'] - started if stats['first_byte_at'] is not None else None,
+            cost=actual_cost, tokens=(input_tokens or 0) + (output_tokens or 0),
+        )
+
+        call_span.set_attributes({
+            "llm.input_tokens": input_tokens or 0,
+            "llm.output_tokens": output_tokens or 0,
+            "llm.cached_input_tokens": cached_tokens,
+            "llm.cost_usd": actual_cost,
+            "llm.retries": max(stats['attempts'] - 1, 0),
+            "http.request_bytes": stats['request_bytes'],
+            "http.response_bytes": stats['response_bytes'],
+        })
+        tracing.end_span(call_span)
+
         # Return response and cost info
         cost_info = {
             'actual_cost': actual_cost,
             'input_tokens': input_tokens,
-            'output_tokens': output_tokens
+            'output_tokens': output_tokens,
+            'cached_tokens': cached_tokens,
+            # Timeline of the call, persisted on the resulting node
+            'request_started_at': started_at,
+            'first_token_at': started_at + timedelta(seconds=stats['first_byte_at'] - started) if stats['first_byte_at'] is not None else None,
+            'completed_at': started_at + timedelta(seconds=elapsed),
+            'retry_count': max(stats['attempts'] - 1, 0)
         }
         
         return response, cost_info
 
     async def stream_chat_completion(self, model: str, messages: List[Dict]) -> AsyncGenerator[str, None]:
+        started = time.perf_counter()
+        first_token = True
+        ttft = None
         try:
             stream = await self.client.chat.completions.create(
                 model=model,
@@ -292,7 +432,16 @@ class OpenRouterClient:
             async for chunk in stream:
                 content = chunk.choices[0].delta.content
                 if content:
+                    if first_token:
+                        ttft = time.perf_counter() - started
+                        metrics.MODEL_TTFT.observe(ttft, model=model)
+                        first_token = False
                     yield content
+            metrics.MODEL_CALL_DURATION.observe(time.perf_counter() - started, model=model, outcome="ok")
+            routing.record_call(model, time.perf_counter() - started, ok=True, ttft=ttft)
         except Exception as e:
-            print(f"Error streaming {model}: {e}")
+            metrics.MODEL_ERRORS.inc(model=model, error=type(e).__name__)
+            metrics.MODEL_CALL_DURATION.observe(time.perf_counter() - started, model=model, outcome="error")
+            routing.record_error(model, time.perf_counter() - started, e)
+            logger.error("Error streaming %s: %s", model, e)
             yield f"[Error: {str(e)}]"
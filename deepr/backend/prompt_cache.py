@@ -0,0 +1,85 @@
+"""
+Prompt layout that lets providers reuse cached prompt prefixes.
+
+Every model call of a run is built from the same stable prefix followed by a
+role-specific suffix:
+  1. system message, identical for every call,
+  2. request message: the user's request, carrying the attachments,
+  3. optional context message: material shared by a phase (plan, findings, the draft under review),
+  4. instructions message: what this particular role has to do.
+Providers with automatic prefix caching (OpenAI, DeepSeek, Gemini, ...) then
+reuse 1-3 across the parallel calls of a phase and 1-2 across the whole run.
+For providers that need explicit breakpoints (Anthropic, Gemini through
+OpenRouter), `add_cache_breakpoints` marks the end of messages 2 and 3 with
+`cache_control`. Cached prompt tokens are read back with `cached_tokens`.
+"""
+import os
+from typing import Dict, List, Optional
+
+PROMPT_CACHE_ENABLED = os.getenv("DEEPR_PROMPT_CACHE", "true").lower() in ("1", "true", "yes")
+# Models that only cache prompts at explicit cache_control breakpoints
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+# Anthropic honours at most four breakpoints per request
+MAX_BREAKPOINTS = 4
+
+SYSTEM_PROMPT = (
+    "You are a member of DeepR, a council of AI models that research, review and "
+    "synthesize answers together. The user's request and any shared material come "
+    "first; your role and task are given in the last message."
+)
+
+
+def build_messages(request: str, instructions: str, context: Optional[str] = None) -> List[Dict]:
+    """Stable prefix (system, request, shared context) followed by the role-specific instructions"""
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"User Request:\n{request}"},
+    ]
+    if context:
+        messages.append({"role": "user", "content": context})
+    messages.append({"role": "user", "content": instructions})
+    return messages
+
+
+def render(messages: List[Dict]) -> str:
+    """Text of the messages after the system prompt, as stored in Node.prompt_sent"""
+    parts = []
+    for msg in messages:
+        if msg.get('role') == 'system':
+            continue
+        content = msg.get('content')
+        if isinstance(content, str):
+            parts.append(content.strip())
+        else:
+            parts.extend(part['text'].strip() for part in content or [] if part.get('type') == 'text')
+    return "\n\n".join(parts)
+
+
+def supports_cache_control(model: str) -> bool:
+    return PROMPT_CACHE_ENABLED and model.startswith(CACHE_CONTROL_MODEL_PREFIXES)
+
+
+def add_cache_breakpoints(model: str, messages: List[Dict]) -> List[Dict]:
+    """
+    Mark the end of every user message before the last one as a cache breakpoint.
+    Only applied to models that need explicit breakpoints; messages are updated in place.
+    """
+    if not supports_cache_control(model):
+        return messages
+    prefix = [msg for msg in messages[:-1] if msg.get('role') == 'user']
+    for msg in prefix[-MAX_BREAKPOINTS:]:
+        if isinstance(msg.get('content'), str):
+            msg['content'] = [{"type": "text", "text": msg['content']}]
+        # Attachments precede the text, so a breakpoint on the last text part covers them too
+        text_parts = [part for part in msg['content'] if part.get('type') == 'text']
+        if text_parts:
+            text_parts[-1]['cache_control'] = {"type": "ephemeral"}
+    return messages
+
+
+def cached_tokens(usage_data: Dict) -> int:
+    """Prompt tokens served from the provider's cache, from an OpenAI-style usage payload"""
+    details = usage_data.get('prompt_tokens_details') or {}
+    if isinstance(details, dict):
+        return int(details.get('cached_tokens') or 0)
+    return int(getattr(details, 'cached_tokens', 0) or 0)
@@ -0,0 +1,328 @@
+"""
+Run event fan-out so any worker can serve a live subscription to any running conversation.
+
+The run that produces events publishes them through `publish_run`; subscribers
+read them from `GET /runs/{conversation_id}/events`. Each worker keeps a short
+replay buffer per run, so a reconnect with Last-Event-ID resumes where it left off.
+Event ids restart at 1 with every run; the first event of a new run of the same
+conversation (the next SuperChat turn) replaces the previous run's buffer.
+A run that sends nothing for STALE_RUN_SECONDS is presumed dead (its worker went
+away without a terminal event): its buffer is dropped and subscribers get an error.
+
+Brokers (DEEPR_PUBSUB):
+- "memory": in-process only, enough for a single worker.
+- "postgres": events are sent with NOTIFY on the `deepr_run_events` channel and
+  every worker LISTENs, so subscriptions work across workers and replicas.
+- "auto" (default): postgres when DATABASE_URL points at Postgres, memory otherwise.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_BACKEND = os.getenv("DEEPR_PUBSUB", "auto").lower()
+CHANNEL = "deepr_run_events"
+REPLAY_EVENTS = 1000
+# How long a finished run can still be replayed
+FINISHED_RETENTION_SECONDS = 120
+# A run silent for this long is presumed dead (its worker went away without a terminal event)
+STALE_RUN_SECONDS = 900
+SUBSCRIBER_QUEUE_SIZE = 1000
+# NOTIFY payloads are limited to 8000 bytes; leave room for the part header
+NOTIFY_CHUNK_BYTES = 7000
+# The parts of an event are sent in one transaction; parts still waiting for the rest after
+# this long were lost (e.g. during a listener reconnect)
+PARTIAL_EVENT_SECONDS = 30
+MAX_PARTIAL_EVENTS = 256
+TERMINAL_EVENTS = ("done", "error")
+
+RunEvent = Tuple[int, Dict]
+# Queued to subscribers of a run that went stale
+_RUN_LOST = object()
+
+
+class RunChannel:
+    def __init__(self):
+        self.buffer: Deque[RunEvent] = deque(maxlen=REPLAY_EVENTS)
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.finished_at: Optional[float] = None
+        self.updated_at = time.monotonic()
+
+
+class InProcessBroker:
+    def __init__(self):
+        self._channels: Dict[int, RunChannel] = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def has_run(self, conversation_id: int) -> bool:
+        self._sweep()
+        return conversation_id in self._channels
+
+    def is_running(self, conversation_id: int) -> bool:
+        """Whether a run of the conversation is still producing events (on any worker, with the postgres broker)"""
+        channel = self._channels.get(conversation_id)
+        return (
+            channel is not None and channel.finished_at is None
+            and time.monotonic() - channel.updated_at < STALE_RUN_SECONDS
+        )
+
+    async def publish(self, conversation_id: int, event_id: int, event: Dict):
+        self._deliver(conversation_id, event_id, event)
+
+    def _deliver(self, conversation_id: int, event_id: int, event: Dict):
+        channel = self._channels.get(conversation_id)
+        if channel is not None and event_id == 1:
+            # A new run of the conversation (e.g. the next SuperChat turn): ids restart, so the
+            # previous run's buffer must not be replayed or mistaken for events already seen
+            self._close(channel)
+            channel = None
+        if channel is None:
+            self._sweep()
+            channel = self._channels[conversation_id] = RunChannel()
+        channel.buffer.append((event_id, event))
+        channel.updated_at = time.monotonic()
+        if event.get('type') in TERMINAL_EVENTS:
+            channel.finished_at = time.monotonic()
+        for queue in list(channel.subscribers):
+            try:
+                queue.put_nowait((event_id, event))
+            except asyncio.QueueFull:
+                # The subscriber is told to reconnect and resumes from the replay buffer
+                channel.subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def _close(self, channel: RunChannel, item=None):
+        # Subscribers still following an unfinished run reconnect and pick up the new one
+        for queue in list(channel.subscribers):
+            channel.subscribers.discard(queue)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    def _sweep(self):
+        now = time.monotonic()
+        for conversation_id, channel in list(self._channels.items()):
+            if channel.finished_at is None:
+                if now - channel.updated_at >= STALE_RUN_SECONDS:
+                    logger.warning("Run of conversation %s sent nothing for %ss; dropping it", conversation_id, STALE_RUN_SECONDS)
+                    self._close(channel, _RUN_LOST)
+                    del self._channels[conversation_id]
+            elif now - channel.finished_at > FINISHED_RETENTION_SECONDS and not channel.subscribers:
+                del self._channels[conversation_id]
+
+    async def subscribe(self, conversation_id: int, last_event_id: int = 0) -> AsyncIterator[RunEvent]:
+        """Replay buffered events after last_event_id, then follow the run until it finishes"""
+        channel = self._channels.get(conversation_id)
+        if channel is None:
+            return
+        queue: asyncio.Queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        channel.subscribers.add(queue)
+        try:
+            for event_id, event in list(channel.buffer):
+                if event_id > last_event_id:
+                    last_event_id = event_id
+                    yield event_id, event
+            if channel.finished_at is not None:
+                return
+            while True:
+                if self._channels.get(conversation_id) is channel:
+                    # Wake up when the run would go stale, in case nothing else sweeps it
+                    timeout = max(channel.updated_at + STALE_RUN_SECONDS - time.monotonic(), 0.0)
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        self._sweep()
+                        continue
+                else:
+                    item = await queue.get()
+                if item is None:
+                    yield last_event_id, {'type': 'error', 'message': 'Subscription fell behind; reconnect to resume'}
+                    return
+                if item is _RUN_LOST:
+                    yield last_event_id, {'type': 'error', 'message': 'Run stopped without finishing'}
+                    return
+                event_id, event = item
+                if event_id <= last_event_id:
+                    continue
+                last_event_id = event_id
+                yield event_id, event
+                if event.get('type') in TERMINAL_EVENTS:
+                    return
+        finally:
+            channel.subscribers.discard(queue)
+
+
+def encode_notifications(origin: str, conversation_id: int, event_id: int, event: Dict) -> List[str]:
+    """Split one event into NOTIFY payloads: `origin conversation event part/parts|data`"""
+    data = json.dumps(event, separators=(",", ":"))  # ASCII-only, so characters are bytes
+    chunks = [data[i:i + NOTIFY_CHUNK_BYTES] for i in range(0, len(data), NOTIFY_CHUNK_BYTES)] or [""]
+    return [
+        f"{origin} {conversation_id} {event_id} {part}/{len(chunks)}|{chunk}"
+        for part, chunk in enumerate(chunks, 1)
+    ]
+
+
+class NotificationAssembler:
+    """Reassemble multi-part NOTIFY payloads into events"""
+
+    def __init__(self):
+        # (origin, conversation, event) -> (time of the first part, parts so far), oldest first
+        self._partial: Dict[Tuple[str, int, int], Tuple[float, List[str]]] = {}
+
+    def clear(self):
+        self._partial.clear()
+
+    def _expire(self, now: float):
+        while self._partial:
+            key, (started_at, _) = next(iter(self._partial.items()))
+            if now - started_at < PARTIAL_EVENT_SECONDS and len(self._partial) < MAX_PARTIAL_EVENTS:
+                break
+            del self._partial[key]
+
+    def feed(self, payload: str) -> Optional[Tuple[str, int, int, Dict]]:
+        header, _, chunk = payload.partition("|")
+        origin, conversation_id, event_id, parts = header.split(" ")
+        part, total = (int(n) for n in parts.split("/"))
+        key = (origin, int(conversation_id), int(event_id))
+        if total == 1:
+            return (*key, json.loads(chunk))
+        if key not in self._partial:
+            now = time.monotonic()
+            self._expire(now)
+            self._partial[key] = (now, [])
+        chunks = self._partial[key][1]
+        chunks.append(chunk)
+        if part < total:
+            return None
+        del self._partial[key]
+        if len(chunks) != total:
+            raise ValueError(f"event {key} lost {total - len(chunks)} of {total} parts")
+        return (*key, json.loads("".join(chunks)))
+
+
+class PostgresBroker(InProcessBroker):
+    """Fan out through Postgres NOTIFY; events from this worker are delivered locally without a round trip"""
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self.origin = uuid.uuid4().hex[:12]
+        self._assembler = NotificationAssembler()
+        self._listener = None
+        self._pool = None
+        self._stopping = False
+
+    async def start(self):
+        import asyncpg
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=4)
+        await self._listen()
+
+    async def _listen(self):
+        import asyncpg
+        # Parts sent while no listener was connected never arrive
+        self._assembler.clear()
+        while not self._stopping:
+            try:
+                self._listener = await asyncpg.connect(self.dsn)
+                self._listener.add_termination_listener(self._on_listener_lost)
+                await self._listener.add_listener(CHANNEL, self._on_notification)
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning("LISTEN %s failed (%s); retrying", CHANNEL, e)
+                await asyncio.sleep(1)
+
+    def _on_listener_lost(self, connection):
+        if not self._stopping:
+            logger.warning("Lost the %s listener connection; reconnecting", CHANNEL)
+            asyncio.get_running_loop().create_task(self._listen())
+
+    async def stop(self):
+        self._stopping = True
+        if self._listener is not None:
+            await self._listener.close()
+        if self._pool is not None:
+            await self._pool.close()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            message = self._assembler.feed(payload)
+        except (ValueError, KeyError) as e:
+            logger.warning("Dropping malformed run event notification: %s", e)
+            return
+        if message is None:
+            return
+        origin, conversation_id, event_id, event = message
+        if origin != self.origin:
+            self._deliver(conversation_id, event_id, event)
+
+    async def publish(self, conversation_id: int, event_id: int, event: Dict):
+        self._deliver(conversation_id, event_id, event)
+        try:
+            async with self._pool.acquire() as connection:
+                # One transaction keeps the parts of an event together and in order
+                async with connection.transaction():
+                    for payload in encode_notifications(self.origin, conversation_id, event_id, event):
+                        await connection.execute("SELECT pg_notify($1, $2)", CHANNEL, payload)
+        except Exception as e:
+            # Other workers miss this event, the run itself carries on
+            logger.warning("Failed to publish run event %s/%s: %s", conversation_id, event_id, e)
+
+
+_broker: Optional[InProcessBroker] = None
+
+
+def _create_broker() -> InProcessBroker:
+    from database import DATABASE_URL
+    backend = PUBSUB_BACKEND
+    if backend == "auto":
+        backend = "postgres" if DATABASE_URL.startswith("postgresql") else "memory"
+    if backend == "postgres":
+        return PostgresBroker(DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1))
+    return InProcessBroker()
+
+
+def get_broker() -> InProcessBroker:
+    global _broker
+    if _broker is None:
+        _broker = _create_broker()
+    return _broker
+
+
+async def start_broker():
+    await get_broker().start()
+
+
+async def stop_broker():
+    global _broker
+    if _broker is not None:
+        await _broker.stop()
+        _broker = None
+
+
+async def publish_run(conversation_id: int, events: AsyncIterator[Dict]) -> AsyncIterator[RunEvent]:
+    """Number and publish the events of a run, yielding them on as (id, event) pairs"""
+    broker = get_broker()
+    event_id = 0
+    finished = False
+    try:
+        async for event in events:
+            event_id += 1
+            await broker.publish(conversation_id, event_id, event)
+            finished = event.get('type') in TERMINAL_EVENTS
+            yield event_id, event
+    finally:
+        if not finished:
+            # The originating request went away (or failed) before the run completed
+            await broker.publish(conversation_id, event_id + 1, {'type': 'error', 'message': 'Run was interrupted'})
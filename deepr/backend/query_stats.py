@@ -0,0 +1,144 @@
+"""
+Per-request SQL statement counting and slow-query logging.
+
+QueryStatsMiddleware counts the statements and database time of each HTTP
+request, including the streamed body of a council run. Statements slower than
+DEEPR_SLOW_QUERY_MS are logged together with the backend line that issued them.
+Tests use assert_query_budget to keep N+1 patterns from creeping back.
+"""
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+import metrics
+
+try:
+    import greenlet
+except ImportError:  # pragma: no cover - installed with SQLAlchemy's asyncio extra
+    greenlet = None
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_SECONDS = float(os.getenv("DEEPR_SLOW_QUERY_MS", "200")) / 1000.0
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DB_QUERIES = metrics.histogram(
+    "deepr_db_queries_per_request", "SQL statements issued per HTTP request", ["route"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+DB_TIME = metrics.histogram("deepr_db_time_per_request_seconds", "Time spent in SQL statements per HTTP request", ["route"])
+DB_SLOW_QUERIES = metrics.counter("deepr_db_slow_queries_total", "SQL statements slower than DEEPR_SLOW_QUERY_MS")
+
+
+class QueryStats:
+    """Statement count and time, also added to the enclosing stats (e.g. a test budget around a request)"""
+
+    def __init__(self, parent: Optional["QueryStats"] = None, keep_statements: bool = False):
+        self.parent = parent
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: Optional[List[str]] = [] if keep_statements else None
+
+    def record(self, statement: str, seconds: float):
+        stats = self
+        while stats is not None:
+            stats.count += 1
+            stats.seconds += seconds
+            if stats.statements is not None:
+                stats.statements.append(statement)
+            stats = stats.parent
+
+
+_current_stats: ContextVar[Optional[QueryStats]] = ContextVar("deepr_query_stats", default=None)
+
+
+def current_stats() -> Optional[QueryStats]:
+    return _current_stats.get()
+
+
+def _origin() -> str:
+    """Innermost backend frame outside this module, i.e. the code that issued the statement"""
+    frame = sys._getframe(2)
+    # Async sessions execute inside a greenlet whose stack stops at greenlet_spawn;
+    # the awaiting caller is on the parent greenlet's suspended stack
+    current = greenlet.getcurrent() if greenlet is not None else None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(BACKEND_DIR) and filename != __file__:
+            return f"{os.path.relpath(filename, BACKEND_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+        if frame is None and current is not None and current.parent is not None:
+            current = current.parent
+            frame = current.gr_frame
+    return "unknown"
+
+
+def instrument_engine(engine):
+    """Record statements executed through the given AsyncEngine; safe to call more than once"""
+    from sqlalchemy import event
+
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._deepr_query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._deepr_query_started
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record(statement, elapsed)
+    if elapsed >= SLOW_QUERY_SECONDS:
+        DB_SLOW_QUERIES.inc()
+        logger.warning("Slow query (%.1f ms) from %s: %s", elapsed * 1000, _origin(), " ".join(statement.split())[:500])
+
+
+@contextmanager
+def collect_queries(keep_statements: bool = False):
+    """Count the statements issued inside the block (and by tasks it spawns)"""
+    stats = QueryStats(parent=_current_stats.get(), keep_statements=keep_statements)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+@contextmanager
+def assert_query_budget(max_queries: int):
+    """Fail when the block issues more than max_queries statements"""
+    with collect_queries(keep_statements=True) as stats:
+        yield stats
+    if stats.count > max_queries:
+        listing = "\n".join(f"  {' '.join(s.split())[:200]}" for s in stats.statements)
+        raise AssertionError(f"Expected at most {max_queries} queries, got {stats.count}:\n{listing}")
+
+
+class QueryStatsMiddleware:
+    """ASGI middleware recording statement count and database time per request, streamed bodies included"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with collect_queries() as stats:
+            await self.app(scope, receive, send)
+
+        route = scope.get("route")
+        route_path = route.path if route is not None and hasattr(route, "path") else "unmatched"
+        DB_QUERIES.observe(stats.count, route=route_path)
+        DB_TIME.observe(stats.seconds, route=route_path)
+        logger.debug("%s %s: %d queries, %.1f ms in database", scope["method"], scope["path"], stats.count, stats.seconds * 1000)
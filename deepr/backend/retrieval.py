@@ -0,0 +1,240 @@
+"""
+Local retrieval over large text attachments.
+
+A text attachment (or a PDF sent to the model as text, see extraction) whose
+token estimate exceeds DEEPR_RETRIEVAL_MIN_TOKENS is not inlined in full. It
+is split into line-aligned chunks and indexed with BM25. Each call then gets
+only the chunks most relevant to the user's request, up to
+DEEPR_RETRIEVAL_TOKEN_BUDGET tokens per attachment, in document order and
+labelled with their line numbers.
+
+The query is the user's request alone, not the role instructions, so every
+call of a run picks the same excerpts and keeps the cacheable prompt prefix
+(see prompt_cache). Indexes are built off the event loop when an attachment
+is saved and kept per worker in an LRU bounded by DEEPR_RETRIEVAL_CACHE_MB of
+indexed text. A worker that has no index for an attachment rebuilds it from
+the cached extracted text. Set DEEPR_ATTACHMENT_RETRIEVAL=false to always
+inline whole files.
+"""
+import asyncio
+import logging
+import math
+import os
+import re
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from extraction import estimate_tokens, send_pdf_as_text
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_RETRIEVAL = os.getenv("DEEPR_ATTACHMENT_RETRIEVAL", "true").lower() in ("1", "true", "yes")
+MIN_TOKENS = int(os.getenv("DEEPR_RETRIEVAL_MIN_TOKENS", "16000"))
+TOKEN_BUDGET = int(os.getenv("DEEPR_RETRIEVAL_TOKEN_BUDGET", "8000"))
+CACHE_CHARS = int(float(os.getenv("DEEPR_RETRIEVAL_CACHE_MB", "64")) * 1024 * 1024)
+CHUNK_CHARS = 1500
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i if in is it its of on or that the this to was what "
+    "when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words and numbers; identifiers are also split on underscores and camelCase"""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text).lower()
+    return [token for token in TOKEN_RE.findall(text) if len(token) > 1 and token not in STOPWORDS]
+
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS) -> List[Tuple[int, int, str]]:
+    """Split into (first line, last line, text) chunks of about chunk_chars, breaking between lines"""
+    chunks = []
+    lines: List[str] = []
+    size = 0
+    start = 1
+    for number, line in enumerate(text.splitlines(keepends=True), 1):
+        # Overlong lines (minified files, CSV blobs) are cut on their own
+        while len(line) > chunk_chars:
+            if lines:
+                chunks.append((start, number - 1, "".join(lines)))
+                lines, size = [], 0
+            chunks.append((number, number, line[:chunk_chars]))
+            line = line[chunk_chars:]
+            start = number
+        if size + len(line) > chunk_chars and lines:
+            chunks.append((start, number - 1, "".join(lines)))
+            lines, size = [], 0
+        if not lines:
+            start = number
+        lines.append(line)
+        size += len(line)
+    if lines:
+        chunks.append((start, start + len(lines) - 1, "".join(lines)))
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over the chunks of one document"""
+
+    def __init__(self, text: str):
+        self.chunks = chunk_text(text)
+        self.chars = len(text)
+        self.term_counts = [Counter(tokenize(chunk)) for _, _, chunk in self.chunks]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        document_frequency = Counter(term for counts in self.term_counts for term in counts)
+        n = len(self.chunks)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+
+    def scores(self, query: str) -> List[float]:
+        terms = [term for term in set(tokenize(query)) if term in self.idf]
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            norm = K1 * (1 - B + B * length / self.avg_length) if self.avg_length else K1
+            scores.append(sum(
+                self.idf[term] * counts[term] * (K1 + 1) / (counts[term] + norm)
+                for term in terms if term in counts
+            ))
+        return scores
+
+    def select(self, query: str, budget: int) -> List[Tuple[int, int, str]]:
+        """Best-scoring chunks within the token budget, in document order (the opening chunks if nothing matches)"""
+        scores = self.scores(query)
+        ranked = sorted(range(len(self.chunks)), key=lambda i: (-scores[i], i))
+        if not any(scores):
+            ranked = list(range(len(self.chunks)))
+        chosen, used = [], 0
+        for i in ranked:
+            cost = estimate_tokens(self.chunks[i][2])
+            if used + cost > budget:
+                continue
+            chosen.append(i)
+            used += cost
+        return [self.chunks[i] for i in sorted(chosen)]
+
+
+class RetrievedText:
+    """Stand-in for a large text attachment in one request, carrying only the selected excerpts"""
+
+    def __init__(self, attachment, text: str):
+        self.id = getattr(attachment, "id", None)
+        self.filename = attachment.filename
+        self.file_type = "text"
+        self.mime_type = "text/plain"
+        self.extracted_text = text
+
+
+_indexes: "OrderedDict[int, BM25Index]" = OrderedDict()
+_indexed_chars = 0
+_pending: Dict[int, asyncio.Future] = {}
+
+
+def _remember(attachment_id: int, index: BM25Index):
+    global _indexed_chars
+    if index.chars > CACHE_CHARS or attachment_id in _indexes:
+        return
+    _indexes[attachment_id] = index
+    _indexed_chars += index.chars
+    while _indexed_chars > CACHE_CHARS:
+        _, evicted = _indexes.popitem(last=False)
+        _indexed_chars -= evicted.chars
+
+
+def _document_text(attachment) -> Optional[str]:
+    text = getattr(attachment, "extracted_text", None)
+    if text is None and attachment.file_type == "text":
+        text = attachment.file_data.decode("utf-8")
+    return text
+
+
+def needs_retrieval(attachment, file_supported: Optional[bool] = None) -> bool:
+    if not ATTACHMENT_RETRIEVAL:
+        return False
+    if attachment.file_type != "text" and not send_pdf_as_text(attachment, file_supported):
+        return False
+    tokens = getattr(attachment, "token_estimate", None)
+    if tokens is None:
+        text = _document_text(attachment)
+        tokens = estimate_tokens(text)
+    return tokens > MIN_TOKENS
+
+
+async def get_index(attachment) -> BM25Index:
+    """The attachment's index, built off the event loop once per worker while it stays cached"""
+    attachment_id = getattr(attachment, "id", None)
+    if attachment_id is None:
+        return await asyncio.to_thread(BM25Index, _document_text(attachment))
+    if attachment_id in _indexes:
+        _indexes.move_to_end(attachment_id)
+        return _indexes[attachment_id]
+    future = _pending.get(attachment_id)
+    if future is None:
+        future = asyncio.ensure_future(asyncio.to_thread(BM25Index, _document_text(attachment)))
+        _pending[attachment_id] = future
+
+        def done(f):
+            _pending.pop(attachment_id, None)
+            if not f.cancelled() and f.exception() is None:
+                _remember(attachment_id, f.result())
+
+        future.add_done_callback(done)
+    return await asyncio.shield(future)
+
+
+# Background index builds, referenced until they finish so they are not garbage-collected
+_background: Set[asyncio.Task] = set()
+
+
+def index_in_background(attachment):
+    """Build the index of a newly saved text attachment so the run that follows finds it ready"""
+    if attachment.file_type == "text" and needs_retrieval(attachment):
+        attachment_id = getattr(attachment, "id", None)
+        task = asyncio.get_running_loop().create_task(get_index(attachment))
+        _background.add(task)
+
+        def done(t):
+            _background.discard(t)
+            if not t.cancelled() and t.exception() is not None:
+                # The run that needs the index tries to build it again
+                logger.error("indexing attachment %s failed", attachment_id, exc_info=t.exception())
+
+        task.add_done_callback(done)
+
+
+def format_excerpts(filename: str, chunks: List[Tuple[int, int, str]], total_chunks: int) -> str:
+    parts = [f"Excerpts from {filename} ({len(chunks)} of {total_chunks} sections, selected for relevance to the request):"]
+    for first, last, text in chunks:
+        label = f"line {first}" if first == last else f"lines {first}-{last}"
+        parts.append(f"--- {label} ---\n{text.rstrip()}")
+    return "\n\n".join(parts)
+
+
+def request_text(messages: List[Dict]) -> str:
+    """Text of the first user message: the user's request, shared by every call of a run"""
+    for msg in messages:
+        if msg.get("role") == "user":
+            content = msg.get("content")
+            if isinstance(content, str):
+                return content
+            return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return ""
+
+
+async def prepare_text(attachments: Optional[List], messages: List[Dict], file_supported: Optional[bool] = None) -> Optional[List]:
+    """Attachments for one model call, with large text documents replaced by their relevant excerpts"""
+    if not attachments or not any(needs_retrieval(att, file_supported) for att in attachments):
+        return attachments
+    query = request_text(messages)
+    prepared = []
+    for att in attachments:
+        if not needs_retrieval(att, file_supported) or _document_text(att) is None:
+            prepared.append(att)
+            continue
+        index = await get_index(att)
+        chunks = index.select(query, TOKEN_BUDGET)
+        prepared.append(RetrievedText(att, format_excerpts(att.filename, chunks, len(index.chunks))))
+    return prepared
@@ -0,0 +1,311 @@
+"""
+Telemetry-driven model routing.
+
+Every OpenRouter call updates rolling statistics for its model: latency and
+time to first token of successful calls, error rate and cost per 1k tokens,
+each an exponentially weighted moving average (DEEPR_ROUTING_EWMA_ALPHA).
+Workers keep them in memory, load them from `model_stats` at startup and
+write the models they called back every DEEPR_MODEL_STATS_FLUSH_SECONDS; with
+several workers the last write wins, which is fine for a moving average.
+
+Runs can name the model "auto" for a council member, chairman or DxO role
+and pass `auto_models`, the models the user accepts as equivalent. Each
+"auto" slot gets a different candidate, best first for `routing_target`:
+- latency: expected seconds per successful answer
+- cost: expected USD per 1k tokens of a successful answer
+Candidates with fewer than MIN_CALLS recorded calls are tried first, so the
+statistics come to cover every candidate.
+
+Only provider-side failures (timeouts, connection errors, 429 and 5xx) count
+as errors; a user's own 4xx (bad key, no credits, context too long) does not.
+A circuit breaker opens after DEEPR_BREAKER_FAILURES consecutive failures of
+a model and keeps it out of routing for DEEPR_BREAKER_COOLDOWN_SECONDS. Then
+one run may try it again: a success closes the circuit, a failure reopens it.
+While a circuit is open, runs that listed the model explicitly get the best
+available `auto_models` candidate instead, if they passed any. The breaker is
+per worker. GET /routing/stats shows the statistics and circuit states.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import openai
+from fastapi import APIRouter, Depends
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import metrics
+from auth import get_current_user
+from database import conflict_insert
+from models import ModelStat
+
+logger = logging.getLogger(__name__)
+
+AUTO = "auto"
+TARGETS = ("latency", "cost")
+EWMA_ALPHA = float(os.getenv("DEEPR_ROUTING_EWMA_ALPHA", "0.2"))
+BREAKER_FAILURES = int(os.getenv("DEEPR_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("DEEPR_BREAKER_COOLDOWN_SECONDS", "60"))
+STATS_FLUSH_SECONDS = float(os.getenv("DEEPR_MODEL_STATS_FLUSH_SECONDS", "30"))
+# Calls a model needs before its statistics are trusted for ranking
+MIN_CALLS = 3
+# Floor of the success rate when scaling by it, so a model that always failed ranks last but finite
+MIN_SUCCESS_RATE = 0.05
+
+CIRCUIT_OPEN = metrics.gauge("deepr_model_circuit_open", "Whether the model's circuit breaker is open (1) on this worker", ["model"])
+
+
+def _ewma(current: Optional[float], value: float) -> float:
+    return value if current is None else current + EWMA_ALPHA * (value - current)
+
+
+class ModelStats:
+    """Rolling statistics and circuit state of one model on this worker"""
+
+    def __init__(self, latency=None, ttft=None, error_rate=0.0, cost_per_1k=None, calls=0):
+        self.latency = latency
+        self.ttft = ttft
+        self.error_rate = error_rate
+        self.cost_per_1k = cost_per_1k
+        self.calls = calls
+        self.consecutive_failures = 0
+        # time.monotonic() until which the circuit is open; 0 when closed
+        self.open_until = 0.0
+
+    def circuit(self, now: float) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if now < self.open_until else "half_open"
+
+    def score(self, target: str) -> Optional[float]:
+        """Expected latency or cost per successful answer (lower is better); None while unmeasured"""
+        value = self.latency if target == "latency" else self.cost_per_1k
+        if self.calls < MIN_CALLS or value is None:
+            return None
+        return value / max(1.0 - self.error_rate, MIN_SUCCESS_RATE)
+
+
+_stats: Dict[str, ModelStats] = {}
+# Models whose statistics changed since the last flush
+_dirty = set()
+
+
+def record_call(model: str, latency: float, ok: bool, ttft: Optional[float] = None,
+                cost: Optional[float] = None, tokens: int = 0):
+    """Fold one finished OpenRouter call into the model's statistics and circuit"""
+    stats = _stats.setdefault(model, ModelStats())
+    stats.calls += 1
+    stats.error_rate = _ewma(stats.error_rate, 0.0 if ok else 1.0)
+    if ok:
+        stats.latency = _ewma(stats.latency, latency)
+        if ttft is not None:
+            stats.ttft = _ewma(stats.ttft, ttft)
+        if cost and tokens:
+            stats.cost_per_1k = _ewma(stats.cost_per_1k, cost * 1000 / tokens)
+        stats.consecutive_failures = 0
+        if stats.open_until:
+            stats.open_until = 0.0
+            CIRCUIT_OPEN.set(0, model=model)
+    else:
+        stats.consecutive_failures += 1
+        # Failing again after the cooldown (half-open) reopens at once
+        if stats.consecutive_failures >= BREAKER_FAILURES:
+            if not stats.open_until:
+                logger.warning("Circuit opened for %s after %d consecutive failures", model, stats.consecutive_failures)
+            stats.open_until = time.monotonic() + BREAKER_COOLDOWN_SECONDS
+            CIRCUIT_OPEN.set(1, model=model)
+    _dirty.add(model)
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """
+    Whether a failed call says something about the model rather than the caller:
+    timeouts, connection errors, rate limits and 5xx. Errors of one user's request
+    (bad or revoked key, no credits, context too long) must not count against a
+    model whose statistics and circuit every user shares.
+    """
+    if isinstance(error, openai.APIConnectionError):  # Includes timeouts
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in (408, 429) or status >= 500)
+
+
+def record_error(model: str, latency: float, error: BaseException):
+    """record_call for a failed call; caller-side errors are left out"""
+    if is_provider_failure(error):
+        record_call(model, latency, ok=False)
+
+
+def is_available(model: str) -> bool:
+    stats = _stats.get(model)
+    return stats is None or stats.circuit(time.monotonic()) != "open"
+
+
+def _claim(model: str):
+    # A half-open model gets one trial run per cooldown, not every run that starts meanwhile
+    stats = _stats.get(model)
+    now = time.monotonic()
+    if stats is not None and stats.circuit(now) == "half_open":
+        stats.open_until = now + BREAKER_COOLDOWN_SECONDS
+
+
+def rank(candidates: List[str], target: str) -> List[str]:
+    """Available candidates, unmeasured ones first (in the given order) and then best first"""
+    available = [model for model in dict.fromkeys(candidates) if is_available(model)]
+    scores = {model: _stats[model].score(target) if model in _stats else None for model in available}
+    unmeasured = [model for model in available if scores[model] is None]
+    measured = sorted((model for model in available if scores[model] is not None), key=lambda model: scores[model])
+    return unmeasured + measured
+
+
+def assign(models: List[str], candidates: List[str], target: str = "latency") -> Tuple[List[str], List[str]]:
+    """
+    Concrete model for each slot: "auto" takes the best candidate not already in use,
+    and models with an open circuit are replaced the same way when there are candidates.
+    Returns the models and a note per substitution. Raises ValueError for "auto" without candidates.
+    """
+    if target not in TARGETS:
+        raise ValueError(f"routing_target must be one of: {', '.join(TARGETS)}")
+    if AUTO in models and not candidates:
+        raise ValueError('"auto" models need a list of auto_models to choose from')
+    ranked = rank(candidates, target) if candidates else []
+    in_use = {model for model in models if model != AUTO and is_available(model)}
+    assigned, notes = [], []
+    for model in models:
+        if model != AUTO and (is_available(model) or not candidates):
+            assigned.append(model)
+            continue
+        # Prefer a model no other slot uses; share one when there are more slots than candidates
+        choice = next((c for c in ranked if c not in in_use), ranked[0] if ranked else None)
+        if choice is None:
+            # Every candidate is failing: keep the listed model, or the first candidate for "auto"
+            choice = model if model != AUTO else candidates[0]
+        _claim(choice)
+        in_use.add(choice)
+        assigned.append(choice)
+        if model == AUTO:
+            notes.append(f"auto → {choice} (by {target})")
+        elif choice != model:
+            notes.append(f"{model} is failing; using {choice} instead")
+    return assigned, notes
+
+
+async def load_stats(db: AsyncSession):
+    """Seed this worker's statistics from the database (models already called here keep theirs)"""
+    rows = (await db.execute(select(ModelStat))).scalars().all()
+    for row in rows:
+        if row.model not in _stats:
+            _stats[row.model] = ModelStats(row.latency_seconds, row.ttft_seconds, row.error_rate or 0.0,
+                                           row.cost_per_1k_tokens, row.calls or 0)
+
+
+async def flush_stats(db: AsyncSession) -> int:
+    """Upsert the statistics of models called since the last flush; returns how many were written"""
+    models = list(_dirty)
+    _dirty.clear()
+    if not models:
+        return 0
+    rows = []
+    now = datetime.now(timezone.utc)
+    for model in models:
+        stats = _stats[model]
+        rows.append(dict(model=model, latency_seconds=stats.latency, ttft_seconds=stats.ttft, error_rate=stats.error_rate,
+                         cost_per_1k_tokens=stats.cost_per_1k, calls=stats.calls, updated_at=now))
+    dialect_insert = conflict_insert(db)
+    try:
+        if dialect_insert is not None:
+            statement = dialect_insert(ModelStat).values(rows)
+            columns = {name: statement.excluded[name] for name in rows[0] if name != "model"}
+            await db.execute(statement.on_conflict_do_update(index_elements=["model"], set_=columns))
+        else:
+            for row in rows:
+                await db.merge(ModelStat(**row))
+        await db.commit()
+    except Exception:
+        # Keep them for the next flush
+        _dirty.update(models)
+        raise
+    return len(rows)
+
+
+class StatsSync:
+    """Loads model statistics at startup and flushes them every `interval` seconds and at shutdown"""
+
+    def __init__(self, interval: float = STATS_FLUSH_SECONDS):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            await self._with_session(load_stats)
+        except Exception:
+            logger.exception("loading model statistics failed")
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await self._with_session(flush_stats)
+        except Exception:
+            logger.exception("flushing model statistics failed")
+
+    async def _with_session(self, job):
+        from database import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            return await job(db)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._with_session(flush_stats)
+            except Exception:
+                logger.exception("flushing model statistics failed")
+
+
+_sync: Optional[StatsSync] = None
+
+
+async def start_stats_sync() -> Optional[StatsSync]:
+    """Load and periodically persist model statistics; call from the app's startup hook"""
+    global _sync
+    if STATS_FLUSH_SECONDS <= 0:
+        return None
+    _sync = StatsSync()
+    await _sync.start()
+    return _sync
+
+
+async def stop_stats_sync():
+    global _sync
+    if _sync:
+        await _sync.stop()
+        _sync = None
+
+
+router = APIRouter(prefix="/routing", dependencies=[Depends(get_current_user)])
+
+
+@router.get("/stats")
+async def get_stats():
+    now = time.monotonic()
+    return [
+        {
+            "model": model,
+            "latency_seconds": stats.latency,
+            "ttft_seconds": stats.ttft,
+            "error_rate": stats.error_rate,
+            "cost_per_1k_tokens": stats.cost_per_1k,
+            "calls": stats.calls,
+            "circuit": stats.circuit(now),
+        }
+        for model, stats in sorted(_stats.items())
+    ]
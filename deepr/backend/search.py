@@ -0,0 +1,190 @@
+"""
+Full-text search over a user's conversation titles and node contents.
+
+On Postgres, `conversations.search_vector` and `nodes.search_vector` are kept
+current by triggers and GIN-indexed, so `GET /search` ranks matches with
+`ts_rank_cd` and highlights them with `ts_headline`. Queries use web search
+syntax ("quoted phrases", -exclusions, OR). Other databases (SQLite in
+development and tests) fall back to a LIKE scan that requires every word.
+
+Results are one per conversation, ranked by the title match plus the best
+matching node, whose snippet is returned with matches wrapped in <mark> tags.
+Snippets and title highlights are HTML: the text (model output) is escaped
+before the marks are inserted, so they can be rendered as markup.
+
+The LIKE fallback matches delta-encoded refinements (see engines.drafts) on
+their stored JSON, which holds the lines they insert: words in those lines
+are found, but phrases spanning escaped characters or unchanged lines are
+not. Their snippets are cut from the decoded text.
+"""
+import html
+import re
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import and_, case, func, literal_column, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth import get_current_user
+from database import get_db
+from models import Conversation, Node, User
+from storage import resolve_node_contents
+
+router = APIRouter()
+
+SEARCH_CONFIG = literal_column("'english'::regconfig")
+HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15, MaxFragments=2, FragmentDelimiter=\" … \""
+TITLE_HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, HighlightAll=true"
+MAX_RESULTS = 50
+# LIKE fallback limits
+MAX_TERMS = 8
+SNIPPET_CHARS = 240
+
+
+def _escape_html(text):
+    """SQL counterpart of html.escape(text, quote=False), applied before ts_headline adds its marks"""
+    return func.replace(func.replace(func.replace(text, "&", "&amp;"), "<", "&lt;"), ">", "&gt;")
+
+
+def build_search_query(user_id: int, q: str, limit: int, offset: int):
+    """Postgres statement returning one ranked row per matching conversation (limit + 1 rows to detect more)"""
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+    node_rank = func.ts_rank_cd(Node.search_vector, tsquery)
+    hits = (
+        select(
+            Node.conversation_id,
+            Node.id.label("node_id"),
+            node_rank.label("rank"),
+            func.count().over(partition_by=Node.conversation_id).label("matches"),
+            func.row_number().over(partition_by=Node.conversation_id, order_by=(node_rank.desc(), Node.id)).label("position"),
+        )
+        .join(Conversation, Conversation.id == Node.conversation_id)
+        .where(Conversation.user_id == user_id, Node.search_vector.op("@@")(tsquery))
+        .subquery()
+    )
+    title_match = Conversation.search_vector.op("@@")(tsquery)
+    rank = (
+        case((title_match, func.ts_rank_cd(Conversation.search_vector, tsquery)), else_=0.0)
+        + func.coalesce(hits.c.rank, 0.0)
+    ).label("rank")
+    return (
+        select(
+            Conversation.id, Conversation.title, Conversation.method, Conversation.created_at,
+            func.ts_headline(SEARCH_CONFIG, _escape_html(func.coalesce(Conversation.title, "")), tsquery, TITLE_HEADLINE_OPTIONS).label("title_highlight"),
+            hits.c.node_id, func.coalesce(hits.c.matches, 0).label("matches"), rank,
+        )
+        .outerjoin(hits, and_(hits.c.conversation_id == Conversation.id, hits.c.position == 1))
+        .where(Conversation.user_id == user_id, Conversation.deleted_at.is_(None), or_(title_match, hits.c.node_id.isnot(None)))
+        .order_by(rank.desc(), Conversation.created_at.desc(), Conversation.id.desc())
+        .limit(limit + 1)
+        .offset(offset)
+    )
+
+
+def _like(column, term: str):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return column.ilike(f"%{escaped}%", escape="\\")
+
+
+def build_fallback_query(user_id: int, terms: List[str], limit: int, offset: int):
+    """LIKE-based equivalent of build_search_query: every term must appear in the title or in one node"""
+    node_match = and_(*[_like(Node.content, term) for term in terms])
+    title_match = and_(*[_like(Conversation.title, term) for term in terms])
+    hits = (
+        select(Node.conversation_id, func.min(Node.id).label("node_id"), func.count().label("matches"))
+        .join(Conversation, Conversation.id == Node.conversation_id)
+        .where(Conversation.user_id == user_id, node_match)
+        .group_by(Node.conversation_id)
+        .subquery()
+    )
+    rank = (case((title_match, 1.0), else_=0.0) + func.coalesce(hits.c.matches, 0) * 0.1).label("rank")
+    return (
+        select(
+            Conversation.id, Conversation.title, Conversation.method, Conversation.created_at,
+            hits.c.node_id, func.coalesce(hits.c.matches, 0).label("matches"), rank,
+        )
+        .outerjoin(hits, hits.c.conversation_id == Conversation.id)
+        .where(Conversation.user_id == user_id, Conversation.deleted_at.is_(None), or_(title_match, hits.c.node_id.isnot(None)))
+        .order_by(rank.desc(), Conversation.created_at.desc(), Conversation.id.desc())
+        .limit(limit + 1)
+        .offset(offset)
+    )
+
+
+def highlight(text: Optional[str], terms: List[str], width: int = SNIPPET_CHARS) -> str:
+    """HTML-escaped window of `text` around the first matching term, with every term occurrence marked"""
+    text = text or ""
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    match = pattern.search(text) if terms else None
+    start = max(0, match.start() - width // 3) if match else 0
+    window = text[start:start + width]
+    parts, position = [], 0
+    for found in (pattern.finditer(window) if terms else ()):
+        parts.append(html.escape(window[position:found.start()], quote=False))
+        parts.append(f"<mark>{html.escape(found.group(0), quote=False)}</mark>")
+        position = found.end()
+    parts.append(html.escape(window[position:], quote=False))
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if start + width < len(text) else "")
+
+
+async def _node_snippets(db: AsyncSession, node_ids: List[int], q: str, terms: List[str], postgres: bool) -> Dict[int, Dict]:
+    if not node_ids:
+        return {}
+    if postgres:
+        snippet = func.ts_headline(
+            SEARCH_CONFIG, _escape_html(func.deepr_node_search_text(Node.content, Node.content_encoding)),
+            func.websearch_to_tsquery(SEARCH_CONFIG, q), HEADLINE_OPTIONS
+        )
+        result = await db.execute(select(Node.id, Node.type, Node.model_name, snippet).where(Node.id.in_(node_ids)))
+        return {row[0]: {'id': row[0], 'type': row[1], 'model': row[2], 'snippet': row[3]} for row in result.all()}
+
+    result = await db.execute(select(Node).where(Node.id.in_(node_ids)))
+    nodes = result.scalars().all()
+    contents = await resolve_node_contents(db, nodes)
+    return {
+        node.id: {'id': node.id, 'type': node.type, 'model': node.model_name, 'snippet': highlight(contents[node.id], terms)}
+        for node in nodes
+    }
+
+
+@router.get("/search")
+async def search_history(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=MAX_RESULTS),
+    offset: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    postgres = db.bind.dialect.name == "postgresql"
+    terms = q.split()[:MAX_TERMS]
+    if not terms:
+        return {"query": q, "limit": limit, "offset": offset, "has_more": False, "results": []}
+    if postgres:
+        stmt = build_search_query(current_user.id, q, limit, offset)
+    else:
+        stmt = build_fallback_query(current_user.id, terms, limit, offset)
+    rows = (await db.execute(stmt)).mappings().all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    snippets = await _node_snippets(db, [row['node_id'] for row in rows if row['node_id']], q, terms, postgres)
+
+    return {
+        "query": q,
+        "limit": limit,
+        "offset": offset,
+        "has_more": has_more,
+        "results": [
+            {
+                'conversation_id': row['id'],
+                'title': row['title'],
+                'title_highlight': row['title_highlight'] if postgres else highlight(row['title'], terms),
+                'method': row['method'],
+                'created_at': row['created_at'],
+                'rank': round(float(row['rank']), 6),
+                'matching_nodes': row['matches'],
+                'node': snippets.get(row['node_id']),
+            }
+            for row in rows
+        ],
+    }
@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import Optional
 from database import get_db
 from models import User, UserSettings
-from auth import get_current_user
-from encryption import encrypt_key, decrypt_key
+from auth import get_current_user, invalidate_user
+from encryption import encrypt_key, decrypt_key, invalidate_user_keys
+from openrouter_service import clear_model_cache
 
 router = APIRouter()
 
@@ -15,6 +17,10 @@ class SettingsUpdate(BaseModel):
 class SettingsResponse(BaseModel):
     has_api_key: bool
 
+class RetentionSettings(BaseModel):
+    # None falls back to the server default (DEEPR_RETENTION_DAYS); 0 keeps conversations forever
+    retention_days: Optional[int] = Field(None, ge=0)
+
 @router.get("/settings", response_model=SettingsResponse)
 async def get_settings(
     current_user: User = Depends(get_current_user),
@@ -27,6 +33,7 @@ async def get_settings(
         settings = UserSettings(user_id=current_user.id)
         db.add(settings)
         await db.commit()
+        invalidate_user(current_user.email)
     
     return {"has_api_key": settings.encrypted_api_key is not None}
 
@@ -42,7 +49,30 @@ async def update_settings(
     await db.execute(stmt)
     await db.commit()
     
-    # Force reload of models on next request
+    # Force reload of models and the cached user/key on next request
     clear_model_cache(current_user.id)
+    invalidate_user(current_user.email)
+    invalidate_user_keys(current_user.id)
     
     return {"status": "ok"}
+
+@router.get("/settings/retention", response_model=RetentionSettings)
+async def get_retention(current_user: User = Depends(get_current_user)):
+    settings = current_user.settings
+    return {"retention_days": settings.retention_days if settings else None}
+
+@router.put("/settings/retention", response_model=RetentionSettings)
+async def update_retention(
+    retention: RetentionSettings,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    result = await db.execute(select(UserSettings).where(UserSettings.user_id == current_user.id))
+    settings = result.scalars().first()
+    if not settings:
+        settings = UserSettings(user_id=current_user.id)
+        db.add(settings)
+    settings.retention_days = retention.retention_days
+    await db.commit()
+    invalidate_user(current_user.email)
+    return {"retention_days": settings.retention_days}
@@ -0,0 +1,182 @@
+"""
+Server-sent event transport for run streams.
+
+Engines and endpoints yield plain event dicts; EventStream encodes them once
+with a precompiled JSON encoder (orjson when installed) and adds:
+- sequential `id:` fields so clients can report the last event they saw,
+- `: keep-alive` comments while a phase is silent, so proxies keep idle streams open,
+- coalescing: consecutive `delta` events for the same node are merged, and once
+  the client is BACKPRESSURE_EVENTS behind, a status superseded by the next
+  queued status is dropped,
+- optional gzip (DEEPR_SSE_COMPRESSION=1 and a client that accepts it).
+"""
+import asyncio
+import json
+import os
+import zlib
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+HEARTBEAT_SECONDS = float(os.getenv("DEEPR_SSE_HEARTBEAT_SECONDS", "15"))
+COMPRESSION_ENABLED = os.getenv("DEEPR_SSE_COMPRESSION", "false").lower() in ("1", "true", "yes")
+MAX_BUFFERED_EVENTS = 256
+# Queued events before superseded statuses are dropped
+BACKPRESSURE_EVENTS = 16
+
+HEARTBEAT = b": keep-alive\n\n"
+_END = object()
+
+SSE_EVENTS = metrics.counter("deepr_sse_events_total", "Events written to SSE streams", ["type"])
+SSE_COALESCED = metrics.counter("deepr_sse_events_coalesced_total", "Events dropped or merged because the client fell behind", ["type"])
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return _json_encoder.encode(obj).encode("utf-8")
+
+
+def encode_event(event: Dict, event_id: Optional[int] = None) -> bytes:
+    # JSON never contains a raw newline, so one data line is always enough
+    if event_id is None:
+        return b"data: " + dumps(event) + b"\n\n"
+    return b"id: %d\ndata: %s\n\n" % (event_id, dumps(event))
+
+
+def coalesce(events: List[Tuple[int, Dict]], drop_statuses: bool = False) -> List[Tuple[int, Dict]]:
+    """
+    Merge consecutive deltas of one node and, if asked, drop statuses that the next queued
+    status supersedes. Events are (id, event) pairs; a merged event keeps the latest id.
+    """
+    result: List[Tuple[int, Dict]] = []
+    for event_id, event in events:
+        kind = event.get('type')
+        previous = result[-1][1] if result else None
+        if drop_statuses and previous is not None and kind == 'status' and previous.get('type') == 'status':
+            SSE_COALESCED.inc(type='status')
+            result[-1] = (event_id, event)
+        elif previous is not None and kind == 'delta' and previous.get('type') == 'delta' and previous.get('node_id') == event.get('node_id'):
+            SSE_COALESCED.inc(type='delta')
+            result[-1] = (event_id, {**previous, 'content': previous.get('content', '') + event.get('content', '')})
+        else:
+            result.append((event_id, event))
+    return result
+
+
+class EventStream:
+    """
+    Encode an async iterator of event dicts as an SSE byte stream.
+    Items may also be (id, event) pairs when ids are assigned upstream (see pubsub.publish_run).
+    """
+
+    def __init__(
+        self,
+        events: AsyncIterator[Union[Dict, Tuple[int, Dict]]],
+        heartbeat_interval: float = HEARTBEAT_SECONDS,
+        compress: bool = False,
+        first_id: int = 1,
+    ):
+        self.events = events
+        self.heartbeat_interval = heartbeat_interval
+        self.compress = compress
+        self.next_id = first_id
+
+    async def _produce(self, queue: asyncio.Queue):
+        try:
+            async for event in self.events:
+                await queue.put(event)
+            await queue.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            aclose = getattr(self.events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def _chunks(self) -> AsyncIterator[bytes]:
+        queue: asyncio.Queue = asyncio.Queue(MAX_BUFFERED_EVENTS)
+        # The run keeps going while the client is slow; queued events are coalesced
+        producer = asyncio.create_task(self._produce(queue))
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+                    continue
+
+                batch = [item]
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+
+                done = False
+                events = []
+                for entry in batch:
+                    if entry is _END:
+                        done = True
+                        break
+                    if isinstance(entry, Exception):
+                        raise entry
+                    if isinstance(entry, tuple):
+                        event_id, entry = entry
+                        self.next_id = event_id + 1
+                    else:
+                        event_id = self.next_id
+                        self.next_id += 1
+                    events.append((event_id, entry))
+
+                if events:
+                    parts = []
+                    for event_id, event in coalesce(events, drop_statuses=len(batch) >= BACKPRESSURE_EVENTS):
+                        SSE_EVENTS.inc(type=event.get('type', ''))
+                        parts.append(encode_event(event, event_id))
+                    yield b"".join(parts)
+                if done:
+                    return
+        finally:
+            if not producer.done():
+                producer.cancel()
+                try:
+                    await producer
+                except asyncio.CancelledError:
+                    pass
+
+    async def __aiter__(self):
+        if not self.compress:
+            async for chunk in self._chunks():
+                yield chunk
+            return
+        # gzip member flushed after every chunk so events are not held back by the compressor
+        compressor = zlib.compressobj(wbits=31)
+        async for chunk in self._chunks():
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def sse_response(events: AsyncIterator[Union[Dict, Tuple[int, Dict]]], request: Optional[Request] = None) -> StreamingResponse:
+    headers = {
+        "Cache-Control": "no-cache",
+        # Stop nginx-style proxies from buffering the stream
+        "X-Accel-Buffering": "no",
+    }
+    compress = (
+        COMPRESSION_ENABLED and request is not None
+        and "gzip" in request.headers.get("accept-encoding", "")
+    )
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(EventStream(events, compress=compress), media_type="text/event-stream", headers=headers)
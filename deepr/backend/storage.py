@@ -1,11 +1,26 @@
 """
 Storage abstraction layer for file attachments.
 Allows switching between database storage and external document management systems.
+Also reconstructs node contents stored as deltas against their parent node and
+keeps node prompts in a content-addressed, compressed `prompt_blobs` table.
 """
+import hashlib
+import zlib
 from abc import ABC, abstractmethod
-from typing import Optional, Dict
-from models import Attachment
+from typing import Optional, Dict, Iterable, Tuple
+from models import Attachment, Node, PromptBlob
+from sqlalchemy import insert, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from database import conflict_insert
+from engines.drafts import decode_delta, DELTA_ENCODING
+from extraction import extract_attachment
+from images import thumbnail_columns
+from retrieval import index_in_background
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class StorageBackend(ABC):
@@ -49,23 +64,25 @@ class DatabaseStorage(StorageBackend):
         file_data: bytes,
         file_size: int
     ) -> Attachment:
-        """Save file to database"""
+        """Save file to database, with its text extracted for the request builder"""
         attachment = Attachment(
             node_id=node_id,
             filename=filename,
             file_type=file_type,
             mime_type=mime_type,
             file_data=file_data,
-            file_size=file_size
+            file_size=file_size,
+            **await extract_attachment(file_type, file_data),
+            **await thumbnail_columns(file_type, file_data, mime_type)
         )
         db.add(attachment)
         await db.commit()
         await db.refresh(attachment)
+        index_in_background(attachment)
         return attachment
     
     async def get_file(self, db: AsyncSession, attachment_id: int) -> Optional[Attachment]:
         """Retrieve file from database"""
-        from sqlalchemy import select
         result = await db.execute(
             select(Attachment).where(Attachment.id == attachment_id)
         )
@@ -151,3 +168,107 @@ def get_storage() -> StorageBackend:
     #     return DatabaseStorage()
     
     return STORAGE_BACKEND
+
+
+async def resolve_node_contents(db: AsyncSession, nodes: Iterable) -> Dict[int, str]:
+    """
+    Return the full text of each node keyed by node ID.
+    Delta-encoded contents are rebuilt from their parent chain; parents that
+    are not among `nodes` are loaded from the database.
+    """
+    by_id = {node.id: node for node in nodes}
+    missing = {
+        node.parent_id for node in by_id.values()
+        if getattr(node, 'content_encoding', None) == DELTA_ENCODING and node.parent_id not in by_id
+    }
+    while missing:
+        result = await db.execute(select(Node).where(Node.id.in_(missing)))
+        loaded = result.scalars().all()
+        for node in loaded:
+            by_id[node.id] = node
+        missing = {
+            node.parent_id for node in loaded
+            if node.content_encoding == DELTA_ENCODING and node.parent_id not in by_id
+        }
+
+    resolved: Dict[int, str] = {}
+
+    def resolve(node_id: int) -> str:
+        # Walk up to the nearest full-text ancestor, then replay deltas downwards
+        chain = []
+        current = by_id[node_id]
+        while current.id not in resolved and getattr(current, 'content_encoding', None) == DELTA_ENCODING:
+            chain.append(current)
+            current = by_id[current.parent_id]
+        text = resolved.setdefault(current.id, current.content)
+        for node in reversed(chain):
+            text = decode_delta(text, node.content)
+            resolved[node.id] = text
+        return text
+
+    return {node.id: resolve(node.id) for node in nodes}
+
+
+# Prompt blobs: identical prompts (e.g. every critic of a DAG run) are stored once, keyed by SHA-256
+ZSTD_LEVEL = 9
+_zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if zstandard else None
+_zstd_decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+
+def prompt_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compress_prompt(text: str) -> Tuple[str, bytes]:
+    """Compress with zstd when installed, zlib otherwise; returns (encoding, data)"""
+    raw = text.encode("utf-8")
+    if _zstd_compressor is not None:
+        return "zstd", _zstd_compressor.compress(raw)
+    return "zlib", zlib.compress(raw, 9)
+
+
+def decompress_prompt(encoding: str, data: bytes) -> str:
+    if encoding == "zstd":
+        if _zstd_decompressor is None:
+            raise RuntimeError("Prompt blob is zstd-compressed but the zstandard package is not installed")
+        return _zstd_decompressor.decompress(data).decode("utf-8")
+    if encoding == "zlib":
+        return zlib.decompress(data).decode("utf-8")
+    return data.decode("utf-8")
+
+
+async def store_prompt(db: AsyncSession, text: Optional[str]) -> Optional[str]:
+    """
+    Store a prompt body unless an identical one exists and return its hash.
+    The insert joins the caller's transaction; commit it together with the node.
+    """
+    if text is None:
+        return None
+    digest = prompt_hash(text)
+    encoding, data = compress_prompt(text)
+    values = dict(hash=digest, encoding=encoding, data=data, size=len(text.encode("utf-8")))
+    dialect_insert = conflict_insert(db)
+    if dialect_insert is not None:
+        await db.execute(dialect_insert(PromptBlob).values(**values).on_conflict_do_nothing(index_elements=["hash"]))
+    else:
+        existing = await db.execute(select(PromptBlob.hash).where(PromptBlob.hash == digest))
+        if existing.first() is None:
+            await db.execute(insert(PromptBlob).values(**values))
+    return digest
+
+
+async def resolve_node_prompts(db: AsyncSession, nodes: Iterable) -> Dict[int, Optional[str]]:
+    """
+    Return the prompt text of each node keyed by node ID, loading all referenced
+    blobs in one query. Nodes written before prompt blobs keep their text in prompt_sent.
+    """
+    nodes = list(nodes)
+    hashes = {node.prompt_hash for node in nodes if getattr(node, 'prompt_hash', None)}
+    texts: Dict[str, str] = {}
+    if hashes:
+        result = await db.execute(select(PromptBlob.hash, PromptBlob.encoding, PromptBlob.data).where(PromptBlob.hash.in_(hashes)))
+        texts = {digest: decompress_prompt(encoding, data) for digest, encoding, data in result.all()}
+    return {
+        node.id: texts.get(node.prompt_hash) if getattr(node, 'prompt_hash', None) else getattr(node, 'prompt_sent', None)
+        for node in nodes
+    }
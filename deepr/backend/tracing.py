@@ -0,0 +1,235 @@
+"""
+Request tracing across the API, engines, OpenRouter calls and SQL statements.
+
+Configured with DEEPR_TRACE_EXPORTER:
+- "none" (default): spans are no-ops.
+- "file": spans are appended as JSON lines (OpenTelemetry field names) to DEEPR_TRACE_FILE.
+- "otlp": spans go through the OpenTelemetry SDK to the collector at
+  OTEL_EXPORTER_OTLP_ENDPOINT. This needs the opentelemetry-sdk and
+  opentelemetry-exporter-otlp packages.
+"""
+import json
+import logging
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER = os.getenv("DEEPR_TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("DEEPR_TRACE_FILE", "traces.jsonl")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "deepr-backend")
+MAX_STATEMENT_LENGTH = 2000
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        pass
+
+    def record_exception(self, exc: BaseException):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """Minimal span written by the file exporter"""
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else None
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano = None
+        self.attributes: Dict[str, Any] = {}
+        self.status = "OK"
+        if attributes:
+            self.set_attributes(attributes)
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self.attributes[key] = value if isinstance(value, (str, bool, int, float)) else str(value)
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_exception(self, exc: BaseException):
+        self.status = "ERROR"
+        self.set_attribute("exception.type", type(exc).__name__)
+        self.set_attribute("exception.message", str(exc)[:500])
+
+    def end(self):
+        self.end_time_unix_nano = time.time_ns()
+        _file_exporter.export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start_time_unix_nano,
+            "end_time_unix_nano": self.end_time_unix_nano,
+            "duration_ms": round((self.end_time_unix_nano - self.start_time_unix_nano) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+            "resource": {"service.name": SERVICE_NAME},
+        }
+
+
+class FileSpanExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def export(self, span: Span):
+        if self._file is None:
+            self._file = open(self.path, "a", buffering=1)
+        self._file.write(json.dumps(span.to_dict()) + "\n")
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("deepr_current_span", default=None)
+_file_exporter: Optional[FileSpanExporter] = None
+_otel_tracer = None
+
+
+def _configure():
+    global _file_exporter, _otel_tracer
+    if TRACE_EXPORTER == "file":
+        _file_exporter = FileSpanExporter(TRACE_FILE)
+    elif TRACE_EXPORTER == "otlp":
+        try:
+            from opentelemetry import trace
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.warning("DEEPR_TRACE_EXPORTER=otlp but opentelemetry-sdk/exporter is not installed; tracing disabled")
+            return
+        provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+        _otel_tracer = trace.get_tracer("deepr")
+
+
+_configure()
+
+
+def enabled() -> bool:
+    return _file_exporter is not None or _otel_tracer is not None
+
+
+def start_span(name: str, **attributes):
+    """Start a span that is not made current; the caller must pass it to end_span"""
+    if _otel_tracer is not None:
+        return _otel_tracer.start_span(name, attributes={k: v for k, v in attributes.items() if v is not None})
+    if _file_exporter is not None:
+        return Span(name, _current_span.get(), attributes)
+    return NOOP_SPAN
+
+
+def end_span(span, exc: Optional[BaseException] = None):
+    if span is NOOP_SPAN:
+        return
+    if exc is not None:
+        span.record_exception(exc)
+        if _otel_tracer is not None:
+            from opentelemetry.trace import Status, StatusCode
+            span.set_status(Status(StatusCode.ERROR))
+    span.end()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Run the block inside a span that is current for nested spans"""
+    if _otel_tracer is not None:
+        with _otel_tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}) as s:
+            yield s
+        return
+    if _file_exporter is None:
+        yield NOOP_SPAN
+        return
+
+    s = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.record_exception(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        s.end()
+
+
+def current_span():
+    if _otel_tracer is not None:
+        from opentelemetry import trace
+        return trace.get_current_span()
+    return _current_span.get() or NOOP_SPAN
+
+
+class TracingMiddleware:
+    """ASGI middleware opening one span per HTTP request, kept open until a streamed body finishes"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not enabled():
+            await self.app(scope, receive, send)
+            return
+
+        with span(f"HTTP {scope['method']} {scope['path']}", **{"http.method": scope["method"], "http.target": scope["path"]}) as s:
+            async def traced_send(message):
+                if message["type"] == "http.response.start":
+                    s.set_attribute("http.status_code", message["status"])
+                await send(message)
+
+            await self.app(scope, receive, traced_send)
+            route = scope.get("route")
+            if route is not None and hasattr(route, "path"):
+                s.set_attribute("http.route", route.path)
+
+
+def instrument_engine(engine):
+    """Emit a span for every SQL statement executed through the given AsyncEngine"""
+    from sqlalchemy import event
+
+    if not enabled():
+        return
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._deepr_span = start_span(
+            "db.query",
+            **{
+                "db.system": conn.dialect.name,
+                "db.statement": statement[:MAX_STATEMENT_LENGTH],
+                "db.operation": statement.split(None, 1)[0].upper() if statement else None,
+            }
+        )
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        s = getattr(context, "_deepr_span", None)
+        if s is not None:
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                s.set_attribute("db.rowcount", cursor.rowcount)
+            end_span(s)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _error(exception_context):
+        s = getattr(exception_context.execution_context, "_deepr_span", None) if exception_context.execution_context else None
+        if s is not None:
+            end_span(s, exception_context.original_exception)
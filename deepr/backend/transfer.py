@@ -0,0 +1,356 @@
+"""
+Streaming export and import of a user's conversations.
+
+An export is two streams:
+- records: NDJSON, one JSON object per line tagged with its `kind`, written
+  conversation by conversation. Each conversation is followed by the prompts
+  its nodes use (once per distinct prompt), its nodes in creation order and
+  the metadata of their attachments.
+- blobs: an uncompressed tar with one `attachments/<id>` member per
+  attachment, holding the file data that the records leave out.
+
+Both are produced from server-side cursors with bounded batches, so memory
+stays flat however large the account is. Importing creates new rows for the
+importing user and remaps ids; node and attachment ids only need to be
+unique within a conversation, so the id map is reset per conversation.
+
+    python -m transfer export --email me@example.com --records runs.ndjson --blobs runs.tar
+    python -m transfer import --email me@example.com --records runs.ndjson --blobs runs.tar
+"""
+import argparse
+import asyncio
+import json
+import tarfile
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth import get_current_user
+from database import get_db
+from extraction import extract_attachment
+from images import thumbnail_columns
+from models import Attachment, Conversation, Node, PromptBlob, User
+from sse import dumps
+from storage import decompress_prompt, store_prompt
+
+router = APIRouter()
+
+FORMAT_VERSION = 1
+# Conversations fetched per page and rows per server-side cursor batch
+CONVERSATION_PAGE = 100
+NODE_BATCH = 200
+BLOB_BATCH = 8
+# Rows inserted before an import commits
+IMPORT_COMMIT_EVERY = 500
+READ_CHUNK = 64 * 1024
+
+NODE_FIELDS = (
+    "id", "parent_id", "type", "content", "content_encoding", "model_name", "attachment_filenames",
+    "prompt_hash", "prompt_sent", "estimated_cost", "actual_cost", "warnings", "request_started_at",
+    "first_token_at", "completed_at", "persisted_at", "retry_count", "created_at",
+)
+NODE_DATETIMES = ("request_started_at", "first_token_at", "completed_at", "persisted_at", "created_at")
+ATTACHMENT_FIELDS = ("id", "node_id", "filename", "file_type", "mime_type", "file_size", "created_at")
+
+
+def _line(record: Dict) -> bytes:
+    return dumps(record) + b"\n"
+
+
+def _blob_name(attachment_id: int) -> str:
+    return f"attachments/{attachment_id}"
+
+
+async def _conversation_pages(db: AsyncSession, user_id: int) -> AsyncIterator[Conversation]:
+    """Keyset-paginate a user's conversations so no cursor stays open across pages"""
+    last_id = 0
+    while True:
+        result = await db.execute(
+            select(Conversation)
+            .where(Conversation.user_id == user_id, Conversation.deleted_at.is_(None), Conversation.id > last_id)
+            .order_by(Conversation.id)
+            .limit(CONVERSATION_PAGE)
+        )
+        page = result.scalars().all()
+        if not page:
+            return
+        for conversation in page:
+            yield conversation
+        last_id = page[-1].id
+
+
+async def export_records(db: AsyncSession, user_id: int) -> AsyncIterator[bytes]:
+    yield _line({"kind": "header", "version": FORMAT_VERSION, "exported_at": datetime.now(timezone.utc)})
+    node_columns = [getattr(Node, name) for name in NODE_FIELDS]
+    attachment_columns = [getattr(Attachment, name) for name in ATTACHMENT_FIELDS]
+
+    async for conversation in _conversation_pages(db, user_id):
+        yield _line({
+            "kind": "conversation", "id": conversation.id, "title": conversation.title,
+            "method": conversation.method, "created_at": conversation.created_at,
+        })
+
+        # Prompts first, so an importer can store them before the nodes that reference them
+        prompts = await db.stream(
+            select(PromptBlob.hash, PromptBlob.encoding, PromptBlob.data)
+            .where(PromptBlob.hash.in_(select(Node.prompt_hash).where(Node.conversation_id == conversation.id)))
+            .execution_options(yield_per=NODE_BATCH)
+        )
+        async for digest, encoding, data in prompts:
+            yield _line({"kind": "prompt", "hash": digest, "text": decompress_prompt(encoding, data)})
+
+        nodes = await db.stream(
+            select(*node_columns)
+            .where(Node.conversation_id == conversation.id)
+            .order_by(Node.id)
+            .execution_options(yield_per=NODE_BATCH)
+        )
+        async for row in nodes:
+            yield _line({"kind": "node", **dict(zip(NODE_FIELDS, row))})
+
+        attachments = await db.stream(
+            select(*attachment_columns)
+            .join(Node, Node.id == Attachment.node_id)
+            .where(Node.conversation_id == conversation.id)
+            .order_by(Attachment.id)
+            .execution_options(yield_per=NODE_BATCH)
+        )
+        async for row in attachments:
+            yield _line({"kind": "attachment", **dict(zip(ATTACHMENT_FIELDS, row))})
+
+
+class _TarBuffer:
+    """Write-only file object that hands tar output back in chunks"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+async def export_blobs(db: AsyncSession, user_id: int) -> AsyncIterator[bytes]:
+    buffer = _TarBuffer()
+    tar = tarfile.open(fileobj=buffer, mode="w|")
+    rows = await db.stream(
+        select(Attachment.id, Attachment.file_data)
+        .join(Node, Node.id == Attachment.node_id)
+        .join(Conversation, Conversation.id == Node.conversation_id)
+        .where(Conversation.user_id == user_id, Conversation.deleted_at.is_(None))
+        .order_by(Attachment.id)
+        .execution_options(yield_per=BLOB_BATCH)
+    )
+    async for attachment_id, data in rows:
+        info = tarfile.TarInfo(_blob_name(attachment_id))
+        info.size = len(data)
+        tar.addfile(info, BytesIO(data))
+        yield buffer.drain()
+    tar.close()
+    yield buffer.drain()
+
+
+async def _parse_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Dict]:
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")) if isinstance(value, str) else value
+
+
+def _read_blob(blobs: Optional[tarfile.TarFile], attachment_id: int) -> Optional[bytes]:
+    if blobs is None:
+        return None
+    try:
+        member = blobs.extractfile(_blob_name(attachment_id))
+    except KeyError:
+        return None
+    return member.read() if member is not None else None
+
+
+async def import_records(
+    db: AsyncSession, user_id: int, records: AsyncIterator[bytes], blobs: Optional[tarfile.TarFile] = None
+) -> Dict[str, int]:
+    """Create the exported conversations for `user_id`; returns counts of what was imported"""
+    counts = {"conversations": 0, "nodes": 0, "prompts": 0, "attachments": 0, "missing_blobs": 0}
+    conversation_id = None
+    node_ids: Dict[int, int] = {}
+    prompt_hashes = set()
+    pending = 0
+
+    async for record in _parse_lines(records):
+        kind = record.get("kind")
+        if kind == "header":
+            if record.get("version") != FORMAT_VERSION:
+                raise ValueError(f"Unsupported export version {record.get('version')}")
+            continue
+        if kind == "conversation":
+            conversation = Conversation(
+                user_id=user_id, title=record.get("title"), method=record.get("method"),
+                created_at=_parse_datetime(record.get("created_at")),
+            )
+            db.add(conversation)
+            await db.flush()
+            conversation_id = conversation.id
+            node_ids = {}
+            prompt_hashes = set()
+            counts["conversations"] += 1
+        elif kind == "prompt":
+            prompt_hashes.add(await store_prompt(db, record["text"]))
+            counts["prompts"] += 1
+        elif kind == "node":
+            if conversation_id is None:
+                raise ValueError("Node record before any conversation record")
+            fields = {name: record.get(name) for name in NODE_FIELDS if name not in ("id", "parent_id")}
+            for name in NODE_DATETIMES:
+                fields[name] = _parse_datetime(fields[name])
+            if fields["prompt_hash"] not in prompt_hashes:
+                fields["prompt_hash"] = None
+            node = Node(
+                conversation_id=conversation_id,
+                parent_id=node_ids.get(record.get("parent_id")),
+                **fields,
+            )
+            db.add(node)
+            await db.flush()
+            node_ids[record["id"]] = node.id
+            counts["nodes"] += 1
+        elif kind == "attachment":
+            data = await asyncio.to_thread(_read_blob, blobs, record["id"])
+            if data is None or record.get("node_id") not in node_ids:
+                counts["missing_blobs"] += 1
+                continue
+            db.add(Attachment(
+                node_id=node_ids[record["node_id"]], filename=record["filename"], file_type=record["file_type"],
+                mime_type=record["mime_type"], file_data=data, file_size=len(data),
+                created_at=_parse_datetime(record.get("created_at")),
+                **await extract_attachment(record["file_type"], data),
+                **await thumbnail_columns(record["file_type"], data, record["mime_type"]),
+            ))
+            counts["attachments"] += 1
+        else:
+            raise ValueError(f"Unknown record type {kind!r}")
+
+        pending += 1
+        if pending >= IMPORT_COMMIT_EVERY:
+            await db.commit()
+            pending = 0
+
+    await db.commit()
+    return counts
+
+
+async def _upload_chunks(upload: UploadFile) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(READ_CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+@router.get("/history/export")
+async def export_history(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    return StreamingResponse(
+        export_records(db, current_user.id), media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="deepr-history.ndjson"'}
+    )
+
+
+@router.get("/history/export/blobs")
+async def export_history_blobs(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    return StreamingResponse(
+        export_blobs(db, current_user.id), media_type="application/x-tar",
+        headers={"Content-Disposition": 'attachment; filename="deepr-attachments.tar"'}
+    )
+
+
+@router.post("/history/import")
+async def import_history(
+    records: UploadFile = File(...),
+    blobs: Optional[UploadFile] = File(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    # Uploads are spooled to disk by Starlette, so the tar can be read with random access
+    archive = await asyncio.to_thread(tarfile.open, fileobj=blobs.file, mode="r:") if blobs else None
+    try:
+        return await import_records(db, current_user.id, _upload_chunks(records), archive)
+    except (ValueError, KeyError, tarfile.TarError) as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=f"Invalid export: {e}")
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+async def _file_chunks(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, READ_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def _run_cli(args):
+    from database import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as db:
+        user = (await db.execute(select(User).where(User.email == args.email))).scalars().first()
+        if user is None:
+            raise SystemExit(f"No user with email {args.email}")
+
+        if args.command == "export":
+            with open(args.records, "wb") as out:
+                async for chunk in export_records(db, user.id):
+                    out.write(chunk)
+            if args.blobs:
+                with open(args.blobs, "wb") as out:
+                    async for chunk in export_blobs(db, user.id):
+                        out.write(chunk)
+            print(f"Exported {args.email} to {args.records}" + (f" and {args.blobs}" if args.blobs else ""))
+        else:
+            archive = tarfile.open(args.blobs, mode="r:") if args.blobs else None
+            try:
+                counts = await import_records(db, user.id, _file_chunks(args.records), archive)
+            finally:
+                if archive is not None:
+                    archive.close()
+            print(json.dumps(counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("--email", required=True, help="Account to export from or import into")
+    parser.add_argument("--records", required=True, help="NDJSON records file")
+    parser.add_argument("--blobs", help="Tar archive with attachment data")
+    asyncio.run(_run_cli(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
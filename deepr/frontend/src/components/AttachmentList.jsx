@@ -1,4 +1,4 @@
-import React from 'react';
+import React, { useEffect, useState } from 'react';
 import { FileText, Image, FileCode, File, Download, X } from 'lucide-react';
 import { API_URL } from '../config';
 
@@ -15,6 +15,35 @@ const getFileIcon = (fileType) => {
     }
 };
 
+// Saved images have dimensions and a server-side thumbnail; fall back to the icon while it loads or if it is missing
+const AttachmentIcon = ({ att }) => {
+    const [src, setSrc] = useState(null);
+
+    useEffect(() => {
+        if (att.file_type !== 'image' || !att.width) return undefined;
+        let url = null;
+        let cancelled = false;
+        fetch(`${API_URL}/api/attachments/${att.id}/thumbnail`, {
+            headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+        })
+            .then(response => (response.ok ? response.blob() : null))
+            .then(blob => {
+                if (blob && !cancelled) {
+                    url = window.URL.createObjectURL(blob);
+                    setSrc(url);
+                }
+            })
+            .catch(() => {});
+        return () => {
+            cancelled = true;
+            if (url) window.URL.revokeObjectURL(url);
+        };
+    }, [att.id, att.file_type, att.width]);
+
+    if (!src) return getFileIcon(att.file_type);
+    return <img src={src} alt="" className="w-8 h-8 object-cover rounded" />;
+};
+
 const formatFileSize = (bytes) => {
     if (bytes < 1024) return `${bytes} B`;
     if (bytes < 1024 * 1024) return `${(bytes / 1024).toFixed(1)} KB`;
@@ -59,7 +88,7 @@ const AttachmentList = ({ attachments, onRemove, uploading }) => {
                     className="flex items-center gap-2 bg-slate-800 hover:bg-slate-700 border border-slate-700 rounded px-3 py-2 text-sm text-slate-300 transition-colors group relative pr-8 pl-3"
                 >
                     <div onClick={() => handleDownload(att.id, att.filename)} className="flex items-center gap-2 cursor-pointer flex-1">
-                        {getFileIcon(att.file_type)}
+                        <AttachmentIcon att={att} />
                         <span className="max-w-[200px] truncate" title={att.filename}>{att.filename}</span>
                         <span className="text-xs text-slate-500">({formatFileSize(att.file_size)})</span>
                     </div>
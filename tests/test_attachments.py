@@ -0,0 +1,163 @@
+from types import SimpleNamespace
+
+import pytest
+
+# Assuming PYTHONPATH includes deepr/backend
+import extraction
+import openrouter_service
+from openrouter_service import build_messages_with_attachments, get_unsupported_attachments
+from prompt_cache import build_messages
+
+
+def _pdf(extracted_text="page one\n\npage two"):
+    return SimpleNamespace(
+        filename="report.pdf", file_type="pdf", mime_type="application/pdf",
+        file_data=b"%PDF-1.7 raw bytes", extracted_text=extracted_text, page_count=2,
+    )
+
+
+@pytest.fixture
+def capabilities(monkeypatch):
+    monkeypatch.setattr(openrouter_service, "_CAPABILITIES_BY_MODEL", {
+        "text/only": {"text": True, "file": False},
+        "files/ok": {"text": True, "file": True},
+    })
+    monkeypatch.setattr(openrouter_service, "_CACHED_MODELS_BY_USER", {
+        1: [{"id": "text/only", "capabilities": {"text": True, "file": False}}],
+    })
+
+
+def test_extract_text(monkeypatch):
+    assert extraction.extract_text("text", "héllo".encode()) == {"extracted_text": "héllo", "page_count": None, "token_estimate": 2}
+    assert extraction.extract_text("image", b"\x89PNG") is None
+
+    monkeypatch.setattr(extraction, "pypdf", None)
+    assert extraction.extract_text("pdf", b"%PDF") is None
+    monkeypatch.setattr(extraction, "pypdf", object())
+    monkeypatch.setattr(extraction, "_pdf_text", lambda data: ("page one\n\npage two", 2))
+    assert extraction.extract_text("pdf", b"%PDF")["page_count"] == 2
+    monkeypatch.setattr(extraction, "_pdf_text", lambda data: ("  \n\n ", 1))
+    assert extraction.extract_text("pdf", b"%PDF") is None
+
+
+def test_pdf_sent_as_text_only_to_models_without_file_input(capabilities):
+    def first_part(model, attachment):
+        messages = build_messages_with_attachments(build_messages("Summarise", "Answer."), [attachment], model)
+        return messages[1]["content"][0]
+
+    assert first_part("text/only", _pdf()) == {"type": "text", "text": "Contents of report.pdf:\n\npage one\n\npage two"}
+    assert first_part("files/ok", _pdf())["type"] == "file"
+    assert first_part("unknown/model", _pdf())["type"] == "file"
+    assert first_part("text/only", _pdf(extracted_text=None))["type"] == "file"
+
+    assert get_unsupported_attachments("text/only", [_pdf()], user_id=1) == []
+    assert len(get_unsupported_attachments("text/only", [_pdf(extracted_text=None)], user_id=1)) == 1
+
+
+def test_pdf_as_text_policy(capabilities, monkeypatch):
+    monkeypatch.setattr(extraction, "PDF_AS_TEXT", "always")
+    assert extraction.send_pdf_as_text(_pdf(), True)
+    monkeypatch.setattr(extraction, "PDF_AS_TEXT", "never")
+    assert not extraction.send_pdf_as_text(_pdf(), False)
+
+
+def test_text_attachments_use_extracted_text():
+    attachment = SimpleNamespace(filename="log.txt", file_type="text", mime_type="text/plain", file_data=b"raw", extracted_text="cached")
+    messages = build_messages_with_attachments(build_messages("Why?", "Answer."), [attachment])
+    assert messages[1]["content"][0] == {"type": "text", "text": "cached"}
+
+
+def _png(width, height, mode="RGB"):
+    from io import BytesIO
+    from PIL import Image
+    out = BytesIO()
+    Image.effect_noise((width, height), 64).convert(mode).save(out, format="PNG")
+    return out.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_images_downsized_per_provider_profile_and_cached(monkeypatch):
+    pytest.importorskip("PIL")
+    import images
+    monkeypatch.setattr(images, "_cache", images.OrderedDict())
+    monkeypatch.setattr(images, "_cache_bytes", 0)
+    calls = []
+    normalize = images.normalize_image
+    monkeypatch.setattr(images, "normalize_image", lambda *args: calls.append(args[2:]) or normalize(*args))
+
+    photo = SimpleNamespace(id=7, filename="photo.png", file_type="image", mime_type="image/png", file_data=_png(3000, 2000))
+    icon = SimpleNamespace(id=8, filename="icon.png", file_type="image", mime_type="image/png", file_data=_png(16, 16))
+
+    sent = await images.prepare_images([photo, icon], "openai/gpt-4o")
+    assert sent[1] is icon
+    assert sent[0].mime_type == "image/jpeg" and len(sent[0].file_data) < len(photo.file_data)
+    from io import BytesIO
+    from PIL import Image
+    assert Image.open(BytesIO(sent[0].file_data)).size == (1152, 768)
+
+    again = await images.prepare_images([photo], "openai/gpt-4o-mini")
+    assert again[0].file_data == sent[0].file_data
+    await images.prepare_images([photo], "anthropic/claude-sonnet-4")
+    assert calls == [(2048, 768), (2048, 768), (1568, 1568)]
+
+
+def test_thumbnail_keeps_dimensions():
+    pytest.importorskip("PIL")
+    import images
+    columns = images.make_thumbnail(_png(1000, 500, "RGBA"), "image/png")
+    assert (columns["width"], columns["height"]) == (1000, 500)
+    assert columns["thumbnail"][:4] == b"RIFF"
+    assert images.make_thumbnail(b"not an image", "image/png") == {}
+
+
+def test_chunks_follow_lines():
+    import retrieval
+    text = "".join(f"line {i}\n" for i in range(1, 301)) + "x" * 4000 + "\nlast\n"
+    chunks = retrieval.chunk_text(text, chunk_chars=500)
+    assert "".join(chunk for _, _, chunk in chunks) == text
+    assert chunks[0][:2] == (1, 63) and chunks[1][0] == 64
+    assert all(len(chunk) <= 500 for _, _, chunk in chunks)
+    assert [chunk[:2] for chunk in chunks[-9:]] == [(301, 301)] * 8 + [(301, 302)]
+
+
+@pytest.mark.asyncio
+async def test_large_text_attachment_sends_relevant_excerpts(monkeypatch):
+    import retrieval
+    monkeypatch.setattr(retrieval, "MIN_TOKENS", 1000)
+    monkeypatch.setattr(retrieval, "TOKEN_BUDGET", 800)
+    lines = [f"{i:05d} INFO request served in {i % 97} ms by worker-{i % 7}\n" for i in range(2000)]
+    lines[1234] = "01234 ERROR database connection pool exhausted (PoolTimeout)\n"
+    log = SimpleNamespace(id=None, filename="app.log", file_type="text", mime_type="text/plain", file_data=b"", extracted_text="".join(lines), token_estimate=40000)
+    small = SimpleNamespace(id=None, filename="notes.txt", file_type="text", mime_type="text/plain", file_data=b"", extracted_text="short", token_estimate=2)
+
+    messages = build_messages("Why did the connection pool get exhausted?", "You are the SRE.")
+    prepared = await retrieval.prepare_text([log, small], messages)
+    assert prepared[1] is small
+    excerpt = prepared[0].extracted_text
+    assert excerpt.startswith("Excerpts from app.log (")
+    assert "PoolTimeout" in excerpt and "--- lines 12" in excerpt
+    assert extraction.estimate_tokens(excerpt) < 1000
+
+    messages = build_messages_with_attachments(messages, prepared)
+    assert messages[1]["content"][0]["text"] == excerpt
+
+
+@pytest.mark.asyncio
+async def test_background_index_failure_is_logged(monkeypatch, caplog):
+    import asyncio
+    import retrieval
+    monkeypatch.setattr(retrieval, "MIN_TOKENS", 10)
+    # A legacy row whose bytes are not UTF-8 and that has no extracted text
+    legacy = SimpleNamespace(id=41, filename="legacy.txt", file_type="text", mime_type="text/plain",
+                             file_data=b"\xff\xfe" * 100, extracted_text=None, token_estimate=100)
+
+    retrieval.index_in_background(legacy)
+    assert len(retrieval._background) == 1
+    task = next(iter(retrieval._background))
+    await asyncio.wait([task])
+    await asyncio.sleep(0)
+
+    assert not retrieval._background
+    [record] = [r for r in caplog.records if r.name == "retrieval"]
+    assert record.getMessage() == "indexing attachment 41 failed"
+    assert isinstance(record.exc_info[1], UnicodeDecodeError)
@@ -6,10 +6,16 @@ import json
 from main import app
 from database import get_db, Base, engine
 from models import User, UserSettings, NodeType
+import auth
 from auth import create_access_token
 from encryption import encrypt_key
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from query_stats import assert_query_budget, instrument_engine
+
+# Statement budgets for N+1 regression guards; lower them when an endpoint gets cheaper
+QUERY_BUDGET_HISTORY = 3
+QUERY_BUDGET_ENSEMBLE_RUN = 30
 
 # Configure asyncio mode
 pytest_plugins = ('pytest_asyncio',)
@@ -23,6 +29,7 @@ async def db_engine():
     # Use in-memory SQLite for testing
     # We need a new engine for in-memory to ensure it persists across the test
     test_engine = create_async_engine("sqlite+aiosqlite:///:memory:", echo=True)
+    instrument_engine(test_engine)
     async with test_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     yield test_engine
@@ -43,6 +50,8 @@ async def client(db_session):
         yield db_session
 
     app.dependency_overrides[get_db] = override_get_db
+    # Every test starts from a fresh database, so cached users from earlier tests are stale
+    auth._user_cache.clear()
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
         yield c
     app.dependency_overrides.clear()
@@ -207,3 +216,586 @@ async def test_dag_method(client, auth_token):
         node_types = [e['node']['type'] for e in events if e.get('type') == 'node']
         assert 'plan' in node_types
         assert 'research' in node_types
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client, local_user, monkeypatch):
+    from metrics import observe_phase
+    with observe_phase("dag", "research"):
+        pass
+
+    # Admins or the scraper token only
+    user, token = local_user
+    assert (await client.get("/metrics")).status_code == 401
+    assert (await client.get("/metrics", headers={"Authorization": f"Bearer {token}"})).status_code == 403
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "scrape-secret")
+    assert (await client.get("/metrics", headers={"Authorization": "Bearer scrape-secret-2"})).status_code == 401
+    monkeypatch.setattr(auth, "ADMIN_EMAILS", {user.email})
+    assert (await client.get("/metrics", headers={"Authorization": f"Bearer {token}"})).status_code == 200
+
+    response = await client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == 200
+    body = response.text
+    assert '# TYPE deepr_phase_duration_seconds histogram' in body
+    assert 'deepr_phase_duration_seconds_count{method="dag",phase="research"}' in body
+    assert 'deepr_temp_upload_bytes' in body
+    assert 'deepr_sse_connections' in body
+
+@pytest.fixture(scope="function")
+async def local_user(db_session):
+    # User without an OpenRouter key, for endpoints that never call a model
+    user = User(email="local@example.com")
+    db_session.add(user)
+    await db_session.commit()
+    await db_session.refresh(user)
+    return user, create_access_token(data={"sub": user.email})
+
+@pytest.mark.asyncio
+async def test_conversation_timeline(client, db_session, local_user):
+    from datetime import datetime, timedelta, timezone
+    from models import Conversation, Node
+    user, token = local_user
+    t0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    conversation = Conversation(user_id=user.id, title="timeline", method="ensemble", created_at=t0)
+    db_session.add(conversation)
+    await db_session.commit()
+    root = Node(conversation_id=conversation.id, type="root", content="q", persisted_at=t0, created_at=t0)
+    db_session.add(root)
+    await db_session.commit()
+    for model, seconds in [("fast/model", 2), ("slow/model", 10)]:
+        db_session.add(Node(
+            conversation_id=conversation.id, parent_id=root.id, type="research", content="a", model_name=model,
+            request_started_at=t0 + timedelta(seconds=1),
+            first_token_at=t0 + timedelta(seconds=1.5),
+            completed_at=t0 + timedelta(seconds=1 + seconds),
+            persisted_at=t0 + timedelta(seconds=11.2),
+            retry_count=0
+        ))
+    await db_session.commit()
+
+    response = await client.get(f"/history/{conversation.id}/timeline", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    data = response.json()
+
+    research = {n['model']: n for n in data['nodes'] if n['type'] == 'research'}
+    assert research['fast/model']['model_seconds'] == 2
+    assert research['fast/model']['persist_wait_seconds'] == 8.2
+    assert research['slow/model']['queue_seconds'] == 1
+    assert research['slow/model']['ttft_seconds'] == 0.5
+    phase = next(p for p in data['phases'] if p['type'] == 'research')
+    assert phase['start_offset'] == 1 and phase['end_offset'] == 11.2
+    assert data['total_seconds'] == 11.2
+
+@pytest.mark.asyncio
+async def test_history_query_budget(client, db_session, local_user):
+    from models import Attachment, Conversation, Node
+    user, token = local_user
+    conversation = Conversation(user_id=user.id, title="budget", method="ensemble")
+    db_session.add(conversation)
+    await db_session.commit()
+    parent_id = None
+    for i in range(10):
+        node = Node(conversation_id=conversation.id, parent_id=parent_id, type="research", content=f"node {i}")
+        db_session.add(node)
+        await db_session.commit()
+        db_session.add(Attachment(node_id=node.id, filename=f"{i}.txt", file_type="text", mime_type="text/plain", file_data=b"x", file_size=1))
+        await db_session.commit()
+        parent_id = node.id
+    db_session.expunge_all()
+
+    headers = {"Authorization": f"Bearer {token}"}
+    assert (await client.get("/history", headers=headers)).status_code == 200
+    # The user is cached now: conversation, nodes and one attachment load, independent of the number of nodes
+    with assert_query_budget(QUERY_BUDGET_HISTORY):
+        response = await client.get(f"/history/{conversation.id}", headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()['nodes']) == 10
+
+@pytest.mark.asyncio
+async def test_council_run_rejects_convergence_threshold_out_of_range(client, local_user):
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+    for threshold in (-0.1, 1.5):
+        payload = {"prompt": "q", "method": "dxo", "convergence_threshold": threshold}
+        response = await client.post("/council/run", json=payload, headers=headers)
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["body", "convergence_threshold"]
+
+@pytest.fixture(scope="function")
+async def fake_ensemble_run(client, db_session, local_user, monkeypatch):
+    """Runs an ensemble of three members against a stubbed OpenRouter; returns (events, auth headers)"""
+    from types import SimpleNamespace
+    from openrouter_service import OpenRouterClient
+    user, token = local_user
+    db_session.add(UserSettings(user_id=user.id, encrypted_api_key=encrypt_key("test-key", user.id)))
+    await db_session.commit()
+
+    async def fake_completion(self, model, messages, attachments=None, stream=False):
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"answer from {model}"))])
+        return response, {'actual_cost': 0.0, 'input_tokens': 1, 'output_tokens': 1}
+    monkeypatch.setattr(OpenRouterClient, "chat_completion_details", fake_completion)
+
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async def run():
+        payload = {"prompt": "q", "method": "ensemble", "council_members": ["a/one", "b/two", "c/three"], "chairman_model": "a/one"}
+        response = await client.post("/council/run", json=payload, headers=headers)
+        events = [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith("data: ")]
+        assert events[-1]['type'] == 'done'
+        return events, headers
+    return run
+
+@pytest.mark.asyncio
+async def test_council_run_query_budget(fake_ensemble_run):
+    with assert_query_budget(QUERY_BUDGET_ENSEMBLE_RUN):
+        await fake_ensemble_run()
+
+@pytest.mark.asyncio
+async def test_council_run_stores_shared_prompts_once(client, db_session, fake_ensemble_run):
+    events, headers = await fake_ensemble_run()
+    token = headers["Authorization"].split()[1]
+
+    # The three members got the same prompt, which is stored once
+    from sqlalchemy import func, select
+    from models import PromptBlob
+    assert (await db_session.execute(select(func.count()).select_from(PromptBlob))).scalar() == 2
+    streamed = {e['node']['id']: e['node']['prompt_sent'] for e in events if e['type'] == 'node'}
+    history = (await client.get(f"/history/{events[0]['conversation_id']}", headers={"Authorization": f"Bearer {token}"})).json()
+    assert {n['id']: n['prompt_sent'] for n in history['nodes'] if n['id'] in streamed} == streamed
+    assert all(prompt and "User Request:" in prompt for node_id, prompt in streamed.items() if node_id != events[1]['node']['id'])
+
+@pytest.mark.asyncio
+async def test_finished_run_replays_to_later_subscribers(client, fake_ensemble_run):
+    events, headers = await fake_ensemble_run()
+    token = headers["Authorization"].split()[1]
+    # A later subscriber to the same run replays it from the broker
+    conversation_id = events[0]['conversation_id']
+    response = await client.get(f"/runs/{conversation_id}/events", headers={"Authorization": f"Bearer {token}", "Last-Event-ID": "2"})
+    replayed = [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert replayed == events[2:]
+    response = await client.get(f"/runs/{conversation_id + 1000}/events", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 404
+
+@pytest.fixture(scope="function")
+def trace_spans(db_engine, monkeypatch):
+    """Collects the spans of the test with tracing switched on; returns the list they are appended to"""
+    from types import SimpleNamespace
+    import tracing
+    spans = []
+    monkeypatch.setattr(tracing, "_file_exporter", SimpleNamespace(export=spans.append))
+    # The engine was created with tracing off
+    tracing.instrument_engine(db_engine)
+    return spans
+
+@pytest.mark.asyncio
+async def test_request_trace(client, db_session, local_user, trace_spans, monkeypatch):
+    from types import SimpleNamespace
+    from openai.resources.chat.completions import AsyncCompletions
+    user, token = local_user
+    db_session.add(UserSettings(user_id=user.id, encrypted_api_key=encrypt_key("test-key", user.id)))
+    await db_session.commit()
+
+    async def fake_create(self, model, messages, stream=False, **kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"answer from {model}"))], usage=None)
+    monkeypatch.setattr(AsyncCompletions, "create", fake_create)
+    trace_spans.clear()
+
+    payload = {"prompt": "q", "method": "ensemble", "council_members": ["a/one", "b/two"], "chairman_model": "a/one"}
+    response = await client.post("/council/run", json=payload, headers={"Authorization": f"Bearer {token}"})
+    events = [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert events[-1]['type'] == 'done'
+
+    roots = [s for s in trace_spans if s.parent_span_id is None]
+    assert [s.name for s in roots] == ["HTTP POST /council/run"]
+    root = roots[0]
+    assert root.attributes["http.status_code"] == 200
+    # One trace, every span hanging off the request span
+    by_id = {s.span_id: s for s in trace_spans}
+    assert {s.trace_id for s in trace_spans} == {root.trace_id}
+    assert all(s.parent_span_id in by_id for s in trace_spans if s is not root)
+
+    def parent(s):
+        return by_id[s.parent_span_id]
+    phases = {s.name: s for s in trace_spans if s.name.startswith("ensemble.")}
+    assert set(phases) == {"ensemble.research", "ensemble.synthesis"}
+    assert all(parent(s) is root for s in phases.values())
+    calls = [s for s in trace_spans if s.name == "openrouter.chat_completion"]
+    assert sorted((parent(s).name, s.attributes["llm.model"]) for s in calls) == [
+        ("ensemble.research", "a/one"), ("ensemble.research", "b/two"), ("ensemble.synthesis", "a/one"),
+    ]
+    queries = [s for s in trace_spans if s.name == "db.query"]
+    assert queries and all(s.attributes["db.system"] == "sqlite" for s in queries)
+    assert {parent(s).name for s in queries} >= {"HTTP POST /council/run", "ensemble.research"}
+
+@pytest.mark.asyncio
+async def test_admin_memory_profiling(client, local_user, monkeypatch):
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+    response = await client.post("/admin/memory/start", headers=headers)
+    assert response.status_code == 403
+
+    monkeypatch.setattr(auth, "ADMIN_EMAILS", {user.email})
+    try:
+        assert (await client.post("/admin/memory/start", headers=headers)).json()['tracing'] is True
+        snapshot = (await client.get("/admin/memory/snapshot?limit=5", headers=headers)).json()
+        assert snapshot['traced_bytes'] > 0 and len(snapshot['top']) == 5
+    finally:
+        await client.post("/admin/memory/stop", headers=headers)
+    assert (await client.get("/admin/memory/snapshot", headers=headers)).status_code == 409
+
+@pytest.mark.asyncio
+async def test_settings_update_invalidates_cached_user_and_key(client, local_user, monkeypatch):
+    from types import SimpleNamespace
+    from openrouter_service import OpenRouterClient
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+    used_keys = []
+
+    async def fake_completion(self, model, messages, attachments=None, stream=False):
+        used_keys.append(self.api_key)
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="ok"))])
+        return response, {'actual_cost': 0.0, 'input_tokens': 1, 'output_tokens': 1}
+    monkeypatch.setattr(OpenRouterClient, "chat_completion_details", fake_completion)
+
+    # Creates the settings row and caches the user without a key
+    assert (await client.get("/settings", headers=headers)).json() == {"has_api_key": False}
+    payload = {"prompt": "q", "method": "ensemble", "council_members": ["a/one"], "chairman_model": "a/one"}
+    for key in ("first-key", "second-key"):
+        assert (await client.put("/settings", json={"openrouter_api_key": key}, headers=headers)).status_code == 200
+        response = await client.post("/council/run", json=payload, headers=headers)
+        assert response.status_code == 200, response.text
+        assert used_keys[-1] == key
+
+@pytest.mark.asyncio
+async def test_search_history(client, db_session, local_user):
+    from models import Conversation, Node
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+    other = User(email="other@example.com")
+    db_session.add(other)
+    await db_session.commit()
+
+    for owner, title, content in [
+        (user.id, "Cache design", "Use a write-through cache in front of Postgres."),
+        (user.id, "Unrelated", "Nothing about storage here; the CACHE is mentioned once."),
+        (user.id, "Gardening", "Tomatoes need sun."),
+        (other.id, "Cache design", "Someone else's cache notes."),
+    ]:
+        conversation = Conversation(user_id=owner, title=title, method="ensemble")
+        db_session.add(conversation)
+        await db_session.commit()
+        db_session.add(Node(conversation_id=conversation.id, type="research", content=content))
+        await db_session.commit()
+
+    results = (await client.get("/search?q=cache", headers=headers)).json()['results']
+    # Title matches rank first; other users' conversations are never returned
+    assert [r['title'] for r in results] == ["Cache design", "Unrelated"]
+    assert results[0]['title_highlight'] == "<mark>Cache</mark> design"
+    assert "<mark>CACHE</mark>" in results[1]['node']['snippet']
+
+    page = (await client.get("/search?q=cache&limit=1&offset=1", headers=headers)).json()
+    assert [r['title'] for r in page['results']] == ["Unrelated"] and page['has_more'] is False
+    assert (await client.get("/search?q=cache%20tomatoes", headers=headers)).json()['results'] == []
+
+
+def test_search_query_compiles_for_postgres():
+    from sqlalchemy.dialects import postgresql
+    from search import build_search_query
+    sql = str(build_search_query(1, 'cache -redis', 20, 0).compile(dialect=postgresql.dialect()))
+    assert "websearch_to_tsquery('english'::regconfig" in sql
+    assert "nodes.search_vector @@" in sql and "ts_rank_cd" in sql and "ts_headline" in sql
+
+def test_search_snippets_escape_model_output():
+    from sqlalchemy.dialects import postgresql
+    from search import build_search_query, highlight
+    snippet = highlight('Use <img src=x onerror="alert(1)"> & a cache <b>', ["cache", "img"])
+    assert snippet == 'Use &lt;<mark>img</mark> src=x onerror="alert(1)"&gt; &amp; a <mark>cache</mark> &lt;b&gt;'
+    assert highlight("<script>", []) == "&lt;script&gt;"
+    # Postgres escapes the text before ts_headline adds its marks
+    sql = str(build_search_query(1, 'cache', 20, 0).compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    assert "ts_headline('english'::regconfig, replace(replace(replace(coalesce(conversations.title" in sql
+
+@pytest.mark.asyncio
+async def test_prompt_blobs_dedupe_and_resolve_legacy_prompts(db_session):
+    from types import SimpleNamespace
+    from storage import store_prompt, resolve_node_prompts, compress_prompt, decompress_prompt
+    prompt = "Findings from Agent 1 ...\n" * 200
+    encoding, data = compress_prompt(prompt)
+    assert decompress_prompt(encoding, data) == prompt and len(data) < len(prompt) / 10
+
+    digest = await store_prompt(db_session, prompt)
+    assert await store_prompt(db_session, prompt) == digest
+    await db_session.commit()
+
+    nodes = [
+        SimpleNamespace(id=1, prompt_hash=digest, prompt_sent=None),
+        SimpleNamespace(id=2, prompt_hash=None, prompt_sent="legacy prompt"),
+        SimpleNamespace(id=3, prompt_hash=None, prompt_sent=None),
+    ]
+    assert await resolve_node_prompts(db_session, nodes) == {1: prompt, 2: "legacy prompt", 3: None}
+
+@pytest.mark.asyncio
+async def test_history_export_import_round_trip(client, db_session, local_user):
+    from models import Conversation, Node, Attachment
+    from storage import store_prompt
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+
+    conversation = Conversation(user_id=user.id, title="Exported", method="dag")
+    db_session.add(conversation)
+    await db_session.commit()
+    root = Node(conversation_id=conversation.id, type="root", content="question")
+    db_session.add(root)
+    await db_session.commit()
+    digest = await store_prompt(db_session, "shared prompt")
+    for i in range(2):
+        db_session.add(Node(conversation_id=conversation.id, parent_id=root.id, type="research", content=f"answer {i}", prompt_hash=digest))
+    db_session.add(Attachment(node_id=root.id, filename="a.bin", file_type="file", mime_type="application/octet-stream", file_data=b"\x00\x01blob", file_size=6))
+    await db_session.commit()
+
+    records = await client.get("/history/export", headers=headers)
+    assert records.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in records.content.splitlines()]
+    assert [line["kind"] for line in lines] == ["header", "conversation", "prompt", "node", "node", "node", "attachment"]
+    blobs = await client.get("/history/export/blobs", headers=headers)
+
+    importer = User(email="importer@example.com")
+    db_session.add(importer)
+    await db_session.commit()
+    importer_headers = {"Authorization": f"Bearer {create_access_token(data={'sub': importer.email})}"}
+    response = await client.post(
+        "/history/import", headers=importer_headers,
+        files={"records": ("h.ndjson", records.content), "blobs": ("h.tar", blobs.content)}
+    )
+    assert response.json() == {"conversations": 1, "nodes": 3, "prompts": 1, "attachments": 1, "missing_blobs": 0}
+
+    imported = (await client.get("/history", headers=importer_headers)).json()
+    assert [c["title"] for c in imported] == ["Exported"]
+    nodes = (await client.get(f"/history/{imported[0]['id']}", headers=importer_headers)).json()["nodes"]
+    by_type = {}
+    for node in nodes:
+        by_type.setdefault(node["type"], []).append(node)
+    assert [n["prompt_sent"] for n in by_type["research"]] == ["shared prompt", "shared prompt"]
+    assert all(n["parent_id"] == by_type["root"][0]["id"] for n in by_type["research"])
+    attachment_id = by_type["root"][0]["attachments"][0]["id"]
+    assert (await client.get(f"/attachments/{attachment_id}", headers=importer_headers)).content == b"\x00\x01blob"
+
+    response = await client.post("/history/import", headers=importer_headers, files={"records": ("h.ndjson", b'{"kind": "node"}\n')})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_retention_setting_survives_user_cache(client, local_user):
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+    # The first GET caches the user; the PUT must not leave a stale snapshot behind
+    assert (await client.get("/settings/retention", headers=headers)).json() == {"retention_days": None}
+    assert (await client.put("/settings/retention", json={"retention_days": 30}, headers=headers)).status_code == 200
+    assert (await client.get("/settings/retention", headers=headers)).json() == {"retention_days": 30}
+    assert (await client.get("/settings/retention", headers=headers)).json() == {"retention_days": 30}
+    assert (await client.put("/settings/retention", json={"retention_days": -1}, headers=headers)).status_code == 422
+
+@pytest.mark.asyncio
+async def test_maintenance_reclaims_orphans_and_expired_conversations(client, db_session, local_user, monkeypatch):
+    import time
+    import maintenance
+    from datetime import datetime, timedelta, timezone
+    from sqlalchemy import select, func
+    from models import Conversation, Node, Attachment, PromptBlob
+    from storage import store_prompt
+    from file_utils import temp_storage, reap_expired_uploads
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+    monkeypatch.setattr(maintenance, "PROMPT_BLOB_GRACE_SECONDS", -60)
+
+    temp_storage["stale"] = {"file_size": 10, "uploaded_at": 0}
+    temp_storage["fresh"] = {"file_size": 5, "uploaded_at": time.time()}
+    assert reap_expired_uploads() == {"deleted": 1, "bytes": 10}
+    assert "fresh" in temp_storage
+    del temp_storage["fresh"]
+
+    assert (await client.put("/settings/retention", json={"retention_days": 30}, headers=headers)).json() == {"retention_days": 30}
+    long_ago = datetime.now(timezone.utc) - timedelta(days=90)
+    old = Conversation(user_id=user.id, title="Old", created_at=long_ago)
+    recent = Conversation(user_id=user.id, title="Recent")
+    # Started long ago but continued today: retention counts from the last activity
+    continued = Conversation(user_id=user.id, title="Continued", created_at=long_ago)
+    db_session.add_all([old, recent, continued])
+    await db_session.commit()
+    old_prompt = await store_prompt(db_session, "old prompt")
+    kept_prompt = await store_prompt(db_session, "kept prompt")
+    old_node = Node(conversation_id=old.id, type="root", content="12345", prompt_hash=old_prompt, created_at=long_ago)
+    db_session.add_all([
+        old_node,
+        Node(conversation_id=recent.id, type="root", content="question", prompt_hash=kept_prompt),
+        Node(conversation_id=continued.id, type="root", content="first turn", created_at=long_ago),
+        Node(conversation_id=continued.id, type="research", content="today's turn"),
+    ])
+    await db_session.commit()
+    db_session.add_all([
+        Attachment(node_id=old_node.id, filename="old.bin", file_type="file", mime_type="application/octet-stream", file_data=b"x" * 100, file_size=100),
+        Attachment(node_id=None, filename="orphan.bin", file_type="file", mime_type="application/octet-stream", file_data=b"y" * 7, file_size=7),
+    ])
+    await db_session.commit()
+
+    dry = await maintenance.run_db_jobs(db_session, dry_run=True)
+    assert dry["retention"]["deleted"] == 1 and dry["retention"]["bytes"] == 105
+    assert (await db_session.execute(select(func.count(Conversation.id)))).scalar() == 3
+
+    reports = await maintenance.run_db_jobs(db_session)
+    assert {job: report["deleted"] for job, report in reports.items()} == {"deleted": 0, "retention": 1, "attachments": 1, "prompt_blobs": 1}
+    assert reports["attachments"]["bytes"] == 7
+    assert (await db_session.execute(select(Conversation.title))).scalars().all() == ["Recent", "Continued"]
+    assert (await db_session.execute(select(PromptBlob.hash))).scalars().all() == [kept_prompt]
+    assert (await db_session.execute(select(func.count(Attachment.id)))).scalar() == 0
+
+@pytest.mark.asyncio
+async def test_delete_conversations_hides_then_purges(client, db_session, local_user):
+    import maintenance
+    from sqlalchemy import select
+    from models import Conversation, Node, Attachment
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+
+    conversations = [Conversation(user_id=user.id, title=f"Run {i}") for i in range(3)]
+    db_session.add_all(conversations)
+    await db_session.commit()
+    for conversation in conversations:
+        root = Node(conversation_id=conversation.id, type="root", content="question")
+        db_session.add(root)
+        await db_session.commit()
+        db_session.add_all([
+            Node(conversation_id=conversation.id, parent_id=root.id, type="research", content="answer"),
+            Attachment(node_id=root.id, filename="a.txt", file_type="text", mime_type="text/plain", file_data=b"data", file_size=4),
+        ])
+    await db_session.commit()
+    first, second, kept = [c.id for c in conversations]
+
+    assert (await client.delete(f"/history/{first}", headers=headers)).json() == {"deleted": [first]}
+    assert (await client.delete(f"/history/{first}", headers=headers)).status_code == 404
+    response = await client.post("/history/delete", json={"conversation_ids": [second, first, 9999]}, headers=headers)
+    assert response.json() == {"deleted": [second]}
+    assert (await client.post("/history/delete", json={"conversation_ids": []}, headers=headers)).status_code == 422
+
+    assert [c["id"] for c in (await client.get("/history", headers=headers)).json()] == [kept]
+    assert (await client.get(f"/history/{second}", headers=headers)).status_code == 404
+    assert [r["conversation_id"] for r in (await client.get("/search?q=answer", headers=headers)).json()["results"]] == [kept]
+
+    await maintenance._purge_task
+    assert (await db_session.execute(select(Conversation.id))).scalars().all() == [kept]
+    assert set((await db_session.execute(select(Node.conversation_id))).scalars().all()) == {kept}
+    assert len((await db_session.execute(select(Attachment.id))).scalars().all()) == 1
+
+@pytest.mark.asyncio
+async def test_run_deadline_cancels_stragglers(client, db_session, local_user, monkeypatch):
+    from types import SimpleNamespace
+    from openrouter_service import OpenRouterClient
+    user, token = local_user
+    db_session.add(UserSettings(user_id=user.id, encrypted_api_key=encrypt_key("test-key", user.id)))
+    await db_session.commit()
+
+    cancelled = []
+    synthesis_prompts = []
+
+    async def fake_completion(self, model, messages, attachments=None, stream=False):
+        if model == "slow/model":
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.append(model)
+                raise
+        if model == "chair/model":
+            synthesis_prompts.append(json.dumps(messages))
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"answer from {model}"))])
+        return response, {'actual_cost': 0.0}
+    monkeypatch.setattr(OpenRouterClient, "chat_completion_details", fake_completion)
+
+    payload = {"prompt": "q", "method": "ensemble", "council_members": ["fast/model", "slow/model"],
+               "chairman_model": "chair/model", "deadline_seconds": 0.2}
+    response = await client.post("/council/run", json=payload, headers={"Authorization": f"Bearer {token}"})
+    events = [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert events[-1]['type'] == 'done'
+
+    nodes = [e['node'] for e in events if e['type'] == 'node']
+    assert [n['model'] for n in nodes if n['type'] == 'research'] == ["fast/model"]
+    synthesis = [n for n in nodes if n['type'] == 'synthesis'][0]
+    assert synthesis['warnings'] == ["No response before the 0.2s run deadline: slow/model (research)"]
+    assert cancelled == ["slow/model"]
+    assert "answer from fast/model" in str(synthesis_prompts) and "slow/model" not in str(synthesis_prompts)
+
+@pytest.mark.asyncio
+async def test_superchat_follow_up_subscription_sees_new_turn(client, db_session, local_user, monkeypatch):
+    from types import SimpleNamespace
+    from openrouter_service import OpenRouterClient
+    from pubsub import get_broker
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+    db_session.add(UserSettings(user_id=user.id, encrypted_api_key=encrypt_key("test-key", user.id)))
+    await db_session.commit()
+
+    turn = {"number": 1}
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def fake_completion(self, model, messages, attachments=None, stream=False):
+        if turn["number"] == 2 and model == "a/member":
+            started.set()
+            await release.wait()
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"turn {turn['number']} from {model}"))])
+        return response, {'actual_cost': 0.0}
+    monkeypatch.setattr(OpenRouterClient, "chat_completion_details", fake_completion)
+
+    def parse(response):
+        return [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+    payload = {"prompt": "first", "council_members": ["a/member"], "chairman_model": "b/chair"}
+    first = parse(await client.post("/superchat/chat", json=payload, headers=headers))
+    conversation_id = first[0]['conversation_id']
+    assert first[-1]['type'] == 'done'
+
+    # Second turn of the same conversation, while the first run is still within its replay window
+    turn["number"] = 2
+    payload.update(prompt="second", conversation_id=conversation_id)
+    second_task = asyncio.create_task(client.post("/superchat/chat", json=payload, headers=headers))
+    await asyncio.wait_for(started.wait(), 5)
+    subscriber = asyncio.create_task(client.get(f"/runs/{conversation_id}/events", headers=headers))
+    channel = get_broker()._channels[conversation_id]
+    for _ in range(100):
+        if channel.subscribers:
+            break
+        await asyncio.sleep(0.01)
+    release.set()
+
+    second = parse(await asyncio.wait_for(second_task, 5))
+    followed = parse(await asyncio.wait_for(subscriber, 5))
+    assert second[-1]['type'] == 'done'
+    assert followed == second
+    assert "turn 2 from b/chair" in [e['node']['content'] for e in followed if e['type'] == 'node']
+
+@pytest.mark.asyncio
+async def test_delete_during_live_run_purges_after_it_ends(client, db_session, local_user, monkeypatch):
+    import maintenance
+    from sqlalchemy import select
+    from models import Conversation, Node
+    from pubsub import get_broker
+    monkeypatch.setattr(maintenance, "LIVE_RUN_RECHECK_SECONDS", 0.05)
+    user, token = local_user
+    headers = {"Authorization": f"Bearer {token}"}
+
+    conversation = Conversation(user_id=user.id, title="streaming")
+    db_session.add(conversation)
+    await db_session.commit()
+    broker = get_broker()
+    await broker.publish(conversation.id, 1, {'type': 'start', 'conversation_id': conversation.id})
+    assert broker.is_running(conversation.id)
+
+    assert (await client.delete(f"/history/{conversation.id}", headers=headers)).json() == {"deleted": [conversation.id]}
+    await asyncio.sleep(0.1)
+    # The run keeps writing into its (hidden) conversation meanwhile
+    db_session.add(Node(conversation_id=conversation.id, type="research", content="late answer"))
+    await db_session.commit()
+    assert not maintenance._purge_task.done()
+    assert (await db_session.execute(select(Conversation.id))).scalars().all() == [conversation.id]
+
+    await broker.publish(conversation.id, 2, {'type': 'done'})
+    await asyncio.wait_for(maintenance._purge_task, 5)
+    assert (await db_session.execute(select(Conversation.id))).scalars().all() == []
+    assert (await db_session.execute(select(Node.id))).scalars().all() == []
@@ -0,0 +1,183 @@
+"""
+Microbenchmarks for per-request CPU hot paths in the backend.
+
+Skipped unless DEEPR_BENCHMARK=1. Each benchmark is compared against the
+per-call time stored in tests/benchmark_baselines.json and fails when it is
+more than DEEPR_BENCHMARK_THRESHOLD (default 1.5) times slower. Run with
+DEEPR_BENCHMARK_UPDATE=1 to record new baselines on the reference machine.
+
+    DEEPR_BENCHMARK=1 PYTHONPATH=deepr/backend pytest tests/test_benchmarks.py -s
+"""
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+# Assuming PYTHONPATH includes deepr/backend
+import openrouter_service
+from api import serialize_node_with_attachments
+from council_engine import CouncilEngine
+from database import Base
+from engines.drafts import compact_review_view, draft_similarity
+from engines.dxo_engine import DxOEngine
+from models import Attachment, Conversation, Node, User
+from openrouter_service import build_messages_with_attachments, get_unsupported_attachments
+from sse import encode_event
+
+pytestmark = pytest.mark.skipif(os.getenv("DEEPR_BENCHMARK") != "1", reason="Set DEEPR_BENCHMARK=1 to run benchmarks")
+
+BASELINE_FILE = Path(__file__).with_name("benchmark_baselines.json")
+THRESHOLD = float(os.getenv("DEEPR_BENCHMARK_THRESHOLD", "1.5"))
+UPDATE = os.getenv("DEEPR_BENCHMARK_UPDATE") == "1"
+MIN_ROUND_SECONDS = 0.05
+ROUNDS = 5
+
+
+def _report(name: str, per_call: float):
+    baselines = json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+    if UPDATE:
+        baselines[name] = per_call
+        BASELINE_FILE.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        return
+    baseline = baselines.get(name)
+    print(f"\n{name}: {per_call * 1e6:.1f} us/call (baseline {baseline * 1e6:.1f} us)" if baseline else f"\n{name}: {per_call * 1e6:.1f} us/call (no baseline)")
+    if baseline:
+        assert per_call <= baseline * THRESHOLD, (
+            f"{name} regressed: {per_call * 1e6:.1f} us/call vs baseline {baseline * 1e6:.1f} us (threshold x{THRESHOLD})"
+        )
+
+
+def bench(name: str, fn):
+    """Best per-call time over several rounds, each long enough to be measurable"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if time.perf_counter() - start >= MIN_ROUND_SECONDS:
+            break
+        loops *= 2
+    best = min(_time_round(fn, loops) for _ in range(ROUNDS))
+    _report(name, best)
+
+
+def _time_round(fn, loops):
+    start = time.perf_counter()
+    for _ in range(loops):
+        fn()
+    return (time.perf_counter() - start) / loops
+
+
+async def bench_async(name: str, coro_fn, loops: int = 50):
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for _ in range(loops):
+            await coro_fn()
+        elapsed = (time.perf_counter() - start) / loops
+        best = elapsed if best is None else min(best, elapsed)
+    _report(name, best)
+
+
+def _attachment(i, file_type="text", size=64 * 1024):
+    mime = {"text": "text/plain", "image": "image/png", "pdf": "application/pdf"}[file_type]
+    data = (b"line %d of the attached log file\n" % i) * (size // 32)
+    return SimpleNamespace(id=i, filename=f"file{i}.{file_type}", file_type=file_type, mime_type=mime, file_data=data, file_size=len(data))
+
+
+SAMPLE_DRAFT = "\n\n".join(
+    f"## Section {i}\nComponent {i} handles part {i} of the pipeline, retries with backoff and reports to component {i + 1}."
+    for i in range(80)
+)
+
+
+def test_bench_serialize_node_with_attachments():
+    node = SimpleNamespace(
+        id=1, conversation_id=1, parent_id=None, type="research", content=SAMPLE_DRAFT,
+        model_name="openai/gpt-4o", attachment_filenames="a.txt,b.png", prompt_sent=SAMPLE_DRAFT,
+        actual_cost=0.01, warnings=json.dumps(["warning one", "warning two"]),
+        attachments=[_attachment(i) for i in range(5)]
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        bench("serialize_node_with_attachments", lambda: loop.run_until_complete(serialize_node_with_attachments(None, node)))
+    finally:
+        loop.close()
+
+
+def test_bench_build_messages_with_large_attachments():
+    attachments = [_attachment(0, "pdf", 4 * 1024 * 1024), _attachment(1, "image", 2 * 1024 * 1024), _attachment(2, "text", 1024 * 1024)]
+    bench(
+        "build_messages_with_attachments",
+        lambda: build_messages_with_attachments([{"role": "user", "content": "Summarise the documents."}], attachments)
+    )
+
+
+def test_bench_get_unsupported_attachments():
+    openrouter_service._CACHED_MODELS_BY_USER[-1] = [
+        {"id": f"vendor/model-{i}", "capabilities": {"image": i % 2 == 0, "file": i % 3 == 0, "audio": False, "video": False, "text": True}}
+        for i in range(400)
+    ]
+    attachments = [_attachment(i, t, 16) for i, t in enumerate(["image", "pdf", "text"] * 4)]
+    try:
+        bench("get_unsupported_attachments", lambda: get_unsupported_attachments("vendor/model-399", attachments, -1))
+    finally:
+        del openrouter_service._CACHED_MODELS_BY_USER[-1]
+
+
+def test_bench_dxo_prompt_assembly():
+    engine = DxOEngine(None, None, None)
+    revised = SAMPLE_DRAFT.replace("Component 7 handles", "Component 7 now owns").replace("part 40 ", "part forty ")
+    role = {"name": "Security Expert", "model": "openai/gpt-4o", "instructions": "Focus on threats."}
+
+    def assemble():
+        draft_similarity(SAMPLE_DRAFT, revised)
+        changes = compact_review_view(SAMPLE_DRAFT, revised)
+        engine.build_review_prompt(role, revised, changes=changes)
+        engine.build_review_prompt({"name": "Critical Reviewer", "model": "x"}, revised, is_gatekeeper=True)
+
+    bench("dxo_prompt_assembly", assemble)
+
+
+def test_bench_sse_event_encoding():
+    node_data = {
+        'id': 42, 'conversation_id': 7, 'parent_id': 41, 'type': 'research', 'content': SAMPLE_DRAFT,
+        'model': 'openai/gpt-4o', 'attachment_filenames': 'a.txt', 'prompt_sent': SAMPLE_DRAFT,
+        'actual_cost': 0.0123, 'warnings': [], 'attachments': [{'id': 1, 'filename': 'a.txt', 'file_type': 'text', 'file_size': 10, 'mime_type': 'text/plain'}]
+    }
+    bench("sse_event_encoding", lambda: encode_event({'type': 'node', 'node': node_data}, 42))
+
+
+async def test_bench_get_attachments_chain():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    try:
+        async with session_factory() as db:
+            user = User(email="bench@example.com")
+            db.add(user)
+            await db.commit()
+            conversation = Conversation(user_id=user.id, title="bench")
+            db.add(conversation)
+            await db.commit()
+            parent_id = None
+            for depth in range(4):
+                node = Node(conversation_id=conversation.id, parent_id=parent_id, type="research", content="x")
+                db.add(node)
+                await db.commit()
+                for i in range(3):
+                    db.add(Attachment(node_id=node.id, filename=f"{depth}-{i}.txt", file_type="text", mime_type="text/plain", file_data=b"x" * 1024, file_size=1024))
+                await db.commit()
+                parent_id = node.id
+
+            council = CouncilEngine(db, user, None)
+            await bench_async("get_attachments_chain", lambda: council.get_attachments_chain(node, max_depth=3))
+    finally:
+        await engine.dispose()
@@ -0,0 +1,78 @@
+# Assuming PYTHONPATH includes deepr/backend
+from types import SimpleNamespace
+from engines.drafts import (
+    draft_similarity, shingle_similarity, sequence_similarity,
+    compact_review_view, encode_delta, decode_delta, maybe_encode_delta, DELTA_ENCODING
+)
+from storage import resolve_node_contents
+
+
+DRAFT = """
+The service exposes a REST API backed by PostgreSQL. Requests are authenticated
+with short-lived JWTs and every write goes through a single transaction. Reads are
+served from a replica and cached for thirty seconds in Redis.
+"""
+
+
+def test_identical_drafts_are_fully_similar():
+    assert draft_similarity(DRAFT, DRAFT) == 1.0
+
+
+def test_whitespace_and_case_changes_do_not_count():
+    reformatted = " ".join(DRAFT.split()).upper()
+    assert draft_similarity(DRAFT, reformatted) == 1.0
+
+
+def test_small_edit_stays_above_rewrite():
+    edited = DRAFT.replace("thirty seconds", "sixty seconds")
+    rewritten = "A completely different design built around an event log and CQRS projections."
+    assert draft_similarity(DRAFT, edited) > 0.7
+    assert draft_similarity(DRAFT, rewritten) < 0.1
+
+
+def test_reordering_is_penalised_by_sequence_score():
+    sentences = [s for s in DRAFT.split(".") if s.strip()]
+    reordered = ".".join(reversed(sentences))
+    assert sequence_similarity(DRAFT, reordered) < 1.0
+    assert draft_similarity(DRAFT, reordered) <= shingle_similarity(DRAFT, reordered)
+
+
+LONG_DRAFT = "\n\n".join(
+    f"## Section {i}\nComponent {i} handles part {i} of the pipeline and reports to component {i + 1}."
+    for i in range(40)
+)
+
+
+def test_delta_round_trip():
+    revised = LONG_DRAFT.replace("Component 7 handles", "Component 7 now owns").replace("## Section 30", "## Section 30b")
+    revised += "\n\n## Appendix\nRollout plan.\r\nNo trailing newline"
+    delta = encode_delta(LONG_DRAFT, revised)
+    assert decode_delta(LONG_DRAFT, delta) == revised
+    assert len(delta) < len(revised) / 4
+
+
+def test_delta_skipped_when_not_smaller():
+    assert maybe_encode_delta(LONG_DRAFT, "Entirely new text.") is None
+    assert maybe_encode_delta(None, LONG_DRAFT) is None
+
+
+def test_compact_review_view_only_lists_changed_sections():
+    revised = LONG_DRAFT.replace("Component 7 handles", "Component 7 now owns")
+    view = compact_review_view(LONG_DRAFT, revised)
+    assert view is not None
+    assert "Component 7 now owns" in view
+    assert "Component 20 handles" not in view
+    assert compact_review_view(LONG_DRAFT, "Entirely new text.") is None
+
+
+async def test_resolve_node_contents_rebuilds_delta_chain():
+    v2 = LONG_DRAFT.replace("part 3 ", "part three ")
+    v3 = v2.replace("part 12 ", "part twelve ")
+    nodes = [
+        SimpleNamespace(id=1, parent_id=None, content=LONG_DRAFT, content_encoding=None),
+        SimpleNamespace(id=2, parent_id=1, content=encode_delta(LONG_DRAFT, v2), content_encoding=DELTA_ENCODING),
+        SimpleNamespace(id=3, parent_id=2, content=encode_delta(v2, v3), content_encoding=DELTA_ENCODING),
+        SimpleNamespace(id=4, parent_id=3, content="Critique", content_encoding=None),
+    ]
+    contents = await resolve_node_contents(None, nodes)
+    assert contents == {1: LONG_DRAFT, 2: v2, 3: v3, 4: "Critique"}
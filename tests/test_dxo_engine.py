@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+# Assuming PYTHONPATH includes deepr/backend
+from database import Base
+from engines.dxo_engine import DxOEngine
+from models import Conversation, Node, User
+from storage import resolve_node_contents
+
+pytest_plugins = ('pytest_asyncio',)
+
+LEAD = {"name": "Lead Researcher", "model": "lead/model"}
+EXPERT = {"name": "Security Expert", "model": "expert/model"}
+CRITIC = {"name": "Critical Reviewer", "model": "critic/model"}
+
+DRAFTS = [
+    "Monolith on one VM with nightly backups and manual deploys.",
+    "Event sourced services on Kubernetes with blue green releases.",
+    "Serverless functions behind an API gateway, storage in DynamoDB.",
+]
+
+
+class StubClient:
+    """Answers by role: the lead returns the next draft, the critic the next score"""
+
+    def __init__(self, drafts, scores):
+        self.drafts = list(drafts)
+        self.scores = list(scores)
+        self.calls = []
+
+    async def chat_completion_details(self, model, messages, attachments=None, stream=False):
+        self.calls.append(model)
+        if model == LEAD["model"]:
+            content = self.drafts.pop(0)
+        elif model == CRITIC["model"]:
+            content = f"Critique. Confidence Score: {self.scores.pop(0)}"
+        else:
+            content = "Expert feedback."
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+        return response, {'actual_cost': 0.0}
+
+
+@pytest.fixture
+async def dxo_run():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)() as db:
+        user = User(email="dxo@example.com")
+        db.add(user)
+        await db.commit()
+        conversation = Conversation(user_id=user.id, title="design", method="dxo")
+        db.add(conversation)
+        await db.commit()
+        root = Node(conversation_id=conversation.id, type="root", content="Design a service", model_name="user")
+        db.add(root)
+        await db.commit()
+
+        async def run(client, roles, **kwargs):
+            dxo = DxOEngine(db, user, client)
+            events = [event async for event in dxo.run_dxo_pipeline(conversation.id, root, roles, **kwargs)]
+            nodes = (await db.execute(select(Node).where(Node.id != root.id).order_by(Node.id))).scalars().all()
+            contents = await resolve_node_contents(db, nodes)
+            return events, [(node.type, node.parent_id, contents[node.id], node.id) for node in nodes]
+
+        yield run
+    await engine.dispose()
+
+
+async def test_concurrent_schedule_scores_the_final_draft(dxo_run):
+    client = StubClient(DRAFTS, scores=[40, 70, 90])
+    events, nodes = await dxo_run(client, [LEAD, EXPERT, CRITIC], max_iterations=2, schedule="concurrent")
+
+    assert [node[0] for node in nodes] == [
+        "proposal", "critique", "critique", "refinement",  # loop 1: expert and gatekeeper side by side
+        "critique", "critique", "refinement",  # loop 2
+        "critique", "verdict",  # the last refinement is scored before the verdict
+    ]
+    final_draft_id = nodes[6][3]
+    last_review = nodes[7]
+    assert last_review[1] == final_draft_id and "Score: 90" in last_review[2]
+    assert "Status: APPROVED (Confidence: 90%)" in nodes[-1][2]
+    assert client.calls.count(CRITIC["model"]) == 3
+
+
+async def test_concurrent_schedule_approves_without_refinement(dxo_run):
+    client = StubClient(DRAFTS, scores=[95])
+    events, nodes = await dxo_run(client, [LEAD, EXPERT, CRITIC], max_iterations=3, schedule="concurrent")
+
+    assert [node[0] for node in nodes] == ["proposal", "critique", "critique", "verdict"]
+    assert "Status: APPROVED (Confidence: 95%)" in nodes[-1][2]
+    assert "Iterations: 1 Loops" in nodes[-1][2]
+
+
+def test_unknown_schedule_is_rejected():
+    from pydantic import ValidationError
+    from api import CouncilRunRequest
+    assert CouncilRunRequest(prompt="q", method="dxo", dxo_schedule="concurrent").dxo_schedule == "concurrent"
+    with pytest.raises(ValidationError):
+        CouncilRunRequest(prompt="q", method="dxo", dxo_schedule="concurent")
+
+async def test_converged_draft_ends_the_loop(dxo_run):
+    # The refinement only fixes a typo, so the loop stops after one round
+    proposal = DRAFTS[1] + " Each service owns its database and publishes domain events to Kafka."
+    client = StubClient([proposal, proposal.replace("Kafka", "Kafka.")], scores=[])
+    events, nodes = await dxo_run(client, [LEAD, EXPERT], max_iterations=5, convergence_threshold=0.8)
+
+    assert [node[0] for node in nodes] == ["proposal", "critique", "refinement", "verdict"]
+    assert any(e['type'] == 'status' and e['message'].startswith('Draft converged') for e in events)
+    # No gatekeeper scored the converged draft: no stale or made-up confidence
+    assert "Status: Converged (Confidence: n/a)" in nodes[-1][2]
+
+    # With a gatekeeper, the converged draft is scored once more
+    client = StubClient([proposal, proposal.replace("Kafka", "Kafka.")], scores=[60])
+    events, nodes = await dxo_run(client, [LEAD, EXPERT, CRITIC], max_iterations=5, convergence_threshold=0.8)
+    verdicts = [node for node in nodes if node[0] == "verdict"]
+    assert "Status: Converged (Confidence: 60%)" in verdicts[-1][2]
+    assert client.calls == [LEAD["model"], EXPERT["model"], LEAD["model"], CRITIC["model"]]
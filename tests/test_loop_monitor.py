@@ -0,0 +1,34 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+# Assuming PYTHONPATH includes deepr/backend
+import loop_monitor
+from loop_monitor import LoopMonitor
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_blocking_call_is_reported(caplog):
+    monitor = LoopMonitor(interval=0.01, blocking_threshold=0.1)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        samples = loop_monitor.LOOP_LAG.count()
+        stalls = loop_monitor.LOOP_BLOCKED.value()
+        with caplog.at_level(logging.WARNING, logger="loop_monitor"):
+            time.sleep(0.4)  # A synchronous call on the loop thread
+            await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+
+    assert loop_monitor.LOOP_LAG.count() > samples
+    assert monitor.take_max_lag() >= 0.3
+    assert monitor.take_max_lag() == 0.0
+    # One report per stall, however long it lasts
+    assert loop_monitor.LOOP_BLOCKED.value() == stalls + 1
+    [record] = [r for r in caplog.records if r.getMessage().startswith("Event loop blocked")]
+    assert "time.sleep(0.4)" in record.getMessage()
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+# Assuming PYTHONPATH includes deepr/backend
+from openrouter_service import build_messages_with_attachments
+from prompt_cache import add_cache_breakpoints, build_messages, cached_tokens, render
+
+
+def _attachment(name="notes.txt", data=b"attached notes"):
+    return SimpleNamespace(filename=name, file_type="text", mime_type="text/plain", file_data=data)
+
+
+def test_calls_of_a_phase_share_the_prompt_prefix():
+    first = build_messages("Design a cache", "You are the Security Expert.", "Draft:\nv1")
+    second = build_messages("Design a cache", "You are the QA Engineer.", "Draft:\nv1")
+    assert first[:-1] == second[:-1]
+    assert first[-1]["content"] != second[-1]["content"]
+    assert render(first) == "User Request:\nDesign a cache\n\nDraft:\nv1\n\nYou are the Security Expert."
+
+
+def test_attachments_only_in_first_user_message_ahead_of_its_text():
+    messages = build_messages_with_attachments(build_messages("Summarise", "You are the Chairman.", "Findings"), [_attachment()])
+    request, context, instructions = messages[1:]
+    assert [part["type"] for part in request["content"]] == ["text", "text"]
+    assert request["content"][0]["text"] == "attached notes"
+    assert request["content"][-1]["text"] == "User Request:\nSummarise"
+    assert context["content"] == "Findings" and instructions["content"] == "You are the Chairman."
+
+
+def test_cache_breakpoints_only_for_models_that_need_them():
+    messages = build_messages_with_attachments(build_messages("Summarise", "Answer.", "Findings"), [_attachment()])
+    assert add_cache_breakpoints("openai/gpt-4o", messages) == build_messages_with_attachments(
+        build_messages("Summarise", "Answer.", "Findings"), [_attachment()]
+    )
+
+    add_cache_breakpoints("anthropic/claude-sonnet-4", messages)
+    request, context, instructions = messages[1:]
+    assert "cache_control" not in request["content"][0]
+    assert request["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert context["content"] == [{"type": "text", "text": "Findings", "cache_control": {"type": "ephemeral"}}]
+    assert instructions["content"] == "Answer."
+
+
+def test_cached_tokens_from_usage():
+    assert cached_tokens({"prompt_tokens": 100, "prompt_tokens_details": {"cached_tokens": 80}}) == 80
+    assert cached_tokens({"prompt_tokens": 100, "prompt_tokens_details": None}) == 0
+    assert cached_tokens({"prompt_tokens": 100}) == 0
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+# Assuming PYTHONPATH includes deepr/backend
+from pubsub import InProcessBroker, NotificationAssembler, NOTIFY_CHUNK_BYTES, encode_notifications
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_subscriber_replays_after_last_event_id_then_follows():
+    broker = InProcessBroker()
+    for event_id, kind in enumerate(["start", "status", "node"], 1):
+        await broker.publish(7, event_id, {"type": kind})
+
+    received = []
+
+    async def follow():
+        async for event_id, event in broker.subscribe(7, last_event_id=1):
+            received.append((event_id, event["type"]))
+
+    task = asyncio.create_task(follow())
+    await asyncio.sleep(0)
+    await broker.publish(7, 4, {"type": "node"})
+    await broker.publish(7, 5, {"type": "done"})
+    await asyncio.wait_for(task, 1)
+
+    assert received == [(2, "status"), (3, "node"), (4, "node"), (5, "done")]
+    assert broker.has_run(7) and not broker.has_run(8)
+
+
+def test_large_events_are_split_and_reassembled():
+    event = {"type": "node", "node": {"content": "é" * (NOTIFY_CHUNK_BYTES * 2)}}
+    payloads = encode_notifications("worker1", 3, 9, event)
+    assert len(payloads) > 2
+    assert all(len(p.encode()) < 8000 for p in payloads)
+
+    assembler = NotificationAssembler()
+    results = [assembler.feed(p) for p in payloads]
+    assert results[:-1] == [None] * (len(payloads) - 1)
+    assert results[-1] == ("worker1", 3, 9, event)
+
+
+@pytest.mark.asyncio
+async def test_run_that_goes_silent_is_dropped(monkeypatch):
+    import pubsub
+    monkeypatch.setattr(pubsub, "STALE_RUN_SECONDS", 0.2)
+    broker = InProcessBroker()
+    await broker.publish(7, 1, {"type": "start"})
+
+    async def follow(conversation_id):
+        return [event async for _, event in broker.subscribe(conversation_id)]
+
+    # Its worker died without a terminal event: live subscribers are told so
+    events = await asyncio.wait_for(follow(7), 1)
+    assert events == [{"type": "start"}, {"type": "error", "message": "Run stopped without finishing"}]
+    assert not broker.is_running(7) and not broker.has_run(7)
+
+    # A channel found stale by another request ends its subscriber at once
+    await broker.publish(8, 1, {"type": "start"})
+    task = asyncio.create_task(follow(8))
+    await asyncio.sleep(0.1)
+    broker._channels[8].updated_at -= 3600
+    assert not broker.has_run(8)
+    assert (await asyncio.wait_for(task, 1))[-1]["message"] == "Run stopped without finishing"
+
+
+def test_lost_parts_do_not_pile_up(monkeypatch):
+    import pubsub
+    now = [1000.0]
+    monkeypatch.setattr(pubsub.time, "monotonic", lambda: now[0])
+    event = {"type": "node", "node": {"content": "x" * (NOTIFY_CHUNK_BYTES * 2)}}
+    assembler = NotificationAssembler()
+
+    # The last part never arrives (listener reconnect)
+    first, second, _ = encode_notifications("worker1", 3, 9, event)
+    assert assembler.feed(first) is None and assembler.feed(second) is None
+    now[0] += pubsub.PARTIAL_EVENT_SECONDS
+    payloads = encode_notifications("worker1", 3, 10, event)
+    assert assembler.feed(payloads[0]) is None
+    assert list(assembler._partial) == [("worker1", 3, 10)]
+
+    # A lost middle part is reported instead of yielding a truncated event
+    with pytest.raises(ValueError):
+        assembler.feed(payloads[2])
+    assert not assembler._partial
+
+    for event_id in range(pubsub.MAX_PARTIAL_EVENTS + 10):
+        assembler.feed(encode_notifications("worker1", 3, event_id, event)[0])
+    assert len(assembler._partial) == pubsub.MAX_PARTIAL_EVENTS
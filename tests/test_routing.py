@@ -0,0 +1,137 @@
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+# Assuming PYTHONPATH includes deepr/backend
+import routing
+from database import Base
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.fixture
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(routing, "_stats", {})
+    monkeypatch.setattr(routing, "_dirty", set())
+
+
+def test_auto_routing_and_circuit_breaker(fresh_stats, monkeypatch):
+    for _ in range(routing.MIN_CALLS):
+        routing.record_call("fast/model", 2.0, ok=True, cost=0.002, tokens=1000)
+        routing.record_call("cheap/model", 8.0, ok=True, cost=0.0005, tokens=1000)
+    routing.record_call("fresh/model", 1.0, ok=True)
+
+    candidates = ["cheap/model", "fast/model", "fresh/model"]
+    # Unmeasured candidates are tried first, then the best measured one
+    assert routing.assign(["auto", "auto"], candidates)[0] == ["fresh/model", "fast/model"]
+    assert routing.assign(["auto", "auto"], candidates, "cost")[0] == ["fresh/model", "cheap/model"]
+    # An explicitly listed model is not handed to an "auto" slot as well
+    assert routing.assign(["fresh/model", "auto"], candidates)[0] == ["fresh/model", "fast/model"]
+    with pytest.raises(ValueError):
+        routing.assign(["auto"], [])
+
+    now = [1000.0]
+    monkeypatch.setattr(routing.time, "monotonic", lambda: now[0])
+    for _ in range(routing.BREAKER_FAILURES):
+        routing.record_call("fast/model", 0.1, ok=False)
+    assert not routing.is_available("fast/model")
+    models, notes = routing.assign(["fast/model", "other/model"], ["fast/model", "cheap/model"])
+    assert models == ["cheap/model", "other/model"]
+    assert notes == ["fast/model is failing; using cheap/model instead"]
+    # Without candidates the run keeps the model it asked for
+    assert routing.assign(["fast/model"], [])[0] == ["fast/model"]
+
+    # After the cooldown one run may try it again; failing reopens the circuit, succeeding closes it
+    now[0] += routing.BREAKER_COOLDOWN_SECONDS
+    assert routing.assign(["auto"], ["fast/model"])[0] == ["fast/model"]
+    assert not routing.is_available("fast/model")
+    now[0] += routing.BREAKER_COOLDOWN_SECONDS
+    routing.record_call("fast/model", 2.0, ok=True)
+    assert routing.is_available("fast/model")
+    assert routing._stats["fast/model"].error_rate > 0
+
+
+@pytest.mark.asyncio
+async def test_model_stats_persist(fresh_stats, monkeypatch):
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    routing.record_call("a/model", 3.0, ok=True, ttft=0.5, cost=0.01, tokens=2000)
+    routing.record_call("a/model", 1.0, ok=False)
+    async with session() as db:
+        assert await routing.flush_stats(db) == 1
+        routing.record_call("a/model", 5.0, ok=True)
+        assert await routing.flush_stats(db) == 1
+        assert await routing.flush_stats(db) == 0
+
+    expected = routing._stats["a/model"]
+    monkeypatch.setattr(routing, "_stats", {})
+    async with session() as db:
+        await routing.load_stats(db)
+    loaded = routing._stats["a/model"]
+    assert (loaded.latency, loaded.ttft, loaded.error_rate, loaded.cost_per_1k, loaded.calls) == \
+        (expected.latency, expected.ttft, expected.error_rate, expected.cost_per_1k, 3)
+    assert loaded.latency == pytest.approx(3.0 + routing.EWMA_ALPHA * 2.0)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_caller_errors_do_not_open_the_circuit(fresh_stats, monkeypatch):
+    import httpx
+    import openai
+    from openrouter_service import OpenRouterClient
+
+    request = httpx.Request("POST", "https://openrouter.test/api/v1/chat/completions")
+    client = OpenRouterClient("revoked-key")
+    error = {}
+
+    async def failing_create(**kwargs):
+        raise error["next"]
+    monkeypatch.setattr(client.client.chat.completions, "create", failing_create)
+
+    # One user's revoked key is not the model's fault
+    error["next"] = openai.AuthenticationError("bad key", response=httpx.Response(401, request=request), body=None)
+    for _ in range(routing.BREAKER_FAILURES + 1):
+        with pytest.raises(openai.AuthenticationError):
+            await client.chat_completion_details("shared/model", [{"role": "user", "content": "q"}])
+    assert routing.is_available("shared/model")
+    assert "shared/model" not in routing._stats
+
+    error["next"] = openai.InternalServerError("upstream down", response=httpx.Response(503, request=request), body=None)
+    for _ in range(routing.BREAKER_FAILURES):
+        with pytest.raises(openai.InternalServerError):
+            await client.chat_completion_details("shared/model", [{"role": "user", "content": "q"}])
+    assert not routing.is_available("shared/model")
+
+
+@pytest.mark.asyncio
+async def test_cancelled_calls_are_traced_but_not_failures(fresh_stats, monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+    import metrics
+    import tracing
+    from openrouter_service import OpenRouterClient
+
+    spans = []
+    monkeypatch.setattr(tracing, "_file_exporter", SimpleNamespace(export=spans.append))
+    client = OpenRouterClient("key")
+
+    async def slow_create(**kwargs):
+        await asyncio.sleep(30)
+    monkeypatch.setattr(client.client.chat.completions, "create", slow_create)
+
+    # A run deadline gives up on the call
+    cancelled = metrics.MODEL_CALL_DURATION.count(model="slow/model", outcome="cancelled")
+    task = asyncio.create_task(client.chat_completion_details("slow/model", [{"role": "user", "content": "q"}]))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert metrics.MODEL_CALL_DURATION.count(model="slow/model", outcome="cancelled") == cancelled + 1
+    [span] = spans
+    assert span.name == "openrouter.chat_completion" and span.end_time_unix_nano is not None
+    assert span.attributes["llm.cancelled"] is True and span.attributes["exception.type"] == "CancelledError"
+    assert "slow/model" not in routing._stats
@@ -0,0 +1,68 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+# Assuming PYTHONPATH includes deepr/backend
+from sse import EventStream, coalesce, encode_event
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+def parse(body: bytes):
+    events, comments = [], []
+    for block in body.decode().split("\n\n"):
+        if block.startswith(":"):
+            comments.append(block)
+        elif block:
+            fields = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((int(fields["id"]), json.loads(fields["data"])))
+    return events, comments
+
+
+async def collect(stream: EventStream) -> bytes:
+    return b"".join([chunk async for chunk in stream])
+
+
+def test_encode_event_is_single_data_line():
+    body = encode_event({"type": "node", "node": {"content": "line one\nline two", "name": "café"}}, 7)
+    assert body.startswith(b"id: 7\ndata: ") and body.endswith(b"\n\n")
+    assert body.count(b"\n") == 3
+    assert json.loads(body.split(b"data: ", 1)[1])["node"]["content"] == "line one\nline two"
+
+
+def test_coalesce_merges_deltas_and_keeps_statuses_without_backpressure():
+    events = list(enumerate([
+        {"type": "status", "message": "a"}, {"type": "status", "message": "b"},
+        {"type": "delta", "node_id": 1, "content": "Hel"}, {"type": "delta", "node_id": 1, "content": "lo"},
+        {"type": "delta", "node_id": 2, "content": "!"},
+    ], 1))
+    assert coalesce(events) == [
+        (1, {"type": "status", "message": "a"}), (2, {"type": "status", "message": "b"}),
+        (4, {"type": "delta", "node_id": 1, "content": "Hello"}), (5, {"type": "delta", "node_id": 2, "content": "!"}),
+    ]
+    assert coalesce(events[:2], drop_statuses=True) == [(2, {"type": "status", "message": "b"})]
+
+
+@pytest.mark.asyncio
+async def test_event_stream_ids_and_heartbeats():
+    async def events():
+        yield {"type": "start"}
+        await asyncio.sleep(0.05)
+        yield {"type": "done"}
+
+    body = await collect(EventStream(events(), heartbeat_interval=0.01))
+    parsed, comments = parse(body)
+    assert parsed == [(1, {"type": "start"}), (2, {"type": "done"})]
+    assert comments and comments[0] == ": keep-alive"
+
+
+@pytest.mark.asyncio
+async def test_event_stream_gzip_round_trip():
+    async def events():
+        for i in range(3):
+            yield {"type": "node", "node": {"id": i}}
+
+    body = gzip.decompress(await collect(EventStream(events(), compress=True)))
+    assert [event["node"]["id"] for _, event in parse(body)[0]] == [0, 1, 2]